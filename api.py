@@ -4,22 +4,72 @@ Defines all methods needed for the API. Implemented using Google Cloud Endpoints
 
 __author__ = 'Cesar'
 
+import collections
 import endpoints
 from google.appengine.ext import ndb
-from google.appengine.api import taskqueue
 from protorpc import remote
 import logging
 import messages
-from user import User, UserCreationError, GetUserError
-from meter import Meter, MeterCreationError, GetMeterError
-from reading import Reading, ReadingCreationError, GetReadingError
-from reading import TaskCreationError, NotificationCreationError
-from bill import Bill, BillCreationError, GetBillError, BillPaymentError
-from prepay import Prepay, PrepayCreationError, GetPrepayError, PrepayPaymentError
+import serializers
+from user import User
+from meter import Meter
+from reading import Reading
+from bill import Bill
+from prepay import Prepay
 import jmas_api
-from parse_api import Push
+import history
+import consumption
+import errors
+import cache
+import instrumentation
 package = 'OCR'
 
+# Push notifications (title, text) sent to the user once the result of a reading is known
+NEW_READING_NOTIFICATION = ("Nueva Lectura!", "Lectura Procesada. Valor: {0}")
+NEGATIVE_CONSUMPTION_NOTIFICATION = ("Error en Lectura =(",
+                                     "Lo sentimos, algo salio mal con tu lectura .."
+                                     " lo estamos revisando (consumo negativo)")
+OCR_ERROR_NOTIFICATION = ("Error en Lectura =(",
+                          "Lo sentimos, algo salio mal con tu lectura .."
+                          " lo estamos revisando (error en OCR)")
+HUMAN_REVIEW_NOTIFICATION_TITLE = "Resultado de Revision de Lectura"
+# Accounts allowed to lease OCR-Worker tasks, the same users as the ACLs of the OCR queues (see queue.yaml)
+OCR_WORKER_EMAILS = ('382197999605-compute@developer.gserviceaccount.com', 'cesar@golocky.com')
+
+
+def require_ocr_worker():
+    """
+    Checks that the caller is authenticated as one of OCR_WORKER_EMAILS.
+        :exception PlatformError with PERMISSION_DENIED otherwise
+    """
+    try:
+        user = endpoints.get_current_user()
+    except endpoints.InvalidGetUserCall:
+        user = None
+    if user is None or user.email().lower() not in OCR_WORKER_EMAILS:
+        raise errors.PlatformError('Only OCR-Worker accounts can lease tasks', errors.PERMISSION_DENIED)
+
+
+def result_effects(outcome, result):
+    """
+    Classifies the outcome of an image processing result into its effects.
+        :param outcome: (String) Saved, NegativeConsumption or Error (see Reading.save_task_results_to_datastore)
+        :param result: (messages.ImageProcessingResult)
+        :return: (delete_task, queue, notification): True if the task must be deleted from the
+                 image-processing-queue, the OCR engineering queue that receives the image (or None) and the
+                 (title, text) of the push notification
+    """
+    # Tasks done by human hand come from the OCR engineering queues, not from the image-processing-queue
+    delete_task = not result.human
+    if outcome == 'Saved':
+        push_title, push_text = NEW_READING_NOTIFICATION
+        return delete_task, None, (push_title, push_text.format(result.result))
+    if outcome == 'NegativeConsumption':
+        return delete_task, 'negative-consumption-queue', NEGATIVE_CONSUMPTION_NOTIFICATION
+    if result.human:
+        return delete_task, None, (HUMAN_REVIEW_NOTIFICATION_TITLE, result.error)
+    return delete_task, 'need-help-queue', OCR_ERROR_NOTIFICATION
+
 
 @endpoints.api(name='backend', version='v1', hostname='ocr-backend.appspot.com')
 class OCRBackendApi(remote.Service):
@@ -35,6 +85,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='user.create',
                       path='user/create')
+    @instrumentation.instrumented
     def new_user(self, request):
         """
         Generates a new user in the platform, if the email is already in use returns an error
@@ -51,9 +102,10 @@ class OCRBackendApi(remote.Service):
                                      age=request.age,
                                      account_type=request.account_type,
                                      installation_id=request.installation_id)
-        except UserCreationError as e:
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
             resp.ok = True
         return resp
@@ -63,6 +115,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='user.get',
                       path='user/get')
+    @instrumentation.instrumented
     def get_user(self, request):
         """
         Gets a user information based on it's email address
@@ -76,13 +129,15 @@ class OCRBackendApi(remote.Service):
             resp.age = retrieved_user.age
             resp.account_type = retrieved_user.account_type
             resp.installation_id = retrieved_user.installation_id
-        except GetUserError as e:
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         except Exception as e:
+            logging.exception("[FrontEnd - get_user()] - Unexpected error")
             resp.ok = False
             resp.error = e.message
-
+            resp.error_code = errors.INTERNAL
         else:
             resp.ok = True
         return resp
@@ -95,6 +150,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='meter.create',
                       path='meter/create')
+    @instrumentation.instrumented
     def new_meter(self, request):
         """
         Generates a new meter in the platform, if the account number is already in use returns an error
@@ -103,10 +159,39 @@ class OCRBackendApi(remote.Service):
         resp = messages.CreateMeterResponse()
         try:
             Meter.create_in_datastore(account_number=request.account_number)
-        except MeterCreationError as e:
+        except errors.PlatformError as e:
+            resp.ok = False
+            resp.error = e.value
+            resp.error_code = e.code
+        else:
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.CreateMeters,
+                      messages.CreateMetersResponse,
+                      http_method='POST',
+                      name='meter.create_batch',
+                      path='meter/create_batch')
+    @instrumentation.instrumented
+    def new_meters(self, request):
+        """
+        Generates several meters in the platform. Each account number succeeds or fails on its own,
+        see the results of the response.
+        """
+        logging.debug("[FrontEnd - new_meters()] - Account Numbers = {0}".format(len(request.account_numbers)))
+        resp = messages.CreateMetersResponse()
+        try:
+            results = Meter.create_batch(request.account_numbers)
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
+            resp.results = [messages.CreateMeterStatus(account_number=account_number,
+                                                       ok=error is None,
+                                                       error=error.value if error else None,
+                                                       error_code=error.code if error else None)
+                            for account_number, error in results.items()]
             resp.ok = True
         return resp
 
@@ -115,6 +200,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='meter.get',
                       path='meter/get')
+    @instrumentation.instrumented
     def get_meter(self, request):
         """
         Gets a meter information based on it's account_number
@@ -126,13 +212,50 @@ class OCRBackendApi(remote.Service):
             resp.account_number = retrieved_meter.account_number
             resp.balance = retrieved_meter.balance
             resp.model = retrieved_meter.model
-        except GetMeterError as e:
+            resp.last_measure = retrieved_meter.last_measure
+            resp.last_reading_date = retrieved_meter.last_reading_date
+            if retrieved_meter.last_reading_key:
+                resp.last_reading_key = retrieved_meter.last_reading_key.urlsafe()
+            resp.status = retrieved_meter.status
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         except Exception as e:
+            logging.exception("[FrontEnd - get_meter()] - Unexpected error")
             resp.ok = False
             resp.error = e.message
+            resp.error_code = errors.INTERNAL
+        else:
+            resp.ok = True
+        return resp
 
+    @endpoints.method(messages.GetOnboardingStatus,
+                      messages.GetOnboardingStatusResponse,
+                      http_method='POST',
+                      name='meter.onboarding_status',
+                      path='meter/onboarding_status')
+    @instrumentation.instrumented
+    def get_onboarding_status(self, request):
+        """
+        Gets the onboarding status of a meter and the progress of its history import
+        """
+        logging.debug("[FrontEnd - get_onboarding_status()] - account_number = {0}".format(request.account_number))
+        resp = messages.GetOnboardingStatusResponse()
+        try:
+            # Read from the datastore, the status changes while the onboarding task runs
+            retrieved_meter = Meter.get_from_datastore(account_number=request.account_number, use_cache=False)
+            resp.status = retrieved_meter.status
+            state = history.HistoryImport.get_from_datastore(request.account_number)
+            if state is not None:
+                resp.history_status = state.status
+                resp.history_total = state.total
+                resp.history_imported = state.imported
+                resp.history_error = state.error
+        except errors.PlatformError as e:
+            resp.ok = False
+            resp.error = e.value
+            resp.error_code = e.code
         else:
             resp.ok = True
         return resp
@@ -142,6 +265,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='meter.assign_to_user',
                       path='meter/assign_to_user')
+    @instrumentation.instrumented
     def assign_meter_to_user(self, request):
         """
         Assigns a meter to a user (email)
@@ -155,15 +279,15 @@ class OCRBackendApi(remote.Service):
             else:
                 resp.ok = False
                 resp.error = 'Meter could not be assigned to user!'
-        except GetUserError as e:
-            resp.ok = False
-            resp.error = e.value
-        except GetMeterError as e:
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         except Exception as e:
+            logging.exception("[FrontEnd - assign_meter_to_user()] - Unexpected error")
             resp.ok = False
             resp.error = e.message
+            resp.error_code = errors.INTERNAL
         return resp
 
     @endpoints.method(messages.GetMeters,
@@ -171,6 +295,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='meter.get_all_assigned_to_user',
                       path='meter/get_all_assigned_to_user')
+    @instrumentation.instrumented
     def get_meters(self, request):
         """
         Gets all meters assigned to a user
@@ -179,9 +304,10 @@ class OCRBackendApi(remote.Service):
         resp = messages.GetMetersResponse()
         try:
             meters = Meter.get_all_from_datastore(request.user)
-        except GetMeterError as e:
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
             for m in meters:
                 r = messages.Meter()
@@ -201,6 +327,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='reading.new_image_for_processing',
                       path='reading/new_image_for_processing')
+    @instrumentation.instrumented
     def new_image_for_processing(self, request):
         """
         Generates a new task to process the new image received in the platform
@@ -212,169 +339,203 @@ class OCRBackendApi(remote.Service):
             Reading.set_image_processing_task(queue='image-processing-queue',
                                               meter=request.account_number,
                                               image_name=request.image_name)
-        except TaskCreationError as e:
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
             resp.ok = True
         return resp
 
+    @endpoints.method(messages.LeaseTasks,
+                      messages.LeaseTasksResponse,
+                      http_method='POST',
+                      name='reading.lease_tasks',
+                      path='reading/lease_tasks',
+                      scopes=[endpoints.EMAIL_SCOPE],
+                      allowed_client_ids=[endpoints.SKIP_CLIENT_ID_CHECK])
+    @instrumentation.instrumented
+    def lease_tasks(self, request):
+        """
+        Leases OCR-Worker tasks of one meter model, so a worker pool can keep a single model loaded. Only for
+        OCR-Worker accounts (see OCR_WORKER_EMAILS), authenticated with an OAuth token of the email scope.
+        """
+        logging.debug("[FrontEnd - lease_tasks()] - Queue = {0} Tag = {1} Max = {2}"
+                      .format(request.queue, request.tag, request.max_tasks))
+        resp = messages.LeaseTasksResponse()
+        try:
+            require_ocr_worker()
+            tasks = Reading.lease_image_processing_tasks(queue=request.queue,
+                                                         tag=request.tag,
+                                                         max_tasks=request.max_tasks,
+                                                         lease_seconds=request.lease_seconds)
+        except errors.PlatformError as e:
+            resp.ok = False
+            resp.error = e.value
+            resp.error_code = e.code
+        else:
+            resp.tasks = [messages.LeasedTask(task_name=t.name,
+                                              task_payload=t.payload,
+                                              tag=t.tag,
+                                              retry_count=t.retry_count)
+                          for t in tasks]
+            resp.ok = True
+        return resp
+
     @endpoints.method(messages.ImageProcessingResult,
                       messages.ImageProcessingResultResponse,
                       http_method='POST',
                       name='reading.set_image_processing_result',
                       path='reading/set_image_processing_result')
+    @instrumentation.instrumented
     def set_image_processing_result(self, request):
         """
         Set the result of an image processing task
             request.task_name: Process--[image]
             request.task_payload: [meter]--[image]
             request.human: True, False
+
+        Runs as a pipeline of timed stages: load the meter (cached), apply the result and queue its push (one
+        transaction, see Reading.save_task_result_to_datastore), classify the outcome (see result_effects) and
+        apply its effects on the OCR queues.
         """
         logging.debug("[FrontEnd - set_image_processing_result()] - Task Name = {0}".format(request.task_name))
         logging.debug("[FrontEnd - set_image_processing_result()] - Task Payload = {0}".format(request.task_payload))
         logging.debug("[FrontEnd - set_image_processing_result()] - Result = {0}".format(request.result))
         logging.debug("[FrontEnd - set_image_processing_result()] - Error = {0}".format(request.error))
         logging.debug("[FrontEnd - set_image_processing_result()] - Human = {0}".format(request.human))
-        account_number, image = request.task_payload.split('--')
         resp = messages.ImageProcessingResultResponse()
+        timer = instrumentation.StageTimer('FrontEnd - set_image_processing_result()')
         try:
-            if request.human:
-                # OCR performed by human hand (http://human-helper.ddns.net)
-                if '' == request.error:
-                    if Reading.save_to_datastore(meter=account_number, measure=request.result):
-                        # Prepare Push notification
-                        meter = Meter.get_from_datastore(account_number)
-                        user = User.get_by_meter_key(meter.key)
-                        logging.debug("[FrontEnd - set_image_processing_result()] - "
-                                      "Installation_Id for notification = {0}"
-                                      .format(user.installation_id))
-                        # Send Push notification
-                        p = Push(user.installation_id)
-                        push_title = "Nueva Lectura!"
-                        push_text = "Lectura Procesada. Valor: {0}".format(request.result)
-                        logging.debug("[FrontEnd - set_image_processing_result()] - Text of notification = {0}"
-                                      .format(push_text))
-
-                        p.send(title=push_title, message=push_text)
-                    else:
-                        logging.warning('[FrontEnd - set_image_processing_result()] - Consumo Negativo')
-                        # Create task to investigate negative consumption (OCR engineering)
-                        Reading.set_image_processing_task(queue='negative-consumption-queue',
-                                                          meter=account_number,
-                                                          image_name=image)
-                        # Prepare Push notification
-                        meter = Meter.get_from_datastore(account_number)
-                        user = User.get_by_meter_key(meter.key)
-                        logging.debug("[FrontEnd - set_image_processing_result()] "
-                                      "- Installation_Id for notification = {0}"
-                                      .format(user.installation_id))
-                        # Push notification for user to inform that the reading is wrong
-                        p = Push(user.installation_id)
-                        push_title = "Error en Lectura =("
-                        push_text = "Lo sentimos, algo salio mal con tu lectura .." \
-                                    " lo estamos revisando (consumo negativo)"
-                        logging.debug("[FrontEnd - set_image_processing_result()]"
-                                      " - Text of notification = {0}"
-                                      .format(push_text))
-                        p.send(title=push_title, message=push_text)
-
-                else:
-                    logging.warning('[FrontEnd - set_image_processing_result()] - Error in human OCR')
-                    # Prepare Push notification
-                    meter = Meter.get_from_datastore(account_number)
-                    user = User.get_by_meter_key(meter.key)
-                    logging.debug("[FrontEnd - set_image_processing_result()] -"
-                                  " Installation_Id for notification = {0}"
-                                  .format(user.installation_id))
-                    # Push notification for user to inform that the reading is wrong
-                    p = Push(user.installation_id)
-                    push_title = "Resultado de Revision de Lectura"
-                    push_text = request.error
-                    logging.debug("[FrontEnd - set_image_processing_result()]"
-                                  " - Text of notification = {0}"
-                                  .format(push_text))
-                    p.send(title=push_title, message=push_text)
+            with timer.stage('load'):
+                try:
+                    account_number, image = request.task_payload.split('--')
+                except ValueError:
+                    raise errors.PlatformError('Malformed task payload: {0}'.format(request.task_payload),
+                                               errors.INVALID_ARGUMENT)
+                Meter.get_from_datastore(account_number)
 
-            else:
-                # OCR performed by VMX engine
-                if '' == request.error:
-                    if Reading.save_to_datastore(meter=account_number, measure=request.result):
-                        # OCR-Worker done with task with successful result and result saved. Delete task from queue
-                        q = taskqueue.Queue('image-processing-queue')
-                        q.delete_tasks_by_name(str(request.task_name))
-                        # Prepare Push notification
-                        meter = Meter.get_from_datastore(account_number)
-                        user = User.get_by_meter_key(meter.key)
-                        logging.debug("[FrontEnd - set_image_processing_result()] "
-                                      "- Installation_Id for notification = {0}"
-                                      .format(user.installation_id))
-                        # Send Push notification
-                        p = Push(user.installation_id)
-                        push_title = "Nueva Lectura!"
-                        push_text = "Lectura Procesada. Valor: {0}".format(request.result)
-                        logging.debug("[FrontEnd - set_image_processing_result()] - Text of notification = {0}"
-                                      .format(push_text))
-
-                        p.send(title=push_title, message=push_text)
-                    else:
-                        logging.warning('[FrontEnd - set_image_processing_result()] - Consumo Negativo')
-                        # OCR-Worker done with task with successful result but we have negative consumption.
-                        q = taskqueue.Queue('image-processing-queue')
-                        q.delete_tasks_by_name(str(request.task_name))
-                        # Create task to investigate negative consumption (OCR engineering)
-                        Reading.set_image_processing_task(queue='negative-consumption-queue',
-                                                          meter=account_number,
-                                                          image_name=image)
-                        # Prepare Push notification
-                        meter = Meter.get_from_datastore(account_number)
-                        user = User.get_by_meter_key(meter.key)
-                        logging.debug("[FrontEnd - set_image_processing_result()] "
-                                      "- Installation_Id for notification = {0}"
-                                      .format(user.installation_id))
-                        # Push notification for user to inform that the reading is wrong
-                        p = Push(user.installation_id)
-                        push_title = "Error en Lectura =("
-                        push_text = "Lo sentimos, algo salio mal con tu lectura .." \
-                                    " lo estamos revisando (consumo negativo)"
-                        logging.debug("[FrontEnd - set_image_processing_result()]"
-                                      " - Text of notification = {0}"
-                                      .format(push_text))
-                        p.send(title=push_title, message=push_text)
-                else:
-                    logging.warning('[FrontEnd - set_image_processing_result()] - Error en OCR')
-                    # OCR-Worker done with task with invalid result. Delete OCR image processing task
-                    q = taskqueue.Queue('image-processing-queue')
-                    q.delete_tasks_by_name(str(request.task_name))
-                    # Create task to help automatic OCR in recognizing numbers (OCR engineering)
-                    Reading.set_image_processing_task(queue='need-help-queue',
-                                                      meter=account_number,
-                                                      image_name=image)
-                    # Prepare Push notification
-                    meter = Meter.get_from_datastore(account_number)
-                    user = User.get_by_meter_key(meter.key)
-                    logging.debug("[FrontEnd - set_image_processing_result()] -"
-                                  " Installation_Id for notification = {0}"
-                                  .format(user.installation_id))
-                    # Push notification for user to inform that the reading is wrong
-                    p = Push(user.installation_id)
-                    push_title = "Error en Lectura =("
-                    push_text = "Lo sentimos, algo salio mal con tu lectura .." \
-                                " lo estamos revisando (error en OCR)"
-                    logging.debug("[FrontEnd - set_image_processing_result()]"
-                                  " - Text of notification = {0}"
-                                  .format(push_text))
-                    p.send(title=push_title, message=push_text)
-
-        except (NotificationCreationError, ReadingCreationError) as e:
+            with timer.stage('reading'):
+                # Reading, balance and TaskResult are written in one transaction, a retried submission is a no-op
+                # The push is queued in the same transaction, a committed reading always has its push
+                outcome, duplicate = Reading.save_task_result_to_datastore(
+                    meter=account_number,
+                    task_name=request.task_name,
+                    human=request.human,
+                    measure=request.result if '' == request.error else None,
+                    notification=lambda outcome: result_effects(outcome, request)[2])
+                resp.outcome = outcome
+                resp.duplicate = duplicate
+
+            with timer.stage('classify'):
+                delete_task, queue, _ = result_effects(outcome, request)
+                logging.debug("[FrontEnd - set_image_processing_result()] - Outcome = {0} Duplicate = {1}"
+                              .format(outcome, duplicate))
+
+            with timer.stage('effects'):
+                # Task moves are repeated for a duplicate, the previous submission may have failed before them
+                if delete_task:
+                    # OCR-Worker done with task, delete it from the image-processing-queue
+                    Reading.delete_image_processing_tasks('image-processing-queue', [request.task_name])
+                if queue:
+                    # Create task for OCR engineering (negative consumption or help to recognize numbers). Tasks
+                    # are named, adding it again is a no-op
+                    Reading.set_image_processing_task(queue=queue, meter=account_number, image_name=image)
+
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
-
+            resp.error_code = e.code
         except Exception as e:
+            logging.exception("[FrontEnd - set_image_processing_result()] - Unexpected error")
             resp.ok = False
-            resp.error = 'Error deleting OCR-Worker task from queue: {0}'.format(e.__str__())
+            resp.error = 'Error processing OCR-Worker result: {0}'.format(e.__str__())
+            resp.error_code = errors.INTERNAL
         else:
             resp.ok = True
+        timer.log()
+        return resp
+
+    @endpoints.method(messages.ImageProcessingResultsBatch,
+                      messages.ImageProcessingResultsBatchResponse,
+                      http_method='POST',
+                      name='reading.set_image_processing_results_batch',
+                      path='reading/set_image_processing_results_batch')
+    @instrumentation.instrumented
+    def set_image_processing_results_batch(self, request):
+        """
+        Set the results of several image processing tasks at once. Results are grouped by meter and applied
+        in the order received, each meter independently of the others, and finished tasks are deleted from
+        the image-processing-queue with a single call.
+            request.results: see set_image_processing_result
+        """
+        logging.debug("[FrontEnd - set_image_processing_results_batch()] - Results = {0}"
+                      .format(len(request.results)))
+        resp = messages.ImageProcessingResultsBatchResponse()
+        statuses = [messages.ImageProcessingResultStatus(task_name=r.task_name, ok=False)
+                    for r in request.results]
+        resp.results = statuses
+
+        # Group by meter keeping the order in which results were received
+        by_meter = collections.OrderedDict()
+        for i, result in enumerate(request.results):
+            try:
+                account_number, image = result.task_payload.split('--')
+            except ValueError:
+                statuses[i].error = 'Malformed task payload: {0}'.format(result.task_payload)
+                statuses[i].error_code = errors.INVALID_ARGUMENT
+                continue
+            by_meter.setdefault(account_number, []).append((i, image, result))
+        meters = dict(zip(by_meter.keys(), ndb.get_multi([Meter.get_key(a) for a in by_meter])))
+
+        # Keyed by task name: a task repeated in the submission is deleted and moved once, the queue calls
+        # reject repeated names
+        finished_tasks = collections.OrderedDict()
+        new_tasks = {'negative-consumption-queue': collections.OrderedDict(),
+                     'need-help-queue': collections.OrderedDict()}
+        for account_number, items in by_meter.items():
+            if meters[account_number] is None and Meter.migrate_legacy(account_number) is None:
+                for i, image, result in items:
+                    statuses[i].error = 'Meter does not exist'
+                    statuses[i].error_code = errors.NOT_FOUND
+                continue
+            # Pushes are queued in the transactions of the readings, a committed reading always has its push
+            outcomes, error = Reading.save_task_results_to_datastore(
+                account_number,
+                [(result.task_name, result.human, result.result if '' == result.error else None)
+                 for i, image, result in items],
+                notify=lambda n, outcome, items=items: result_effects(outcome, items[n][2])[2])
+            if error is not None:
+                # Results after the last committed transaction were not applied
+                for i, image, result in items[len(outcomes):]:
+                    statuses[i].error = error.value
+                    statuses[i].error_code = error.code
+
+            # Effects of the committed results, also when a later transaction of the meter failed
+            for (i, image, result), (outcome, duplicate) in zip(items, outcomes):
+                statuses[i].outcome = outcome
+                statuses[i].duplicate = duplicate
+                statuses[i].ok = True
+                delete_task, queue, _ = result_effects(outcome, result)
+                if delete_task:
+                    # OCR-Worker done with task, delete it from the image-processing-queue
+                    finished_tasks[result.task_name] = True
+                if queue:
+                    # Create task for OCR engineering (negative consumption or help to recognize numbers). Tasks
+                    # are named, so it is repeated for a duplicate: the previous submission may have failed
+                    # before adding it
+                    new_tasks[queue]['Process--{0}'.format(image)] = (account_number, image)
+
+        try:
+            Reading.delete_image_processing_tasks('image-processing-queue', finished_tasks.keys())
+            for queue, tasks in new_tasks.items():
+                Reading.set_image_processing_tasks(queue, tasks.values())
+        except errors.PlatformError as e:
+            resp.ok = False
+            resp.error = e.value
+            resp.error_code = e.code
+            return resp
+        resp.ok = True
         return resp
 
     @endpoints.method(messages.GetReadings,
@@ -382,25 +543,58 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='reading.get',
                       path='reading/get')
+    @instrumentation.instrumented
     def get_readings(self, request):
         """
-        Gets all readings that match the criteria.
+        Gets one page of the readings that match the criteria, newest first. Pass next_cursor of the
+        response as cursor to get the next page.
         """
         logging.debug("[FrontEnd - get_readings()] - Account Number = {0}".format(request.account_number))
+        logging.debug("[FrontEnd - get_readings()] - Dates = {0} - {1}".format(request.start_date, request.end_date))
+        logging.debug("[FrontEnd - get_readings()] - Page Size = {0}".format(request.page_size))
         resp = messages.GetReadingsResponse()
         try:
-            readings = Reading.get_all_from_datastore(request.account_number)
-        except GetReadingError as e:
+            readings, resp.next_cursor, resp.more = Reading.get_page_from_datastore(request.account_number,
+                                                                                    start_date=request.start_date,
+                                                                                    end_date=request.end_date,
+                                                                                    page_size=request.page_size,
+                                                                                    cursor=request.cursor)
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
-            for read in readings:
-                r = messages.Reading()
-                r.urlsafe_key = read.key.urlsafe()
-                r.creation_date = read.date
-                r.account_number = read.meter.get().account_number
-                r.measure = read.measure
-                resp.readings.append(r)
+            resp.readings = serializers.readings(readings, request.account_number)
+            resp.ok = True
+        return resp
+
+    @endpoints.method(messages.GetConsumptionSummary,
+                      messages.GetConsumptionSummaryResponse,
+                      http_method='POST',
+                      name='reading.consumption_summary',
+                      path='reading/consumption_summary')
+    @instrumentation.instrumented
+    def get_consumption_summary(self, request):
+        """
+        Gets the daily or monthly consumption of a meter from its rollups, one keyed batch get per request
+        """
+        logging.debug("[FrontEnd - get_consumption_summary()] - Account Number = {0}".format(request.account_number))
+        logging.debug("[FrontEnd - get_consumption_summary()] - Granularity = {0} Dates = {1} - {2}"
+                      .format(request.granularity, request.start_date, request.end_date))
+        resp = messages.GetConsumptionSummaryResponse()
+        try:
+            meter = Meter.get_from_datastore(request.account_number)
+            periods = consumption.summary(meter.key, request.granularity,
+                                          start_date=request.start_date,
+                                          end_date=request.end_date)
+        except errors.PlatformError as e:
+            resp.ok = False
+            resp.error = e.value
+            resp.error_code = e.code
+        else:
+            resp.periods = [messages.ConsumptionPeriod(period_start=start, consumption=m3, readings=readings)
+                            for start, m3, readings in periods]
+            resp.total = sum(m3 for start, m3, readings in periods)
             resp.ok = True
         return resp
 
@@ -412,6 +606,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='bill.new',
                       path='bill/new')
+    @instrumentation.instrumented
     def new_bill(self, request):
         """
         Generates a new bill in the platform
@@ -419,12 +614,19 @@ class OCRBackendApi(remote.Service):
         logging.debug("[FrontEnd - new_bill()] - Account Number = {0}".format(request.account_number))
         resp = messages.NewBillResponse()
         try:
-            Bill.save_to_datastore(request.account_number)
-        except BillCreationError as e:
+            bill = Bill.save_to_datastore(request.account_number)
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
-            resp.ok = True
+            if bill is None:
+                # Not a failure, the meter owes nothing
+                resp.ok = False
+                resp.error = 'Nothing to Bill! Current Balance <= 0'
+                resp.error_code = errors.NOTHING_TO_BILL
+            else:
+                resp.ok = True
         return resp
 
     @endpoints.method(messages.GetBills,
@@ -432,28 +634,27 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='bill.get',
                       path='bill/get')
+    @instrumentation.instrumented
     def get_bills(self, request):
         """
-        Gets all bills that match the criteria.
+        Gets one page of the bills that match the criteria, newest first. Pass next_cursor of the
+        response as cursor to get the next page.
         """
         logging.debug("[FrontEnd - get_bills()] - Account Number = {0}".format(request.account_number))
         logging.debug("[FrontEnd - get_bills()] - Status = {0}".format(request.status))
+        logging.debug("[FrontEnd - get_bills()] - Page Size = {0}".format(request.page_size))
         resp = messages.GetBillsResponse()
         try:
-            bills = Bill.get_all_from_datastore(request.account_number, request.status)
-        except GetBillError as e:
+            bills, resp.next_cursor, resp.more = Bill.get_page_from_datastore(request.account_number,
+                                                                              status=request.status,
+                                                                              page_size=request.page_size,
+                                                                              cursor=request.cursor)
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
-            for b in bills:
-                r = messages.Bill()
-                r.urlsafe_key = b.key.urlsafe()
-                r.creation_date = b.date
-                r.account_number = b.meter.get().account_number
-                r.balance = b.balance
-                r.amount = b.amount
-                r.status = b.status
-                resp.bills.append(r)
+            resp.bills = serializers.bills(bills, request.account_number)
             resp.ok = True
         return resp
 
@@ -462,6 +663,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='bill.pay',
                       path='bill/pay')
+    @instrumentation.instrumented
     def pay_bill(self, request):
         """
         Marks a bill as payed in the platform
@@ -471,15 +673,10 @@ class OCRBackendApi(remote.Service):
         try:
             bill_key = ndb.Key(urlsafe=request.bill_key)
             Bill.pay(bill_key)
-        except GetBillError as e:
-            resp.ok = False
-            resp.error = e.value
-        except GetMeterError as e:
-            resp.ok = False
-            resp.error = e.value
-        except BillPaymentError as e:
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
             resp.ok = True
         return resp
@@ -492,6 +689,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='prepay.new',
                       path='prepay/new')
+    @instrumentation.instrumented
     def new_prepay(self, request):
         """
         Generates a new prepay event in the platform
@@ -500,9 +698,10 @@ class OCRBackendApi(remote.Service):
         resp = messages.NewPrepayResponse()
         try:
             Prepay.save_to_datastore(request.account_number, request.m3_to_prepay)
-        except PrepayCreationError as e:
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
             resp.ok = True
         return resp
@@ -512,6 +711,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='prepay.factor',
                       path='prepay/factor')
+    @instrumentation.instrumented
     def get_prepay_factor(self, request):
         """
         Gets the factor of a prepay taking into account the amount of m3 to prepay
@@ -521,9 +721,10 @@ class OCRBackendApi(remote.Service):
         try:
             resp.factor = jmas_api.get_prepay_conversion_factor()
             logging.debug("[FrontEnd - get_prepay_factor()] - factor = {0}".format(resp.factor))
-        except Exception as e:
+        except errors.PlatformError as e:
             resp.ok = False
-            resp.error = e.__str__()
+            resp.error = e.value
+            resp.error_code = e.code
         else:
             resp.ok = True
         return resp
@@ -533,6 +734,7 @@ class OCRBackendApi(remote.Service):
                       http_method='POST',
                       name='prepay.get',
                       path='prepay/get')
+    @instrumentation.instrumented
     def get_prepays(self, request):
         """
         Gets all prepays events
@@ -541,20 +743,15 @@ class OCRBackendApi(remote.Service):
         resp = messages.GetPrepaysResponse()
         try:
             prepays = Prepay.get_all_from_datastore(request.account_number)
-        except GetPrepayError as e:
+        except errors.PlatformError as e:
             resp.ok = False
             resp.error = e.value
+            resp.error_code = e.code
         else:
-            for p in prepays:
-                r = messages.Prepay()
-                r.urlsafe_key = p.key.urlsafe()
-                r.creation_date = p.created
-                r.account_number = p.meter.get().account_number
-                r.balance = p.balance
-                r.prepay = p.prepay
-                r.amount = p.amount
-                resp.prepays.append(r)
+            resp.prepays = serializers.prepays(prepays, request.account_number)
             resp.ok = True
         return resp
 
-app = endpoints.api_server([OCRBackendApi])
\ No newline at end of file
+# The request scope of the entity caches lives as long as one endpoint call
+app = cache.request_scoped(endpoints.api_server([OCRBackendApi]))
+instrumentation.install()
\ No newline at end of file
@@ -0,0 +1,370 @@
+"""
+Reproducible benchmark of the OCR backend. Runs OCRBackendApi methods in-process against the App Engine testbed
+stubs (datastore, memcache, taskqueue) with a fake Parse server and, optionally, a fake JMAS server. Task queue
+work (onboarding, billing, push dispatch) is executed by draining the queue stubs.
+
+Each scenario reports throughput, p50/p99 latency and RPCs per operation, and the results are written to a JSON
+file so runs of different versions can be compared.
+
+    python benchmark.py --sdk [path to google_appengine] [--meters 50] [--readings 5] [--output benchmark.json]
+
+LocalStack is also the base of the load generator (see loadgen.py).
+"""
+__author__ = 'Cesar'
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+
+SCENARIOS = ['user_create', 'meter_onboarding', 'reading_ingestion', 'bill_listing', 'billing_run']
+# Scenarios run in order and build on each other: readings need onboarded meters, notifications need users
+
+
+def setup_sdk(sdk_path):
+    """
+    Puts the App Engine SDK and its bundled libraries on sys.path
+        :param sdk_path: (String) path to google_appengine, None to use the APPENGINE_SDK env variable
+    """
+    sdk_path = sdk_path or os.environ.get('APPENGINE_SDK')
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class RpcCounter(object):
+    """
+    Counts every RPC made through the apiproxy, by service and method.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def hook(self, service, call, request, response):
+        self.counts['{0}.{1}'.format(service, call)] += 1
+
+    def snapshot(self):
+        return collections.Counter(self.counts)
+
+
+class OperationStats(object):
+    """
+    Latencies and RPCs of the operations of a scenario.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.rpcs = collections.Counter()
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def report(self):
+        ops = len(self.latencies)
+        latencies = sorted(self.latencies)
+        return {'operations': ops,
+                'errors': self.errors,
+                'seconds': self.elapsed,
+                'throughput_ops_per_sec': ops / self.elapsed if self.elapsed else None,
+                'p50_ms': latencies[ops / 2] if ops else None,
+                'p99_ms': latencies[min(ops - 1, int(ops * 0.99))] if ops else None,
+                'rpcs_per_op': dict((rpc, float(n) / ops) for rpc, n in sorted(self.rpcs.items())) if ops else {}}
+
+
+class LocalStack(object):
+    """
+    The backend running in-process on testbed stubs, with fake Parse (and optionally fake JMAS) servers.
+
+        - fake_jmas: True to serve JMAS from fake_jmas.py over HTTP, False to use the in-process fake values.
+        - seed: seed of the random generators, runs with the same seed do the same operations.
+    """
+
+    def __init__(self, fake_jmas=False, seed=0):
+        # Imported here, the SDK must be on sys.path first (see setup_sdk)
+        from google.appengine.ext import testbed
+        from google.appengine.datastore import datastore_stub_util
+
+        random.seed(seed)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='ocr-backend', overwrite=True)
+        # Every write is applied at once, so queries see it like the same request would
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+        from google.appengine.api import apiproxy_stub_map
+        self.rpc_counter = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark', self.rpc_counter.hook)
+
+        import fake_parse
+        import parse_api
+        self.parse_server = fake_parse.FakeParseServer().start()
+        parse_api.REST_API_URL = 'http://localhost'
+        parse_api.REST_API_Port = str(self.parse_server.port)
+
+        import jmas_api
+        self.jmas_server = None
+        if fake_jmas:
+            import fake_jmas as fake_jmas_module
+            self.jmas_server = fake_jmas_module.FakeJmasServer().start()
+        jmas_api.client.base_url = self.jmas_server.url if self.jmas_server else None
+        jmas_api.client.clear()
+
+        import api
+        import instrumentation
+        instrumentation.install()
+        # Calls are authenticated as an OCR-Worker account, as endpoints does for a request with a valid token
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = api.OCR_WORKER_EMAILS[0]
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = ''
+        self.api = api.OCRBackendApi()
+        self._requests = 0
+
+    def call(self, method, request):
+        """
+        Runs an endpoint method as its own request
+            :param method: (String) name of the OCRBackendApi method
+            :param request: ProtoRPC request message
+            :return: response message
+        """
+        return self.request(getattr(self.api, method), request)
+
+    def setup(self, method, request):
+        """
+        Runs an endpoint method that later operations depend on (see call).
+            :exception SetupError if the response has ok = False
+        """
+        resp = self.call(method, request)
+        if not resp.ok:
+            raise SetupError('{0} failed: {1} ({2})'.format(method, resp.error, resp.error_code))
+        return resp
+
+    def request(self, func, *args, **kwargs):
+        """
+        Runs a function as its own request: new request id and a clean request scope and ndb context cache.
+        """
+        import cache
+        from google.appengine.ext import ndb
+        self._requests += 1
+        os.environ['REQUEST_LOG_ID'] = 'benchmark-{0}'.format(self._requests)
+        cache.request.clear()
+        ndb.get_context().clear_cache()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            cache.request.clear()
+
+    def backlog(self, queue_names=None):
+        """
+        :return: dict {queue_name: tasks waiting}
+        """
+        names = [q['name'] for q in self.taskqueue_stub.GetQueues()
+                 if queue_names is None or q['name'] in queue_names]
+        return dict((name, len(self.taskqueue_stub.get_filtered_tasks(queue_names=[name]))) for name in names)
+
+    def drain(self, queue_names, stats=None, max_rounds=100):
+        """
+        Runs the push tasks of the given queues, including the tasks they enqueue, until the queues are empty.
+        Deferred tasks run through deferred.run, push dispatch tasks through notifications.dispatch.
+            :param stats: OperationStats that measures each task, optional
+            :return: number of tasks run
+        """
+        from google.appengine.ext import deferred
+        import notifications
+        ran = 0
+        for _ in xrange(max_rounds):
+            tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=queue_names)
+            if not tasks:
+                break
+            for task in tasks:
+                self.taskqueue_stub.DeleteTask(task.queue_name, task.name)
+                if task.url == notifications.DISPATCH_TASK_URL:
+                    func, args = notifications.dispatch, ()
+                else:
+                    func, args = deferred.run, (task.payload,)
+                if stats is not None:
+                    self.measure(stats, func, *args)
+                else:
+                    try:
+                        self.request(func, *args)
+                    except Exception:
+                        logging.exception('[Benchmark] - Task {0} of {1} failed'.format(task.name, task.queue_name))
+                ran += 1
+        return ran
+
+    def measure(self, stats, func, *args, **kwargs):
+        """
+        Runs func as a request and adds its latency and RPCs to stats. A response with ok = False or an
+        exception counts as an error.
+        """
+        before = self.rpc_counter.snapshot()
+        started = time.time()
+        try:
+            resp = self.request(func, *args, **kwargs)
+        except Exception:
+            logging.exception('[Benchmark] - Operation failed')
+            resp = None
+            stats.errors += 1
+        else:
+            if getattr(resp, 'ok', True) is False:
+                stats.errors += 1
+        stats.latencies.append((time.time() - started) * 1000)
+        after = self.rpc_counter.snapshot()
+        after.subtract(before)
+        stats.rpcs.update(dict((rpc, n) for rpc, n in after.items() if n))
+        return resp
+
+    def stop(self):
+        self.parse_server.shutdown()
+        if self.jmas_server:
+            self.jmas_server.shutdown()
+        self.testbed.deactivate()
+
+
+class SetupError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def account_number(i):
+    return '{0:010d}'.format(1000000 + i)
+
+
+def run_scenarios(stack, meters, readings_per_meter, scenarios=SCENARIOS):
+    """
+    Runs the scenarios in order over a fleet of meters, one user per meter.
+        :return: dict {scenario: OperationStats.report()}
+    """
+    import messages
+    import billing
+    import history
+    import notifications
+
+    accounts = [account_number(i) for i in xrange(meters)]
+    emails = ['user{0}@benchmark.test'.format(i) for i in xrange(meters)]
+    results = collections.OrderedDict()
+
+    def report(name, stats, required):
+        results[name] = stats.report()
+        logging.info('[Benchmark] - {0}: {1}'.format(name, json.dumps(results[name])))
+        if required and stats.errors:
+            # Later scenarios would measure a fleet that does not exist
+            raise SetupError('{0}: {1} of {2} operations failed'.format(name, stats.errors, len(stats.latencies)))
+
+    def timed(name, operations, required=False):
+        stats = OperationStats()
+        started = time.time()
+        for func, args in operations:
+            stack.measure(stats, func, *args)
+        stats.elapsed = time.time() - started
+        report(name, stats, required)
+
+    def timed_tasks(name, queue_names, required=False):
+        stats = OperationStats()
+        started = time.time()
+        stack.drain(queue_names, stats=stats)
+        stats.elapsed = time.time() - started
+        report(name, stats, required)
+
+    if 'user_create' in scenarios:
+        timed('user_create', [(stack.api.new_user, (messages.CreateUser(email=e, name='Benchmark', age=30,
+                                                                        account_type='G+',
+                                                                        installation_id='install-{0}'.format(i)),))
+                              for i, e in enumerate(emails)], required=True)
+
+    if 'meter_onboarding' in scenarios:
+        timed('meter_onboarding', [(stack.api.new_meter, (messages.CreateMeter(account_number=a),))
+                                   for a in accounts], required=True)
+        # Onboarding tasks (JMAS data and history import), one operation per task
+        timed_tasks('meter_onboarding_tasks', [history.HISTORY_QUEUE], required=True)
+        for a, e in zip(accounts, emails):
+            stack.setup('assign_meter_to_user', messages.AssignMeterToUser(account_number=a, email=e))
+
+    if 'reading_ingestion' in scenarios:
+        from meter import Meter
+        uploads = []
+        operations = []
+        for a in accounts:
+            measure = stack.request(Meter.get_from_datastore, a).last_measure or 0
+            for n in xrange(readings_per_meter):
+                image = '{0}-{1}.jpg'.format(a, n)
+                uploads.append((stack.api.new_image_for_processing,
+                                (messages.NewImageForProcessing(account_number=a, image_name=image),)))
+                measure += random.randint(0, 5)
+                operations.append((stack.api.set_image_processing_result,
+                                   (messages.ImageProcessingResult(task_name='Process--{0}'.format(image),
+                                                                   task_payload='{0}--{1}'.format(a, image),
+                                                                   result=measure,
+                                                                   error='',
+                                                                   human=False),)))
+        timed('image_upload', uploads)
+        timed('reading_ingestion', operations)
+        timed_tasks('push_dispatch', [notifications.DISPATCH_QUEUE])
+        results['push_dispatch']['delivered'] = len(stack.parse_server.received)
+
+    if 'bill_listing' in scenarios:
+        timed('bill_listing', [(stack.api.get_bills, (messages.GetBills(account_number=a),)) for a in accounts])
+
+    if 'billing_run' in scenarios:
+        stack.request(billing.start, 'benchmark')
+        # Walk and chunk tasks of the run, one operation per task
+        timed_tasks('billing_run', [billing.BILLING_QUEUE])
+        results['billing_run']['summary'] = stack.request(billing.summary, 'benchmark')
+
+    return results
+
+
+def version():
+    """
+    :return: (String) git description of the code being measured, None outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OCR backend benchmark on App Engine testbed stubs')
+    parser.add_argument('--sdk', help='path to google_appengine (default: APPENGINE_SDK env variable)')
+    parser.add_argument('--meters', type=int, default=50)
+    parser.add_argument('--readings', type=int, default=5, help='readings per meter')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--fake-jmas', action='store_true', help='serve JMAS over HTTP from fake_jmas.py')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    setup_sdk(args.sdk)
+    stack = LocalStack(fake_jmas=args.fake_jmas, seed=args.seed)
+    try:
+        results = run_scenarios(stack, args.meters, args.readings, args.scenarios)
+    finally:
+        stack.stop()
+
+    report = {'version': version(),
+              'date': datetime.datetime.now().isoformat(),
+              'parameters': {'meters': args.meters, 'readings': args.readings, 'fake_jmas': args.fake_jmas,
+                             'seed': args.seed},
+              'scenarios': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print 'Results written to {0}'.format(args.output)
+
+
+if __name__ == '__main__':
+    main()
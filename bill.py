@@ -7,8 +7,14 @@ import logging
 from google.appengine.ext import ndb
 from meter import Meter, GetMeterError
 import jmas_api
+import history
+import cache
+import paging
+import errors
 from datetime import datetime
 
+ALL_STATUSES = 'All'
+
 
 class Bill(ndb.Model):
     """
@@ -27,32 +33,56 @@ class Bill(ndb.Model):
     status = ndb.StringProperty(choices=['Paid', 'Unpaid'])
 
     @classmethod
-    def get_all_from_datastore(cls, account_number, status):
+    def get_page_from_datastore(cls, account_number, status=None, page_size=paging.DEFAULT_PAGE_SIZE, cursor=None):
         """
-        Gets all bills from datastore based on:
+        Gets one page of bills from datastore, newest first, based on:
         Args:
             account_number: (String)
-            status: (String) 'Paid' or 'Unpaid'
+            status: (String) 'Paid' or 'Unpaid', None or 'All' for every status
+            page_size: (Integer) bills per page, at most paging.MAX_PAGE_SIZE
+            cursor: (String) urlsafe cursor returned with the previous page, None for the first page
         Returns:
-            A List with all the bills that match the criteria
+            (bills, next_cursor, more): the List of bills of the page (empty if there are none), the urlsafe
+            cursor of the next page and True if there may be more pages
         """
         try:
             meter = Meter.get_from_datastore(account_number)
-            query_response = Bill.query(ndb.AND(Bill.meter == meter.key,
-                                                Bill.status == status)).fetch()
-            if query_response:
-                resp = []
-                for b in query_response:
-                    resp.append(b)
-            else:
-                raise GetBillError('No Bills found under specified criteria: Account Number: {0}, Status:{1}'
-                                   .format(account_number, status))
+            query = Bill.query(Bill.meter == meter.key)
+            if status and status != ALL_STATUSES:
+                query = query.filter(Bill.status == status)
+            # Served by the (meter, status, -date) and (meter, -date) indexes
+            query = query.order(-Bill.date)
+            # Keys only query, the entities then come from a batched get that can be served by the cache
+            keys, next_cursor, more = paging.fetch_page(query, page_size, cursor, GetBillError, keys_only=True)
+            bills = [b for b in ndb.get_multi(keys) if b is not None]
         except Exception as e:
-                raise GetBillError('Error getting Bill: '+e.__str__())
+            raise errors.wrap(GetBillError, 'Error getting Bill: ', e)
         else:
-            for r in resp:
-                logging.debug("[Bill] = {0}".format(r))
-            return resp
+            logging.debug("[Bill] - Page of {0} bills, more = {1}".format(len(bills), more))
+            return bills, next_cursor, more
+
+    @classmethod
+    def build_change(cls, meter, factor, key=None, date=None):
+        """
+        Builds the bill of the current balance of a meter, as a balance change (see Meter.mutate_balance).
+        Once billed the m3 are removed from the meter balance. Shared by single bills and billing runs.
+        Args:
+            meter: (Meter) read inside the transaction
+            factor: (Float) postpay conversion factor (from JMAS)
+            key: (ndb Key) of the bill, optional
+            date: (Datetime) of the bill, now by default
+        Returns:
+            (delta, [bill]), None if there is nothing to bill (balance <= 0)
+        """
+        if meter.balance <= 0:
+            return None
+        b = Bill(key=key,
+                 date=date or datetime.now(),
+                 meter=meter.key,
+                 balance=meter.balance,
+                 amount=meter.balance*factor,
+                 status='Unpaid')
+        return -b.balance, [b]
 
     @classmethod
     def save_to_datastore(cls, meter):
@@ -65,60 +95,52 @@ class Bill(ndb.Model):
             meter: (String) account_number from request
 
         :return
-            True if creation successful, exception otherwise
+            The Bill created, None if there is nothing to bill (balance <= 0), exception otherwise
 
         """
         try:
-            m = Meter.get_from_datastore(meter)
-            if m.balance > 0:
-                factor = jmas_api.get_postpay_conversion_factor()
-                calculated_amount = m.balance*factor
-                b = Bill(date=datetime.now(),
-                         meter=m.key,
-                         balance=m.balance,
-                         amount=calculated_amount,
-                         status='Unpaid')
-                key = b.put()
-            else:
-                raise BillCreationError('Nothing to Bill! Current Balance: {0} <= 0 '.format(m.balance))
+            factor = jmas_api.get_postpay_conversion_factor()
+            result = Meter.mutate_balance(meter, lambda m: Bill.build_change(m, factor))
         except Exception as e:
-            logging.exception("[Bill] - "+e.message)
-            raise BillCreationError('Error creating the bill in datastore: '+e.__str__())
+            raise errors.wrap(BillCreationError, 'Error creating the bill in datastore: ', e)
         else:
-            logging.debug('[Bill] - Bill with Key = {0} - Amount: {1} = (Balance = {2}) + (Factor = {3})'
-                          .format(key, calculated_amount, m.balance, factor))
-            # Update balance in datastore
-            current_balance = Meter.get_balance(m.account_number)
-            new_balance = current_balance - b.balance
-            # FIXME handle exception from Meter class
-            Meter.set_balance(m.account_number, new_balance)
+            if result is None:
+                logging.debug('[Bill] - Nothing to Bill for meter {0}'.format(meter))
+                return None
+            m, (b,) = result
+            logging.debug('[Bill] - Bill with Key = {0} - Amount: {1} = (Balance = {2}) * (Factor = {3})'
+                          .format(b.key, b.amount, b.balance, factor))
             logging.debug('[Bill] - New Balance: {0} = (Old Balance = {1}) - (Billed Balance = {2})'
-                          .format(new_balance, current_balance, b.balance))
-            return True
+                          .format(m.balance, m.balance + b.balance, b.balance))
+            return b
 
     @classmethod
-    def save_history_to_datastore(cls, meter_key, bills):
+    def save_history_to_datastore(cls, meter_key, bills, chunk_size=history.HISTORY_CHUNK_SIZE, on_progress=None):
         """
-        Saves historic Bills as a new entities on the datastore.
+        Saves historic Bills as a new entities on the datastore, chunk_size entities per put_multi_async call.
+        Bills are keyed by meter and date so importing the same history twice does not duplicate them.
         :param
-            account_number: (String) account_number
+            meter_key: (ndb Key) meter
             bills: (Dictionary) from jmas_api
+            chunk_size: (Integer) entities per put_multi_async call
+            on_progress: function(count) called after each chunk is stored
 
         :return
             True if creation successful, exception otherwise
 
         """
         try:
-            for bill in bills:
-                b = Bill(date=bill,
-                         meter=meter_key,
-                         balance=int(bills[bill]/jmas_api.get_postpay_conversion_factor()),
-                         amount=bills[bill],
-                         status='Paid')
-                key = b.put()
+            factor = jmas_api.get_postpay_conversion_factor()
+            entities = [Bill(id='{0}-{1:%Y%m%d%H%M%S%f}'.format(meter_key.id(), bill),
+                             date=bill,
+                             meter=meter_key,
+                             balance=int(bills[bill]/factor),
+                             amount=bills[bill],
+                             status='Paid')
+                        for bill in bills]
+            history.put_in_chunks(entities, chunk_size, on_progress)
         except Exception as e:
-            logging.exception("[Bill] - "+e.message)
-            raise BillCreationError('Error creating bill in datastore: '+e.__str__())
+            raise errors.wrap(BillCreationError, 'Error creating bill in datastore: ', e)
         else:
             logging.debug('[Bill] - Historical Bills successfully stored')
             return True
@@ -136,46 +158,27 @@ class Bill(ndb.Model):
         """
         try:
             bill = bill_key.get()
-            m = bill.meter.get()
-            if m:
-                if bill:
-                    if bill.status == 'Unpaid':
-                        bill.status = 'Paid'
-                        bill.put()
-                    else:
-                        raise BillPaymentError('Error paying Bill, Bill already payed')
-                else:
-                    raise GetBillError('Error getting Bill from datastore, Bill not found')
-            else:
-                raise GetMeterError('Error getting Meter from datastore, Meter not found')
+            if bill is None:
+                raise GetBillError('Error getting Bill from datastore, Bill not found', errors.NOT_FOUND)
+            if cache.meters.get(bill.meter) is None:
+                raise GetMeterError('Error getting Meter from datastore, Meter not found', errors.NOT_FOUND)
+            if bill.status != 'Unpaid':
+                raise BillPaymentError('Error paying Bill, Bill already payed', errors.ALREADY_PAID)
+            bill.status = 'Paid'
+            bill.put()
         except Exception as e:
-            raise GetBillError('Error marking the bill as payed in datastore: '+e.__str__())
+            raise errors.wrap(GetBillError, 'Error marking the bill as payed in datastore: ', e)
         else:
             return True
 
 
-class BillCreationError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Bill] - Creation Error: '+value, exc_info=True)
-
-    def __str__(self):
-        return repr(self.value)
-
-
-class GetBillError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Bill] - Get Error: '+value, exc_info=True)
+class BillCreationError(errors.PlatformError):
+    pass
 
-    def __str__(self):
-        return repr(self.value)
 
+class GetBillError(errors.PlatformError):
+    pass
 
-class BillPaymentError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Bill] - Payment Error: '+value, exc_info=True)
 
-    def __str__(self):
-        return repr(self.value)
+class BillPaymentError(errors.PlatformError):
+    pass
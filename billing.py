@@ -0,0 +1,269 @@
+"""
+Bulk billing run. Walks every meter with a positive balance with a keys-only query cursor and fans the meters
+out to chunk tasks in the billing queue. Each chunk bills its meters in XG transactions with one get_multi and
+one put_multi. The walk checkpoints each page (its meters, then its cursor) in the BillingRun entity and bills
+are keyed by run and meter, so a run can be resumed (or a task retried) without billing a meter twice or
+skipping one. Walk tasks are named after run and page and advance the checkpoint in a transaction that checks
+the page, so a run resumed while its walk is still chaining keeps a single chain.
+"""
+__author__ = 'Cesar'
+
+import logging
+from datetime import datetime
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from meter import Meter
+from bill import Bill
+import jmas_api
+
+BILLING_QUEUE = 'billing'
+# Meter keys read by each step of the walk
+WALK_PAGE_SIZE = 1000
+# Meters billed by each chunk task
+CHUNK_SIZE = 120
+# Meters per transaction: every meter and its new bill are two entity groups, XG allows 25
+METERS_PER_TRANSACTION = 12
+
+
+class BillingRun(ndb.Model):
+    """
+    A billing run over all meters. Keyed by the run id (by default the billing month, YYYY-MM).
+
+        - status: Running until every chunk is done.
+        - cursor: urlsafe cursor of the next page of meters to walk.
+        - pages: pages of meters walked so far.
+        - chunks: chunk tasks enqueued so far.
+        - walked: True once the last page of meters has been walked.
+        - page_accounts, page_cursor, page_more: page being walked, stored before its chunks are enqueued.
+          Billed meters leave the query, so a walk retried from the same cursor would read other meters.
+    """
+    status = ndb.StringProperty(choices=['Running', 'Done'], default='Running')
+    cursor = ndb.StringProperty(indexed=False)
+    pages = ndb.IntegerProperty(default=0)
+    chunks = ndb.IntegerProperty(default=0)
+    walked = ndb.BooleanProperty(default=False)
+    page_accounts = ndb.StringProperty(repeated=True, indexed=False)
+    page_cursor = ndb.StringProperty(indexed=False)
+    page_more = ndb.BooleanProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty()
+
+
+class BillingChunk(ndb.Model):
+    """
+    Result of a chunk task. Child of its BillingRun, keyed by page and chunk number.
+
+        - billed: meters billed.
+        - amount: total amount billed.
+        - skipped: meters whose balance was no longer positive.
+        - missing: meters that no longer exist.
+    """
+    billed = ndb.IntegerProperty(default=0)
+    amount = ndb.FloatProperty(default=0.0)
+    skipped = ndb.IntegerProperty(default=0)
+    missing = ndb.IntegerProperty(default=0)
+
+
+def current_run_id():
+    """
+    :return: (String) id of the run of the current month
+    """
+    return datetime.now().strftime('%Y-%m')
+
+
+def start(run_id=None):
+    """
+    Starts a billing run, or resumes it from its last checkpoint if it already exists.
+        :param run_id: (String) id of the run, current_run_id() by default
+        :return: BillingRun
+    """
+    run_id = run_id or current_run_id()
+    run = BillingRun.get_or_insert(run_id)
+    if not run.walked:
+        _defer_walk(run_id, run.pages)
+    logging.info('[Billing] - Run {0} started, resuming at page {1}'.format(run_id, run.pages))
+    return run
+
+
+def walk(run_id, page=None):
+    """
+    Walks one page of meters with positive balance: checkpoints its meters, enqueues its chunk tasks,
+    checkpoints the cursor and chains the next page. A retried walk enqueues the checkpointed page again, a walk of
+    a page another walk already advanced past does nothing.
+        :param run_id: (String)
+        :param page: (Integer) page to walk, the checkpointed page by default
+    """
+    run = BillingRun.get_by_id(run_id)
+    if run is None or run.walked:
+        return
+    if page is None:
+        page = run.pages
+    if run.pages != page:
+        logging.info('[Billing] - Run {0}: page {1} already walked'.format(run_id, page))
+        return
+
+    if run.page_more is None:
+        start_cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+        keys, next_cursor, more = Meter.query(Meter.balance > 0).fetch_page(WALK_PAGE_SIZE,
+                                                                            start_cursor=start_cursor,
+                                                                            keys_only=True)
+        run = _checkpoint_page(run_id, page, [k.id() for k in keys],
+                               next_cursor.urlsafe() if next_cursor else None, more)
+        if run is None:
+            return
+    account_numbers = run.page_accounts
+    chunks = [account_numbers[i:i+CHUNK_SIZE] for i in xrange(0, len(account_numbers), CHUNK_SIZE)]
+    for n, chunk in enumerate(chunks):
+        try:
+            # Named after run, page and chunk of the checkpointed page, a walk retried after a failure does not
+            # enqueue it twice
+            deferred.defer(bill_chunk, run_id, '{0}-{1}'.format(page, n), chunk,
+                           _name='billing-{0}-{1}-{2}'.format(run_id, page, n), _queue=BILLING_QUEUE)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    run = _advance(run_id, page, len(chunks))
+    if run is None:
+        return
+    logging.info('[Billing] - Run {0}: page {1} walked, {2} meters in {3} chunks'
+                 .format(run_id, run.pages, len(account_numbers), len(chunks)))
+    if not run.walked:
+        _defer_walk(run_id, run.pages)
+
+
+def _defer_walk(run_id, page):
+    """
+    Enqueues the walk of a page. Named after run and page, so starting a run whose walk is already queued, or a
+    walk retried after chaining the next page, does not start a second chain.
+        :param run_id: (String)
+        :param page: (Integer)
+    """
+    try:
+        deferred.defer(walk, run_id, page, _name='billing-walk-{0}-{1}'.format(run_id, page),
+                       _queue=BILLING_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional
+def _checkpoint_page(run_id, page, account_numbers, cursor, more):
+    """
+    Stores the page being walked, unless another walk already stored it or moved past it.
+        :return: BillingRun, None if the page was already walked
+    """
+    run = BillingRun.get_by_id(run_id)
+    if run.pages != page:
+        return None
+    if run.page_more is None:
+        run.page_accounts = account_numbers
+        run.page_cursor = cursor
+        run.page_more = more
+        run.put()
+    return run
+
+
+@ndb.transactional
+def _advance(run_id, page, chunks):
+    """
+    Moves the checkpoint past a walked page, unless another walk already did.
+        :return: BillingRun, None if the page was already walked
+    """
+    run = BillingRun.get_by_id(run_id)
+    if run.pages != page:
+        return None
+    run.cursor = run.page_cursor
+    run.pages += 1
+    run.chunks += chunks
+    run.walked = not run.page_more
+    run.page_accounts = []
+    run.page_cursor = None
+    run.page_more = None
+    run.put()
+    return run
+
+
+def bill_chunk(run_id, chunk_id, account_numbers):
+    """
+    Bills a chunk of meters and stores the result of the chunk.
+        :param run_id: (String)
+        :param chunk_id: (String) page and chunk number
+        :param account_numbers: (List) of Strings
+    """
+    factor = jmas_api.get_postpay_conversion_factor()
+    result = BillingChunk(parent=ndb.Key(BillingRun, run_id), id=chunk_id)
+    for i in xrange(0, len(account_numbers), METERS_PER_TRANSACTION):
+        group = account_numbers[i:i+METERS_PER_TRANSACTION]
+        billed, amount, skipped, missing = _bill_meters(run_id, group, factor)
+        result.billed += billed
+        result.amount += amount
+        result.skipped += skipped
+        result.missing += missing
+        for account_number in group:
+            Meter.invalidate(account_number)
+    result.put()
+    logging.debug('[Billing] - Run {0} chunk {1}: billed = {2} amount = {3} skipped = {4} missing = {5}'
+                  .format(run_id, chunk_id, result.billed, result.amount, result.skipped, result.missing))
+
+
+@ndb.transactional(xg=True, retries=5)
+def _bill_meters(run_id, account_numbers, factor):
+    """
+    Bills up to METERS_PER_TRANSACTION meters in one transaction. A meter that already has the bill of this run
+    is counted as billed again without changes, so retries are idempotent.
+        :return: (billed, amount, skipped, missing)
+    """
+    meter_keys = [Meter.get_key(a) for a in account_numbers]
+    bill_keys = [ndb.Key(Bill, '{0}-{1}'.format(run_id, a)) for a in account_numbers]
+    entities = ndb.get_multi(meter_keys + bill_keys)
+    meters, existing_bills = entities[:len(meter_keys)], entities[len(meter_keys):]
+
+    billed, amount, skipped, missing = 0, 0.0, 0, 0
+    to_put = []
+    now = datetime.now()
+    for meter, bill_key, existing in zip(meters, bill_keys, existing_bills):
+        if existing is not None:
+            billed += 1
+            amount += existing.amount
+        elif meter is None:
+            missing += 1
+        else:
+            change = Bill.build_change(meter, factor, key=bill_key, date=now)
+            if change is None:
+                skipped += 1
+                continue
+            delta, (b,) = change
+            meter.balance += delta
+            to_put.extend([meter, b])
+            billed += 1
+            amount += b.amount
+    ndb.put_multi(to_put)
+    return billed, amount, skipped, missing
+
+
+def summary(run_id):
+    """
+    Aggregates the results of the chunks of a run, marks the run as Done once every chunk has finished.
+        :param run_id: (String)
+        :return: dict with the run summary, None if the run does not exist
+    """
+    run = BillingRun.get_by_id(run_id)
+    if run is None:
+        return None
+    results = BillingChunk.query(ancestor=run.key).fetch()
+    if run.status == 'Running' and run.walked and len(results) >= run.chunks:
+        run.status = 'Done'
+        run.finished = datetime.now()
+        run.put()
+    return {'run_id': run_id,
+            'status': run.status,
+            'started': run.started.isoformat(),
+            'finished': run.finished.isoformat() if run.finished else None,
+            'pages': run.pages,
+            'chunks': run.chunks,
+            'chunks_done': len(results),
+            'billed': sum(r.billed for r in results),
+            'amount': sum(r.amount for r in results),
+            'skipped': sum(r.skipped for r in results),
+            'missing': sum(r.missing for r in results)}
@@ -0,0 +1,217 @@
+"""
+Two tier read-through cache for datastore entities: a bounded in-process LRU with a short TTL in front of
+memcache. Entities are stored as encoded protocol buffers so every caller gets its own copy.
+
+Writers must call invalidate() after a successful put, the cache never learns about writes by itself.
+
+In front of both tiers, RequestScope memoises the entities (and other lookups) already loaded by the current
+request, so the same meter is read once per request however many classmethods ask for it.
+"""
+__author__ = 'Cesar'
+
+import collections
+import logging
+import os
+import threading
+import time
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+# Entries in the process LRU are not invalidated on other instances, keep their TTL short
+LOCAL_TTL_SECONDS = 30
+LOCAL_MAX_ENTRIES = 1000
+MEMCACHE_TTL_SECONDS = 600
+# After an invalidation memcache refuses fills of the key for this long, so a reader that loaded the entity
+# before the write cannot put the old value back
+INVALIDATION_LOCK_SECONDS = 10
+
+
+class RequestScope(object):
+    """
+    Identity map of the current request: values memoised for the lifetime of one request and only visible to
+    it. Entries are kept per thread and tagged with the request id, so a thread serving a new request never
+    sees the values of the previous one even if clear() was not called; request_scoped() clears them when the
+    request ends so they do not stay in memory.
+    Values are shared within the request, callers that modify an entity must read it with use_cache=False.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _entries(self):
+        request_id = os.environ.get('REQUEST_LOG_ID')
+        if getattr(self._local, 'request_id', None) != request_id or not hasattr(self._local, 'entries'):
+            self._local.request_id = request_id
+            self._local.entries = {}
+        return self._local.entries
+
+    def get(self, scope_key):
+        """
+        :param scope_key: hashable key of the value, (kind, id) by convention
+        :return: the memoised value or None
+        """
+        return self._entries().get(scope_key)
+
+    def set(self, scope_key, value):
+        self._entries()[scope_key] = value
+
+    def drop(self, scope_key):
+        self._entries().pop(scope_key, None)
+
+    def clear(self):
+        self._local.__dict__.clear()
+
+
+request = RequestScope()
+
+
+def request_scoped(app):
+    """
+    WSGI middleware that clears the request scope once the wrapped application has handled the request.
+        :param app: WSGI application
+        :return: WSGI application
+    """
+    def scoped_app(environ, start_response):
+        request.clear()
+        try:
+            return app(environ, start_response)
+        finally:
+            request.clear()
+    return scoped_app
+
+
+class EntityCache(object):
+    """
+    Read-through cache for the entities of one kind.
+
+        - namespace: memcache namespace and name used in the stats.
+        - max_entries: capacity of the process LRU, the least recently used entry is evicted first.
+        - ttl: seconds an entry lives in the process LRU.
+        - memcache_ttl: seconds an entry lives in memcache.
+    """
+
+    def __init__(self, namespace, max_entries=LOCAL_MAX_ENTRIES, ttl=LOCAL_TTL_SECONDS,
+                 memcache_ttl=MEMCACHE_TTL_SECONDS):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memcache_ttl = memcache_ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._adapter = ndb.ModelAdapter()
+        self._counters = dict.fromkeys(['request_hits', 'local_hits', 'memcache_hits', 'misses', 'evictions',
+                                         'invalidations'], 0)
+
+    def get(self, key):
+        """
+        Gets an entity by key, trying the request scope, the process LRU, then memcache, then the datastore.
+            :param key: ndb Key
+            :return: the entity or None if it does not exist
+        """
+        cache_key = key.urlsafe()
+        # Transactions read their own snapshot, they never share entities with the request scope
+        scoped = not ndb.in_transaction()
+        if scoped:
+            entity = request.get((self.namespace, cache_key))
+            if entity is not None:
+                self._count('request_hits')
+                return entity
+        entity = self._get(key, cache_key)
+        if scoped and entity is not None:
+            request.set((self.namespace, cache_key), entity)
+        return entity
+
+    def _get(self, key, cache_key):
+        value = self._get_local(cache_key)
+        if value is not None:
+            self._count('local_hits')
+            return self._decode(value)
+
+        value = memcache.get(cache_key, namespace=self.namespace)
+        if value is not None:
+            self._count('memcache_hits')
+            self._set_local(cache_key, value)
+            return self._decode(value)
+
+        self._count('misses')
+        entity = key.get()
+        if entity is not None:
+            value = self._encode(entity)
+            # add, not set: it fails if another reader filled the key or if the key was invalidated since (see
+            # invalidate), in which case the entity read may already be stale and is not cached at all
+            if memcache.add(cache_key, value, time=self.memcache_ttl, namespace=self.namespace):
+                self._set_local(cache_key, value)
+        return entity
+
+    def invalidate(self, key):
+        """
+        Drops an entity from both tiers. Call after every write of the entity.
+            :param key: ndb Key
+        """
+        cache_key = key.urlsafe()
+        request.drop((self.namespace, cache_key))
+        with self._lock:
+            self._entries.pop(cache_key, None)
+            self._counters['invalidations'] += 1
+        memcache.delete(cache_key, seconds=INVALIDATION_LOCK_SECONDS, namespace=self.namespace)
+
+    def clear(self):
+        """
+        Drops every entry of the process LRU (memcache entries expire on their own)
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dict with the counters of this cache and the current size of the process LRU
+        """
+        with self._lock:
+            s = dict(self._counters)
+            s['size'] = len(self._entries)
+        return s
+
+    def _get_local(self, cache_key):
+        with self._lock:
+            entry = self._entries.pop(cache_key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # Re-insert to mark as most recently used
+            self._entries[cache_key] = entry
+            return value
+
+    def _set_local(self, cache_key, value):
+        with self._lock:
+            self._entries.pop(cache_key, None)
+            self._entries[cache_key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _encode(self, entity):
+        return self._adapter.entity_to_pb(entity).Encode()
+
+    def _decode(self, value):
+        return self._adapter.pb_to_entity(entity_pb.EntityProto(value))
+
+
+meters = EntityCache('meter')
+users = EntityCache('user')
+
+
+def stats():
+    """
+    :return: dict with the stats of every entity cache
+    """
+    s = {'meter': meters.stats(),
+         'user': users.stats()}
+    logging.debug('[Cache] - stats = {0}'.format(s))
+    return s
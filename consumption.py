@@ -0,0 +1,227 @@
+"""
+Daily and monthly consumption rollups of each meter. Rollups are children of their Meter, so the transaction that
+stores a Reading (see Reading.save_task_results_to_datastore) also updates them without adding entity groups.
+A summary is served with a single get_multi of the keys of the requested periods.
+
+The history import adds its readings to the rollups once, in a transaction of the meter (see add_history).
+rebuild() recomputes the rollups of a meter from its raw readings, for the consumption_rollups migration.
+"""
+__author__ = 'Cesar'
+
+import logging
+from datetime import datetime, timedelta
+from google.appengine.ext import ndb
+import errors
+
+DAILY = 'Daily'
+MONTHLY = 'Monthly'
+# Periods served by a single summary request
+MAX_SUMMARY_PERIODS = 366
+DEFAULT_SUMMARY_PERIODS = {DAILY: 31, MONTHLY: 12}
+REBUILD_PAGE_SIZE = 500
+
+
+class DailyConsumption(ndb.Model):
+    """
+    Consumption of a meter in a day. Child of the Meter, keyed by the day (YYYYMMDD).
+
+        - consumption: m3 consumed, the consumption of a reading counts on the day of the reading.
+        - readings: readings stored that day.
+    """
+    consumption = ndb.IntegerProperty(default=0, indexed=False)
+    readings = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class MonthlyConsumption(ndb.Model):
+    """
+    Consumption of a meter in a month. Child of the Meter, keyed by the month (YYYYMM).
+
+        - consumption: m3 consumed, the consumption of a reading counts on the month of the reading.
+        - readings: readings stored that month.
+    """
+    consumption = ndb.IntegerProperty(default=0, indexed=False)
+    readings = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class HistoryRollups(ndb.Model):
+    """
+    Marks that the imported history of a meter was added to its rollups (see add_history). Child of the Meter,
+    keyed 'history'.
+    """
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+def period_start(granularity, date):
+    """
+    :param granularity: DAILY or MONTHLY
+    :param date: (Datetime)
+    :return: (Datetime) first instant of the period that contains the date
+    """
+    if granularity == DAILY:
+        return datetime(date.year, date.month, date.day)
+    return datetime(date.year, date.month, 1)
+
+
+def build_key(meter_key, granularity, date):
+    """
+    :param meter_key: ndb Key of the meter
+    :param granularity: DAILY or MONTHLY
+    :param date: (Datetime) any instant of the period
+    :return: ndb Key of the rollup of the period
+    """
+    if granularity == DAILY:
+        return ndb.Key(DailyConsumption, date.strftime('%Y%m%d'), parent=meter_key)
+    return ndb.Key(MonthlyConsumption, date.strftime('%Y%m'), parent=meter_key)
+
+
+def _model(granularity):
+    return DailyConsumption if granularity == DAILY else MonthlyConsumption
+
+
+def add(meter_key, consumptions):
+    """
+    Adds the consumption of new readings to the rollups of their day and month. Must run inside the transaction
+    that stores the readings; it reads the affected rollups and returns them without putting them.
+        :param meter_key: ndb Key of the meter
+        :param consumptions: (List) of (date, m3) tuples, one per reading
+        :return: List with the updated rollup entities
+    """
+    deltas = {}
+    for date, m3 in consumptions:
+        for granularity in (DAILY, MONTHLY):
+            key = build_key(meter_key, granularity, date)
+            consumption, readings = deltas.get(key, (granularity, 0, 0))[1:]
+            deltas[key] = (granularity, consumption + m3, readings + 1)
+    if not deltas:
+        return []
+    keys = deltas.keys()
+    rollups = []
+    for key, rollup in zip(keys, ndb.get_multi(keys)):
+        granularity, consumption, readings = deltas[key]
+        if rollup is None:
+            rollup = _model(granularity)(key=key)
+        rollup.consumption += consumption
+        rollup.readings += readings
+        rollups.append(rollup)
+    return rollups
+
+
+def add_history(meter_key, readings):
+    """
+    Adds the consumption of the imported history readings to the rollups of the meter, computed from the readings
+    themselves and not from an (eventually consistent) query. Must run inside a transaction of the meter; a
+    retried import finds the HistoryRollups marker and adds nothing. Rollups already updated by live readings
+    keep their values, history is added to them.
+        :param meter_key: ndb Key of the meter
+        :param readings: (List) of Reading, the whole imported history
+        :return: List with the updated rollups and the marker, without putting them. Empty if already added
+    """
+    marker_key = ndb.Key(HistoryRollups, 'history', parent=meter_key)
+    if marker_key.get() is not None:
+        return []
+    consumptions = []
+    previous = None
+    for r in sorted(readings, key=lambda r: r.date):
+        consumptions.append((r.date, r.measure - previous if previous is not None else 0))
+        previous = r.measure
+    return add(meter_key, consumptions) + [HistoryRollups(key=marker_key)]
+
+
+def _first_of_last(granularity, end_date, count):
+    """
+    :return: (Datetime) start of the first of the last count periods that end with the period of end_date
+    """
+    if granularity == DAILY:
+        return period_start(DAILY, end_date - timedelta(days=count - 1))
+    months = end_date.year * 12 + end_date.month - 1 - (count - 1)
+    return datetime(months / 12, months % 12 + 1, 1)
+
+
+def summary(meter_key, granularity, start_date=None, end_date=None):
+    """
+    Gets the rollups of the periods between two dates with a single get_multi.
+        :param meter_key: ndb Key of the meter
+        :param granularity: DAILY or MONTHLY
+        :param start_date: (Datetime) any instant of the first period, by default DEFAULT_SUMMARY_PERIODS
+                           periods before end_date
+        :param end_date: (Datetime) any instant of the last period, by default now
+        :return: List of (period_start, consumption, readings) tuples, oldest first, at most MAX_SUMMARY_PERIODS.
+                 Periods without readings are included with 0
+    """
+    if granularity not in (DAILY, MONTHLY):
+        raise ConsumptionError('Unknown granularity: {0}, expected {1} or {2}'.format(granularity, DAILY, MONTHLY),
+                               errors.INVALID_ARGUMENT)
+    end_date = end_date or datetime.now()
+    if start_date is None:
+        start_date = _first_of_last(granularity, end_date, DEFAULT_SUMMARY_PERIODS[granularity])
+    periods = []
+    period = period_start(granularity, start_date)
+    while period <= end_date and len(periods) < MAX_SUMMARY_PERIODS:
+        periods.append(period)
+        if granularity == DAILY:
+            period += timedelta(days=1)
+        else:
+            period = datetime(period.year + period.month / 12, period.month % 12 + 1, 1)
+    rollups = ndb.get_multi([build_key(meter_key, granularity, p) for p in periods])
+    return [(p, r.consumption if r else 0, r.readings if r else 0) for p, r in zip(periods, rollups)]
+
+
+def rebuild(account_number):
+    """
+    Recomputes the rollups of a meter from its readings and writes them over the stored ones. The consumption of
+    a reading is its measure minus the measure of the previous reading; the first reading counts 0.
+
+    The readings query is eventually consistent and runs outside a transaction, so the rollups are only written,
+    in a transaction, if the meter still has the last reading snapshot it had when the query started and the
+    query returned that last reading. Otherwise a reading was stored meanwhile, or is not visible yet, and the
+    rebuild raises so its task is retried. Rollups of periods without readings are left untouched.
+        :param account_number: (String)
+        :return: number of rollups stored
+    """
+    # Import in the function to avoid circular import
+    from meter import Meter
+    from reading import Reading
+
+    meter_key = Meter.get_key(account_number)
+    meter = meter_key.get()
+    if meter is None:
+        return 0
+    snapshot = (meter.last_reading_key, meter.last_reading_date)
+    query = Reading.query(Reading.meter == meter_key).order(Reading.date)
+    rollups = {}
+    seen_last = meter.last_reading_key is None
+    previous = None
+    cursor = None
+    more = True
+    while more:
+        readings, cursor, more = query.fetch_page(REBUILD_PAGE_SIZE, start_cursor=cursor)
+        for r in readings:
+            seen_last = seen_last or r.key == meter.last_reading_key
+            m3 = r.measure - previous if previous is not None else 0
+            previous = r.measure
+            for granularity in (DAILY, MONTHLY):
+                key = build_key(meter_key, granularity, r.date)
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollup = rollups[key] = _model(granularity)(key=key)
+                rollup.consumption += m3
+                rollup.readings += 1
+    if not seen_last:
+        raise ConsumptionError('Meter {0}: last reading not visible to the query yet'.format(account_number),
+                               errors.UNAVAILABLE)
+
+    @ndb.transactional()
+    def txn():
+        m = meter_key.get()
+        if (m.last_reading_key, m.last_reading_date) != snapshot:
+            raise ConsumptionError('Meter {0}: reading stored during the rebuild'.format(account_number),
+                                   errors.UNAVAILABLE)
+        ndb.put_multi(rollups.values())
+
+    txn()
+    logging.debug('[Consumption] - Meter {0}: {1} rollups rebuilt'.format(account_number, len(rollups)))
+    return len(rollups)
+
+
+class ConsumptionError(errors.PlatformError):
+    pass
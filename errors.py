@@ -0,0 +1,67 @@
+"""
+Error model of the OCR platform. Every error raised by the models is a PlatformError with a typed code, and the
+API returns the code in the error_code field of its responses, so clients branch on it instead of on messages.
+
+Errors with an expected code (a meter that does not exist, an email already in use) are the answer to an ordinary
+request: they travel up to the handler as they are and are never logged with a stack trace. Any other exception
+is an unexpected failure, logged with its stack trace once, where a model method first wraps it (see wrap).
+Outcomes that are not failures (an account without bills yet, nothing to bill, a negative consumption) are plain
+return values and not errors at all.
+"""
+__author__ = 'Cesar'
+
+import logging
+
+NOT_FOUND = 'NotFound'
+ALREADY_EXISTS = 'AlreadyExists'
+ALREADY_PAID = 'AlreadyPaid'
+NOTHING_TO_BILL = 'NothingToBill'
+POSITIVE_BALANCE = 'PositiveBalance'
+NO_PREVIOUS_READING = 'NoPreviousReading'
+INVALID_ARGUMENT = 'InvalidArgument'
+PERMISSION_DENIED = 'PermissionDenied'
+UNAVAILABLE = 'Unavailable'
+INTERNAL = 'Internal'
+
+EXPECTED_CODES = frozenset([NOT_FOUND, ALREADY_EXISTS, ALREADY_PAID, NOTHING_TO_BILL, POSITIVE_BALANCE,
+                            NO_PREVIOUS_READING, INVALID_ARGUMENT, PERMISSION_DENIED])
+
+
+class PlatformError(Exception):
+    """
+    Base of the errors of the platform.
+
+        - value: (String) reason of the error, returned to the client.
+        - code: one of the codes of this module, INTERNAL by default.
+    """
+
+    def __init__(self, value, code=INTERNAL):
+        self.value = value
+        self.code = code
+        self.logged = False
+
+    def __str__(self):
+        return repr(self.value)
+
+    @property
+    def expected(self):
+        return self.code in EXPECTED_CODES
+
+
+def wrap(error_class, message, e):
+    """
+    Converts an exception caught by a model method into the error to raise. Must be called in the except block.
+    An expected error is returned as it is, without logging. Anything else is wrapped in error_class, keeping
+    the code of a PlatformError and INTERNAL otherwise, and logged with its stack trace unless it already was.
+        :param error_class: PlatformError subclass of the caller
+        :param message: (String) prefix of the message of the new error
+        :param e: the exception caught
+        :return: the PlatformError to raise
+    """
+    if isinstance(e, PlatformError) and e.expected:
+        return e
+    error = error_class(message + e.__str__(), e.code if isinstance(e, PlatformError) else INTERNAL)
+    if not getattr(e, 'logged', False):
+        logging.exception('[{0}] - {1}'.format(error_class.__name__, error.value))
+    error.logged = True
+    return error
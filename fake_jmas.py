@@ -0,0 +1,89 @@
+"""
+Local stand-in for the JMAS api, for development and tests. Serves the same temporary fake values the client
+uses when JMAS_API_URL is not set. Point the backend to it with JMAS_API_URL=http://localhost:[port]
+
+    python fake_jmas.py [port] [failure_rate] [latency_seconds]
+"""
+__author__ = 'cesar'
+
+import BaseHTTPServer
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import jmas_api
+
+
+class FakeJmasHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles GET /tariffs and GET /accounts/[account_number]. Every request path is counted in server.requests.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        time.sleep(self.server.latency)
+        if random.random() < self.server.failure_rate:
+            self._reply(503, {'error': 'unavailable'})
+        elif self.path == '/tariffs':
+            self._reply(200, jmas_api.fake_tariffs())
+        elif self.path.startswith('/accounts/'):
+            self._reply(200, jmas_api.fake_account(self.path[len('/accounts/'):]))
+        else:
+            self._reply(404, {'error': 'unknown path {0}'.format(self.path)})
+
+    def _reply(self, status, data):
+        payload = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug('[FakeJmas] - ' + format % args)
+
+
+class FakeJmasServer(BaseHTTPServer.HTTPServer):
+    """
+    Single threaded HTTP server that serves the fake JMAS api.
+
+        - requests: path of every request received.
+        - failure_rate: fraction of requests answered with a 503, to exercise retries and the circuit breaker.
+        - latency: seconds added to every response.
+    """
+
+    def __init__(self, port=0, failure_rate=0.0, latency=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port), FakeJmasHandler)
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://localhost:{0}'.format(self.port)
+
+    def start(self):
+        """
+        Serves in a daemon thread and returns immediately
+        """
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    server = FakeJmasServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8090,
+                            failure_rate=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0,
+                            latency=float(sys.argv[3]) if len(sys.argv) > 3 else 0.0)
+    print 'Fake JMAS listening on {0}'.format(server.url)
+    server.serve_forever()
@@ -0,0 +1,87 @@
+"""
+Local stand-in for the Parse REST API, for development and tests. Accepts push requests, records them and
+answers like Parse does. Point the backend to it with the PARSE_API_URL and PARSE_API_PORT env variables.
+
+    python fake_parse.py [port] [failure_rate]
+"""
+__author__ = 'Cesar'
+
+import BaseHTTPServer
+import json
+import logging
+import random
+import sys
+import threading
+
+
+class FakeParseHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles POST /1/push and POST /1/batch. Every accepted push body is appended to server.received.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        if random.random() < self.server.failure_rate:
+            self._reply(500, {'code': 1, 'error': 'internal error'})
+            return
+        if self.path == '/1/push':
+            with self.server.lock:
+                self.server.received.append(json.loads(body))
+            self._reply(200, {'result': True})
+        elif self.path == '/1/batch':
+            requests = json.loads(body)['requests']
+            with self.server.lock:
+                self.server.received.extend(r['body'] for r in requests)
+                self.server.batches.append(len(requests))
+            self._reply(200, [{'success': {'result': True}} for r in requests])
+        else:
+            self._reply(404, {'code': 123, 'error': 'unknown path {0}'.format(self.path)})
+
+    def _reply(self, status, data):
+        payload = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug('[FakeParse] - ' + format % args)
+
+
+class FakeParseServer(BaseHTTPServer.HTTPServer):
+    """
+    Single threaded HTTP server that remembers the notifications it received.
+
+        - received: list with the JSON body of every accepted push.
+        - batches: size of every accepted batch request.
+        - failure_rate: fraction of requests answered with a 500, to exercise retries.
+    """
+
+    def __init__(self, port=0, failure_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port), FakeParseHandler)
+        self.failure_rate = failure_rate
+        self.received = []
+        self.batches = []
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Serves in a daemon thread and returns immediately
+        """
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    server = FakeParseServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8089,
+                             failure_rate=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
+    print 'Fake Parse listening on port {0}'.format(server.port)
+    server.serve_forever()
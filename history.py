@@ -0,0 +1,162 @@
+"""
+Onboarding of a meter: load of its JMAS account data and import of its JMAS history (bills and readings). Runs
+as a deferred task after the meter has been created, writes the history in chunks with put_multi_async, tracks
+its progress in a HistoryImport entity and leaves the meter Ready (or Failed) when it ends.
+"""
+__author__ = 'Cesar'
+
+import logging
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.api import taskqueue
+import jmas_api
+
+HISTORY_QUEUE = 'history-import'
+HISTORY_CHUNK_SIZE = 100
+# TODO: TEMP!! parameters of the fake JMAS history
+HISTORY_MONTHS = 6
+HISTORY_VALUE_TO_APPROXIMATE = 9321
+
+
+class HistoryImport(ndb.Model):
+    """
+    Progress of the history import of a meter. Keyed by the account number.
+
+        - status: Pending until the task starts, Done or Failed when it ends.
+        - total: number of entities (bills + readings) to import, known once the history is fetched.
+        - imported: number of entities already written.
+        - error: reason of the failure, if any.
+    """
+    status = ndb.StringProperty(choices=['Pending', 'Running', 'Done', 'Failed'], default='Pending')
+    total = ndb.IntegerProperty(default=0)
+    imported = ndb.IntegerProperty(default=0)
+    error = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def get_from_datastore(cls, account_number):
+        """
+        Gets the import progress of a meter
+            :param account_number: (String)
+            :return: HistoryImport or None if the meter never scheduled one
+        """
+        return cls.get_by_id(account_number)
+
+
+def schedule(account_number, chunk_size=HISTORY_CHUNK_SIZE):
+    """
+    Records a pending import and enqueues the task that performs it. When called inside a transaction the
+    task is only enqueued if the transaction commits.
+        :param account_number: (String) meter whose history will be imported
+        :param chunk_size: (Integer) entities per put_multi_async call
+        :return: key of the HistoryImport entity
+    """
+    key = HistoryImport(id=account_number).put()
+    deferred.defer(import_history, account_number, chunk_size=chunk_size,
+                   _queue=HISTORY_QUEUE, _transactional=ndb.in_transaction())
+    return key
+
+
+def schedule_batch(account_numbers, chunk_size=HISTORY_CHUNK_SIZE):
+    """
+    Enqueues one task that schedules the imports of many meters (see schedule_multi). When called inside a
+    transaction the task is only enqueued if the transaction commits, and it counts as a single transactional
+    task whatever the number of meters.
+        :param account_numbers: (List) of Strings
+        :param chunk_size: (Integer) entities per put_multi_async call
+    """
+    deferred.defer(schedule_multi, account_numbers, chunk_size=chunk_size,
+                   _queue=HISTORY_QUEUE, _transactional=ndb.in_transaction())
+
+
+def schedule_multi(account_numbers, chunk_size=HISTORY_CHUNK_SIZE):
+    """
+    Records pending imports for many meters with one put_multi and enqueues their tasks,
+    taskqueue.MAX_TASKS_PER_ADD per call. Not transactional, runs in the task enqueued by schedule_batch and is
+    retried by the queue if it fails.
+        :param account_numbers: (List) of Strings
+        :param chunk_size: (Integer) entities per put_multi_async call
+        :return: list with the keys of the HistoryImport entities
+    """
+    keys = ndb.put_multi([HistoryImport(id=a) for a in account_numbers])
+    tasks = [taskqueue.Task(payload=deferred.serialize(import_history, a, chunk_size=chunk_size),
+                            url=deferred._DEFAULT_URL,
+                            headers=deferred._TASKQUEUE_HEADERS)
+             for a in account_numbers]
+    q = taskqueue.Queue(HISTORY_QUEUE)
+    for start in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        q.add(tasks[start:start+taskqueue.MAX_TASKS_PER_ADD])
+    return keys
+
+
+def import_history(account_number, chunk_size=HISTORY_CHUNK_SIZE):
+    """
+    Onboards a meter: loads its balance and model from JMAS if still missing, then fetches its history from
+    JMAS and stores its bills and readings. History entities have keys derived from the meter and their date,
+    so a retried task overwrites instead of duplicating.
+        :param account_number: (String)
+        :param chunk_size: (Integer) entities per put_multi_async call
+    """
+    # Import in the function to avoid circular import
+    from meter import Meter
+    from reading import Reading
+    from bill import Bill
+
+    state = HistoryImport.get_or_insert(account_number)
+    if state.status == 'Done':
+        Meter.set_status(account_number, 'Ready')
+        return
+    state.status = 'Running'
+    state.imported = 0
+    try:
+        Meter.load_account(account_number)
+        meter_key = Meter.get_key(account_number)
+        # Generate fake History TODO: TEMP!!
+        fake_history = jmas_api.FakeHistory(meter_key, HISTORY_MONTHS, HISTORY_VALUE_TO_APPROXIMATE)
+        state.total = len(fake_history.bills) + len(fake_history.readings)
+        state.put()
+
+        def progress(count):
+            state.imported += count
+            state.put()
+
+        Bill.save_history_to_datastore(meter_key, fake_history.bills, chunk_size=chunk_size, on_progress=progress)
+        # Also adds the history to the consumption rollups of the meter (see consumption.add_history)
+        Reading.save_history_to_datastore(meter_key, fake_history.readings, chunk_size=chunk_size,
+                                          on_progress=progress)
+    except Exception as e:
+        state.status = 'Failed'
+        state.error = e.__str__()
+        state.put()
+        Meter.set_status(account_number, 'Failed')
+        if getattr(e, 'logged', False):
+            # Its stack trace was logged where it was wrapped (see errors.wrap)
+            logging.error('[History] - Import failed for meter {0}: {1}'.format(account_number, e.__str__()))
+        else:
+            logging.exception('[History] - Import failed for meter {0}'.format(account_number))
+        # Let the task queue retry, entity keys are deterministic
+        raise
+    else:
+        state.status = 'Done'
+        state.put()
+        Meter.set_status(account_number, 'Ready')
+        logging.debug('[History] - {0} entities imported for meter {1}'.format(state.imported, account_number))
+
+
+def put_in_chunks(entities, chunk_size=HISTORY_CHUNK_SIZE, on_progress=None):
+    """
+    Writes entities with one put_multi_async per chunk. All chunks are sent before waiting for the first one.
+        :param entities: (List) of ndb entities
+        :param chunk_size: (Integer) entities per put_multi_async call
+        :param on_progress: function(count) called once each chunk is stored
+        :return: list with the keys of the stored entities
+    """
+    chunks = [ndb.put_multi_async(entities[start:start+chunk_size])
+              for start in xrange(0, len(entities), chunk_size)]
+    keys = []
+    for futures in chunks:
+        keys.extend(f.get_result() for f in futures)
+        if on_progress:
+            on_progress(len(futures))
+    return keys
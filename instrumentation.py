@@ -0,0 +1,224 @@
+"""
+Instrumentation of the API. Every endpoint of OCRBackendApi is wrapped by @instrumented, which records its wall
+time, the datastore RPCs it made (by method), its task queue and memcache calls and its external HTTP calls.
+Calls are aggregated per endpoint into rolling latency histograms of this instance, served by
+/admin/instrumentation/stats (see tasks.py).
+
+RPCs are counted with an apiproxy pre-call hook; HTTP calls made with requests do not go through the apiproxy,
+the JMAS and Parse clients count them with count_http().
+
+A StageTimer measures each named stage of a pipeline and logs them in a single line when the request ends, so
+the slow stage of a request is visible without a profiler.
+"""
+__author__ = 'Cesar'
+
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map
+
+# Upper bounds (ms) of the latency histogram buckets, the last bucket has no upper bound
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# Calls are aggregated per minute, minutes older than the window are dropped
+WINDOW_MINUTES = 60
+COUNTED_SERVICES = ('datastore_v3', 'taskqueue', 'memcache', 'urlfetch')
+
+
+class CallRecord(object):
+    """
+    Counters of one endpoint call, filled while it runs.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.time()
+        self.rpcs = collections.Counter()
+        self.stages = collections.OrderedDict()
+
+
+class EndpointStats(object):
+    """
+    Rolling stats of the endpoints of this instance, one bucket per minute and endpoint.
+    """
+
+    def __init__(self, window_minutes=WINDOW_MINUTES):
+        self.window_minutes = window_minutes
+        self._lock = threading.Lock()
+        self._minutes = collections.OrderedDict()
+
+    def record(self, record, ms, ok):
+        minute = int(record.started / 60)
+        with self._lock:
+            endpoints = self._minutes.get(minute)
+            if endpoints is None:
+                endpoints = self._minutes[minute] = {}
+                while self._minutes and next(iter(self._minutes)) <= minute - self.window_minutes:
+                    self._minutes.popitem(last=False)
+            s = endpoints.get(record.endpoint)
+            if s is None:
+                s = endpoints[record.endpoint] = {'calls': 0, 'errors': 0, 'total_ms': 0.0,
+                                                  'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                                                  'rpcs': collections.Counter(),
+                                                  'stages_ms': collections.Counter()}
+            s['calls'] += 1
+            s['errors'] += 0 if ok else 1
+            s['total_ms'] += ms
+            s['histogram'][bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+            s['rpcs'].update(record.rpcs)
+            s['stages_ms'].update(record.stages)
+
+    def stats(self):
+        """
+        :return: dict {endpoint: stats} over the window: calls, errors, mean and percentile latencies (upper bound
+                 of their histogram bucket, None for the open bucket), the histogram and the mean RPCs per call
+        """
+        now = int(time.time() / 60)
+        merged = {}
+        with self._lock:
+            for minute, endpoints in self._minutes.items():
+                if minute <= now - self.window_minutes:
+                    continue
+                for endpoint, s in endpoints.items():
+                    m = merged.setdefault(endpoint, {'calls': 0, 'errors': 0, 'total_ms': 0.0,
+                                                     'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                                                     'rpcs': collections.Counter(),
+                                                     'stages_ms': collections.Counter()})
+                    m['calls'] += s['calls']
+                    m['errors'] += s['errors']
+                    m['total_ms'] += s['total_ms']
+                    m['histogram'] = [a + b for a, b in zip(m['histogram'], s['histogram'])]
+                    m['rpcs'].update(s['rpcs'])
+                    m['stages_ms'].update(s['stages_ms'])
+        result = {}
+        for endpoint, m in merged.items():
+            calls = m['calls']
+            result[endpoint] = {
+                'calls': calls,
+                'errors': m['errors'],
+                'mean_ms': m['total_ms'] / calls,
+                'p50_ms': _percentile(m['histogram'], calls, 0.50),
+                'p95_ms': _percentile(m['histogram'], calls, 0.95),
+                'p99_ms': _percentile(m['histogram'], calls, 0.99),
+                'histogram': dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ['inf'], m['histogram'])),
+                'rpcs_per_call': dict((rpc, float(n) / calls) for rpc, n in m['rpcs'].items()),
+                'stages_mean_ms': dict((stage, ms / calls) for stage, ms in m['stages_ms'].items())}
+        return result
+
+
+def _percentile(histogram, calls, fraction):
+    target = calls * fraction
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS + [None], histogram):
+        seen += count
+        if seen >= target:
+            return bound
+    return None
+
+
+endpoint_stats = EndpointStats()
+_current = threading.local()
+
+
+def current():
+    """
+    :return: CallRecord of the endpoint call running in this thread, None outside of an endpoint call
+    """
+    return getattr(_current, 'record', None)
+
+
+def count(name, value=1):
+    """
+    Adds to a counter of the current endpoint call, if any.
+    """
+    record = current()
+    if record is not None:
+        record.rpcs[name] += value
+
+
+def count_http(service):
+    """
+    Counts an external HTTP call of the current endpoint call.
+        :param service: (String) name of the external service (jmas, parse)
+    """
+    count('http.{0}'.format(service))
+
+
+def _rpc_hook(service, call, request, response):
+    if service in COUNTED_SERVICES:
+        count('{0}.{1}'.format(service, call))
+
+
+def install():
+    """
+    Registers the RPC counting hook of this instance. Safe to call more than once.
+    """
+    hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+    hooks.Append('instrumentation', _rpc_hook)
+
+
+def instrumented(func):
+    """
+    Decorator of the endpoint methods: records the call in endpoint_stats. A call counts as an error if it
+    raises or its response has ok = False.
+    """
+    @functools.wraps(func)
+    def wrapper(self, request):
+        record = CallRecord(func.__name__)
+        _current.record = record
+        ok = False
+        try:
+            resp = func(self, request)
+            ok = getattr(resp, 'ok', True) is not False
+            return resp
+        finally:
+            _current.record = None
+            ms = (time.time() - record.started) * 1000
+            endpoint_stats.record(record, ms, ok)
+            logging.debug('[Instrumentation] - {0}: {1:.1f}ms rpcs = {2}'
+                          .format(record.endpoint, ms, dict(record.rpcs)))
+    return wrapper
+
+
+class StageTimer(object):
+    """
+    Wall time of the stages of one request, in milliseconds and in the order they ran. Stages are also added to
+    the current endpoint call, if any.
+
+        - name: name of the pipeline, used in the log line.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = collections.OrderedDict()
+        self._started = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        Times the enclosed block as the given stage. A stage that raises is timed too.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            ms = (time.time() - started) * 1000
+            self.stages[stage] = self.stages.get(stage, 0.0) + ms
+            record = current()
+            if record is not None:
+                record.stages[stage] = record.stages.get(stage, 0.0) + ms
+
+    def total(self):
+        """
+        :return: milliseconds since the timer was created
+        """
+        return (time.time() - self._started) * 1000
+
+    def log(self):
+        logging.debug('[{0}] - {1} total = {2:.1f}ms'
+                      .format(self.name,
+                              ' '.join('{0} = {1:.1f}ms'.format(s, ms) for s, ms in self.stages.items()),
+                              self.total()))
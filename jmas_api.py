@@ -1,46 +1,263 @@
 """
-Temporary functions that mimic the api required from JMAS
+Client of the JMAS api. Tariffs and account data are cached with a TTL, connections are pooled and every call
+has a timeout, retries and a circuit breaker. When JMAS cannot be reached the last known (stale) value is served.
+
+Until the real JMAS service is available (JMAS_API_URL not set) the client answers with temporary fake values,
+see fake_jmas.py for a local server exposing the same fakes over HTTP.
 """
 __author__ = 'cesar'
 
 import datetime
 import calendar
+import collections
+import logging
+import os
 import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import errors
+import instrumentation
+
+JMAS_API_URL = os.environ.get('JMAS_API_URL')
+TARIFF_TTL_SECONDS = 3600
+ACCOUNT_TTL_SECONDS = 60
+# Values kept by the client, least recently used first out. Expired values stay until evicted, they are
+# served if JMAS is unavailable
+CACHE_MAX_ENTRIES = 1000
+REQUEST_TIMEOUT_SECONDS = 5
+REQUEST_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 0.2
+# Consecutive failures that open the circuit, and seconds it stays open before a single trial call is let through
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECONDS = 30
+MODELS = ['AV3-STAR', 'Dorot', 'Cicasa', 'IUSA']
+
+
+def fake_tariffs():
+    """
+    Returns fake and temp conversion factors
+        :return: dict {'postpay': float, 'prepay': float}
+    """
+    return {'postpay': 10.0, 'prepay': 5.0}
+
+
+def fake_account(account_number):
+    """
+    Returns a fake and temp balance and meter model
+        :param account_number:
+        :return: dict {'balance': random int, 'model': random model}
+    """
+    return {'balance': random.randint(0, 30),
+            'model': MODELS[random.randint(0, 3)]}
+
+
+class JmasClient(object):
+    """
+    Client of the JMAS api. One instance per process, it is thread safe.
+
+        - base_url: JMAS api url, None to answer with the temporary fake values.
+        - timeout: seconds per request.
+        - retries: extra attempts per call before it counts as a failure.
+    """
+
+    def __init__(self, base_url=JMAS_API_URL, timeout=REQUEST_TIMEOUT_SECONDS, retries=REQUEST_RETRIES):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=10))
+        self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=10))
+
+    def get_postpay_conversion_factor(self):
+        """
+        :return: postpay conversion factor as float
+        """
+        return self._cached('tariffs', TARIFF_TTL_SECONDS, self._fetch_tariffs)['postpay']
+
+    def get_prepay_conversion_factor(self):
+        """
+        :return: prepay conversion factor as float
+        """
+        return self._cached('tariffs', TARIFF_TTL_SECONDS, self._fetch_tariffs)['prepay']
+
+    def get_balance(self, account_number):
+        """
+        :param account_number:
+        :return: balance of the account as int
+        """
+        return self.get_account(account_number)['balance']
+
+    def get_model(self, account_number):
+        """
+        :param account_number:
+        :return: meter model of the account as string
+        """
+        return self.get_account(account_number)['model']
+
+    def get_account(self, account_number):
+        """
+        :param account_number:
+        :return: dict {'balance': int, 'model': string}
+        """
+        return self._cached('account-{0}'.format(account_number), ACCOUNT_TTL_SECONDS,
+                            lambda: self._fetch_account(account_number))
+
+    def clear(self):
+        """
+        Drops every cached value and closes the circuit
+        """
+        with self._lock:
+            self._cache.clear()
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def _fetch_tariffs(self):
+        if self.base_url is None:
+            return fake_tariffs()
+        return self._get('/tariffs')
+
+    def _fetch_account(self, account_number):
+        if self.base_url is None:
+            return fake_account(account_number)
+        return self._get('/accounts/{0}'.format(account_number))
+
+    def _cached(self, key, ttl, fetch):
+        """
+        Returns the cached value if still fresh, otherwise fetches it. If the fetch fails and there is an
+        expired value, the expired value is served.
+        """
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None:
+                # Re-insert to mark as most recently used
+                self._cache[key] = entry
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        try:
+            value = fetch()
+        except JmasError as e:
+            # An answer of JMAS (unknown account) is not served from a stale value
+            if entry is None or e.code != errors.UNAVAILABLE:
+                raise
+            logging.warning('[JMAS] - Serving stale value for {0}'.format(key))
+            return entry[1]
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (time.time() + ttl, value)
+            while len(self._cache) > CACHE_MAX_ENTRIES:
+                self._cache.popitem(last=False)
+        return value
+
+    def _get(self, path):
+        """
+        GET a JMAS resource with retries, behind the circuit breaker. Once the circuit has been open for
+        CIRCUIT_RESET_SECONDS it is half open: a single call is let through as a trial, the others fail fast
+        until the trial closes the circuit (JMAS answered) or opens it again.
+            :return: decoded JSON response
+            :exception JmasError UNAVAILABLE if JMAS could not be reached or the circuit is open, NOT_FOUND or
+                       INVALID_ARGUMENT if JMAS rejected the request (4xx), which does not count as a failure
+        """
+        probe = False
+        with self._lock:
+            if self._opened_at is not None:
+                if self._probing or time.time() - self._opened_at < CIRCUIT_RESET_SECONDS:
+                    raise JmasError('JMAS unavailable, circuit open')
+                self._probing = probe = True
+        answered = False
+        try:
+            error = None
+            for attempt in xrange(self.retries + 1):
+                if attempt:
+                    time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+                try:
+                    instrumentation.count_http('jmas')
+                    r = self._session.get(self.base_url + path, timeout=self.timeout)
+                except requests.RequestException as e:
+                    error = e.__str__()
+                    continue
+                if r.status_code == 200:
+                    answered = True
+                    return r.json()
+                error = 'status {0}'.format(r.status_code)
+                if r.status_code < 500:
+                    # JMAS is up and answered, the request itself is wrong: no retry and the circuit closes
+                    answered = True
+                    raise JmasError('JMAS rejected {0}: {1}'.format(path, error),
+                                    errors.NOT_FOUND if r.status_code == 404 else errors.INVALID_ARGUMENT)
+            raise JmasError('Error calling JMAS {0}: {1}'.format(path, error))
+        finally:
+            self._record(answered, probe)
+
+    def _record(self, answered, probe):
+        """
+        Closes the circuit if JMAS answered, otherwise counts a failure: the circuit opens after
+        CIRCUIT_FAILURE_THRESHOLD consecutive failures, or again at once if the failed call was the half open trial.
+            :param answered: (Boolean)
+            :param probe: (Boolean) True if the call was the half open trial
+        """
+        with self._lock:
+            if probe:
+                self._probing = False
+            if answered:
+                if self._opened_at is not None:
+                    logging.info('[JMAS] - Circuit closed')
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if probe or self._failures >= CIRCUIT_FAILURE_THRESHOLD:
+                self._opened_at = time.time()
+                logging.error('[JMAS] - Circuit opened after {0} failures'.format(self._failures))
+
+
+client = JmasClient()
 
 
 def get_postpay_conversion_factor():
     """
-    Returns a fake and temp conversion factor
+    Returns the postpay conversion factor (cached)
         :return: conversion factor as float
     """
-    return 10.0
+    return client.get_postpay_conversion_factor()
 
 
 def get_prepay_conversion_factor():
     """
-    Returns a fake and temp conversion factor
+    Returns the prepay conversion factor (cached)
         :return: conversion factor as float
     """
-    return 5.0
+    return client.get_prepay_conversion_factor()
 
 
 def get_balance(account_number):
     """
-    Returns a fake and temp balance
+    Returns the balance of an account
         :param account_number:
-        :return: random balance as int
+        :return: balance as int
     """
-    return random.randint(0, 30)
+    return client.get_balance(account_number)
 
 
 def get_model(account_number):
     """
-    Returns a fake and temp meter model
+    Returns the meter model of an account
         :param account_number:
-        :return: random model as string
+        :return: model as string
     """
-    models = ['AV3-STAR', 'Dorot', 'Cicasa', 'IUSA']
-    return models[random.randint(0, 3)]
+    return client.get_model(account_number)
+
+
+class JmasError(errors.PlatformError):
+    def __init__(self, value, code=errors.UNAVAILABLE):
+        errors.PlatformError.__init__(self, value, code)
 
 
 class FakeHistory:
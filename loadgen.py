@@ -0,0 +1,318 @@
+"""
+Synthetic load generator of the OCR backend, for capacity planning before onboarding a new city. Builds a fleet
+of users and meters on the local stack (see benchmark.LocalStack) with FakeHistory histories of configurable depth
+and replays days of traffic in simulated time:
+
+    - uploads follow a diurnal curve (DIURNAL_CURVE), each meter uploads --uploads-per-day images a day.
+    - OCR-Workers lease tasks by meter model and submit their results in batches, with a share of OCR errors
+      (routed to the need-help-queue) and of negative consumptions (routed to the negative-consumption-queue).
+    - human reviewers take the tasks of those queues once they are --review-latency minutes old.
+    - push notifications are dispatched every step.
+
+Workers and reviewers have a capacity in tasks per simulated minute, so the sampled queue backlog shows whether a
+fleet of that size is served by that many workers. Wall time of the replay gives the sustained throughput of the
+backend itself.
+
+    python loadgen.py --sdk [path to google_appengine] [--meters 500] [--days 1] [--output loadgen.json]
+"""
+__author__ = 'Cesar'
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import random
+import time
+import benchmark
+
+# Relative upload rate of each hour of the day: quiet nights, peaks before work and in the evening
+DIURNAL_CURVE = [1, 1, 1, 1, 2, 4, 8, 10, 9, 7, 6, 6, 6, 5, 5, 5, 6, 7, 9, 10, 8, 5, 3, 2]
+# m3 consumed by a meter between two uploads
+CONSUMPTION_PER_UPLOAD = (0, 2)
+OCR_ERROR_MESSAGE = 'Unreadable image'
+HUMAN_REJECT_MESSAGE = 'La lectura es anterior a la ultima registrada'
+SAMPLED_QUEUES = ('image-processing-queue', 'need-help-queue', 'negative-consumption-queue', 'push-outbox')
+# Seconds a leased task is reserved, the longest lease the API grants (reading.MAX_LEASE_SECONDS)
+LEASE_SECONDS = 600
+
+
+class LoadGenerator(object):
+    """
+    Fleet and simulated traffic on a LocalStack.
+
+        - stack: benchmark.LocalStack
+        - args: parsed command line (see main)
+    """
+
+    def __init__(self, stack, args):
+        self.stack = stack
+        self.args = args
+        self.accounts = [benchmark.account_number(i) for i in xrange(args.meters)]
+        # Real value of each meter and of each uploaded image, the measure a perfect OCR would read
+        self.truth = {}
+        self.image_truth = {}
+        # Highest measure saved per meter, the reference of a human reviewing a negative consumption
+        self.saved = {}
+        # Simulated minute each task entered a human queue
+        self.routed = {'need-help-queue': collections.deque(), 'negative-consumption-queue': collections.deque()}
+        self.stats = collections.OrderedDict()
+        self.outcomes = collections.Counter()
+        self.samples = []
+        self._images = 0
+        # Simulated minute of the step being replayed
+        self._minute = 0
+
+    def _stats(self, name):
+        s = self.stats.get(name)
+        if s is None:
+            s = self.stats[name] = benchmark.OperationStats()
+        return s
+
+    def build_fleet(self):
+        """
+        Creates one user per meter, onboards the meters in batches (JMAS data and a history of
+        --history-months months) and assigns them.
+        """
+        import messages
+        import history
+        from meter import Meter, MAX_METERS_PER_BATCH
+
+        history.HISTORY_MONTHS = self.args.history_months
+        started = time.time()
+        for i, account in enumerate(self.accounts):
+            self._setup('user_create', self.stack.api.new_user,
+                        messages.CreateUser(email=_email(i), name='Loadgen', age=30, account_type='G+',
+                                            installation_id='install-{0}'.format(i)))
+        for i in xrange(0, len(self.accounts), MAX_METERS_PER_BATCH):
+            resp = self._setup('meter_create_batch', self.stack.api.new_meters,
+                               messages.CreateMeters(account_numbers=self.accounts[i:i + MAX_METERS_PER_BATCH]))
+            failed = [r for r in resp.results if not r.ok]
+            if failed:
+                raise benchmark.SetupError('{0} meters not created, first: {1}: {2} ({3})'
+                                           .format(len(failed), failed[0].account_number, failed[0].error,
+                                                   failed[0].error_code))
+        stats = self._stats('meter_onboarding_task')
+        self.stack.drain([history.HISTORY_QUEUE], stats=stats)
+        if stats.errors:
+            raise benchmark.SetupError('{0} onboarding tasks failed'.format(stats.errors))
+        for i, account in enumerate(self.accounts):
+            self._setup('meter_assign', self.stack.api.assign_meter_to_user,
+                        messages.AssignMeterToUser(account_number=account, email=_email(i)))
+            meter = self.stack.request(Meter.get_from_datastore, account)
+            self.truth[account] = self.saved[account] = meter.last_measure or 0
+        logging.info('[Loadgen] - Fleet of {0} meters built in {1:.1f}s'
+                     .format(len(self.accounts), time.time() - started))
+
+    def _setup(self, name, func, request):
+        """
+        Measures an operation the fleet depends on.
+            :exception benchmark.SetupError if it fails, the replay would measure a fleet that does not exist
+        """
+        resp = self.stack.measure(self._stats(name), func, request)
+        if resp is None or not resp.ok:
+            raise benchmark.SetupError('{0} failed: {1}'.format(name, resp.error if resp is not None else 'exception'))
+        return resp
+
+    def replay(self):
+        """
+        Replays --days days of traffic in steps of --step-minutes simulated minutes, sampling the queue backlog
+        every simulated hour.
+            :return: wall seconds of the replay
+        """
+        import notifications
+
+        step = self.args.step_minutes
+        uploads_per_minute = [float(self.args.uploads_per_day * len(self.accounts) * w) / sum(DIURNAL_CURVE) / 60
+                              for w in DIURNAL_CURVE]
+        started = time.time()
+        hour_started, hour_ops = started, self._operations()
+        for minute in xrange(0, self.args.days * 24 * 60, step):
+            self._minute = minute
+            hour = (minute / 60) % 24
+            self.upload(_draw(uploads_per_minute[hour] * step))
+            self.process_ocr(self.args.ocr_capacity * step)
+            for queue in self.routed:
+                self.review(queue, minute, self.args.review_capacity * step)
+            self.stack.drain([notifications.DISPATCH_QUEUE], stats=self._stats('push_dispatch'))
+            if (minute + step) % 60 < step:
+                now, ops = time.time(), self._operations()
+                sample = {'minute': minute + step,
+                          'hour_of_day': hour,
+                          'ops_per_sec': (ops - hour_ops) / (now - hour_started) if now > hour_started else None,
+                          'backlog': self.stack.backlog(SAMPLED_QUEUES)}
+                self.samples.append(sample)
+                logging.info('[Loadgen] - {0}'.format(json.dumps(sample, sort_keys=True)))
+                hour_started, hour_ops = now, ops
+        return time.time() - started
+
+    def _operations(self):
+        return sum(len(s.latencies) for s in self.stats.values())
+
+    def upload(self, count):
+        """
+        Uploads images of count random meters. Their meters advance by CONSUMPTION_PER_UPLOAD m3.
+        """
+        import messages
+        for _ in xrange(count):
+            account = random.choice(self.accounts)
+            self._images += 1
+            image = '{0}-{1}.jpg'.format(account, self._images)
+            self.truth[account] += random.randint(*CONSUMPTION_PER_UPLOAD)
+            self.image_truth['Process--{0}'.format(image)] = self.truth[account]
+            self.stack.measure(self._stats('image_upload'), self.stack.api.new_image_for_processing,
+                               messages.NewImageForProcessing(account_number=account, image_name=image))
+
+    def _lease(self, queue, max_tasks):
+        import messages
+        from reading import MAX_LEASED_TASKS
+        resp = self.stack.measure(self._stats('lease'), self.stack.api.lease_tasks,
+                                  messages.LeaseTasks(queue=queue, max_tasks=min(max_tasks, MAX_LEASED_TASKS),
+                                                      lease_seconds=LEASE_SECONDS))
+        return resp.tasks if resp is not None and resp.ok else []
+
+    def process_ocr(self, capacity):
+        """
+        OCR-Workers: leases up to capacity tasks of the image-processing-queue, a lease per meter model, and
+        submits each lease as a batch of results with --ocr-error-rate errors and --negative-rate negative
+        consumptions.
+        """
+        import messages
+        while capacity > 0:
+            tasks = self._lease('image-processing-queue', capacity)
+            if not tasks:
+                break
+            capacity -= len(tasks)
+            results = []
+            for task in tasks:
+                truth = self.image_truth.get(task.task_name, 0)
+                r = random.random()
+                if r < self.args.ocr_error_rate:
+                    measure, error = None, OCR_ERROR_MESSAGE
+                elif r < self.args.ocr_error_rate + self.args.negative_rate:
+                    measure, error = truth - random.randint(1, 20), ''
+                else:
+                    measure, error = truth, ''
+                results.append(messages.ImageProcessingResult(task_name=task.task_name,
+                                                              task_payload=task.task_payload,
+                                                              result=measure, error=error, human=False))
+            self._submit('ocr_result_batch', results)
+
+    def review(self, queue, minute, capacity):
+        """
+        Human reviewers: takes the tasks that entered the queue at least --review-latency minutes ago, up to
+        capacity. An OCR error is read from the image; a negative consumption is corrected, or rejected if the
+        image is older than the last saved reading. Reviewed tasks are deleted from the queue, like the
+        human-helper does.
+        """
+        import messages
+        from reading import Reading
+        routed = self.routed[queue]
+        due = 0
+        while routed and routed[0] <= minute - self.args.review_latency and due < capacity:
+            routed.popleft()
+            due += 1
+        while due > 0:
+            tasks = self._lease(queue, due)
+            if not tasks:
+                break
+            due -= len(tasks)
+            results = []
+            for task in tasks:
+                account = task.task_payload.split('--')[0]
+                truth = self.image_truth.get(task.task_name, 0)
+                if queue == 'negative-consumption-queue' and truth < self.saved.get(account, 0):
+                    measure, error = None, HUMAN_REJECT_MESSAGE
+                else:
+                    measure, error = truth, ''
+                results.append(messages.ImageProcessingResult(task_name=task.task_name,
+                                                              task_payload=task.task_payload,
+                                                              result=measure, error=error, human=True))
+            self._submit('human_result_batch', results)
+            self.stack.request(Reading.delete_image_processing_tasks, queue, [t.task_name for t in tasks])
+
+    def _submit(self, name, results):
+        import api
+        import messages
+        resp = self.stack.measure(self._stats(name), self.stack.api.set_image_processing_results_batch,
+                                  messages.ImageProcessingResultsBatch(results=results))
+        if resp is None or not resp.ok:
+            return
+        for result, status in zip(results, resp.results):
+            if not status.ok:
+                # Not applied, it has no outcome
+                continue
+            self.outcomes['{0}.{1}'.format('human' if result.human else 'ocr', status.outcome)] += 1
+            if status.duplicate:
+                continue
+            if status.outcome == 'Saved':
+                account = result.task_payload.split('--')[0]
+                self.saved[account] = max(self.saved.get(account, 0), result.result)
+            queue = api.result_effects(status.outcome, result)[1]
+            if queue in self.routed:
+                self.routed[queue].append(self._minute)
+
+    def report(self, replay_seconds):
+        backlog = self.stack.backlog(SAMPLED_QUEUES)
+        operations = self._operations()
+        return {'operations': dict((name, s.report()) for name, s in self.stats.items()),
+                'outcomes': dict(self.outcomes),
+                'replay_seconds': replay_seconds,
+                'sustained_ops_per_sec': operations / replay_seconds if replay_seconds else None,
+                'backlog_samples': self.samples,
+                'max_backlog': dict((q, max([s['backlog'].get(q, 0) for s in self.samples] or [0]))
+                                    for q in SAMPLED_QUEUES),
+                'final_backlog': backlog}
+
+
+def _email(i):
+    return 'user{0}@loadgen.test'.format(i)
+
+
+def _draw(expected):
+    """
+    :return: (Integer) expected rounded up or down at random, so that fractional rates add up over the steps
+    """
+    n = int(expected)
+    return n + 1 if random.random() < expected - n else n
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic fleet load generator on App Engine testbed stubs')
+    parser.add_argument('--sdk', help='path to google_appengine (default: APPENGINE_SDK env variable)')
+    parser.add_argument('--meters', type=int, default=500)
+    parser.add_argument('--history-months', type=int, default=6, help='months of JMAS history per meter')
+    parser.add_argument('--days', type=int, default=1, help='simulated days of traffic')
+    parser.add_argument('--step-minutes', type=int, default=10, help='simulated minutes per step')
+    parser.add_argument('--uploads-per-day', type=float, default=1.0, help='uploads per meter per day')
+    parser.add_argument('--ocr-error-rate', type=float, default=0.1)
+    parser.add_argument('--negative-rate', type=float, default=0.03)
+    parser.add_argument('--ocr-capacity', type=int, default=20, help='OCR tasks processed per simulated minute')
+    parser.add_argument('--review-capacity', type=int, default=2, help='tasks reviewed per simulated minute')
+    parser.add_argument('--review-latency', type=int, default=30, help='simulated minutes before a review')
+    parser.add_argument('--fake-jmas', action='store_true', help='serve JMAS over HTTP from fake_jmas.py')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadgen.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    benchmark.setup_sdk(args.sdk)
+    stack = benchmark.LocalStack(fake_jmas=args.fake_jmas, seed=args.seed)
+    try:
+        generator = LoadGenerator(stack, args)
+        generator.build_fleet()
+        results = generator.report(generator.replay())
+    finally:
+        stack.stop()
+
+    report = {'version': benchmark.version(),
+              'date': datetime.datetime.now().isoformat(),
+              'parameters': vars(args),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print 'Results written to {0}'.format(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -32,9 +32,11 @@ class CreateUserResponse(messages.Message):
     Response to user creation request
         ok: (Boolean) User creation successful or failed
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
+    error_code = messages.StringField(3)
 
 
 class GetUser(messages.Message):
@@ -50,6 +52,7 @@ class GetUserResponse(messages.Message):
     Response to user information request
         ok: (Boolean) User search successful or failed
         error: (String) If search failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
 
         email = (String)
         name = (String)
@@ -65,6 +68,7 @@ class GetUserResponse(messages.Message):
     age = messages.IntegerField(5)
     account_type = messages.StringField(6)
     installation_id = messages.StringField(7)
+    error_code = messages.StringField(8)
 
 
 """
@@ -99,9 +103,47 @@ class CreateMeterResponse(messages.Message):
     Response to user creation request
         ok: (Boolean) Meter creation successful or failed
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
+    error_code = messages.StringField(3)
+
+
+class CreateMeters(messages.Message):
+    """
+    Message containing the account numbers of several meters to create
+        account_numbers: (String) at most meter.MAX_METERS_PER_BATCH
+    """
+    account_numbers = messages.StringField(1, repeated=True)
+
+
+class CreateMeterStatus(messages.Message):
+    """
+    Outcome of one meter of a batch
+        account_number: (String)
+        ok: (Boolean) Meter created
+        error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If creation failed, the type of the error (see errors.py), otherwise empty.
+    """
+    account_number = messages.StringField(1)
+    ok = messages.BooleanField(2)
+    error = messages.StringField(3)
+    error_code = messages.StringField(4)
+
+
+class CreateMetersResponse(messages.Message):
+    """
+    Response to a batch meter creation request
+        ok: (Boolean) Batch processed, see results for the outcome of each meter
+        results: (CreateMeterStatus) one per account number, in the same order
+        error: (String) If the batch failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    results = messages.MessageField(CreateMeterStatus, 2, repeated=True)
+    error = messages.StringField(3)
+    error_code = messages.StringField(4)
 
 
 class GetMeter(messages.Message):
@@ -117,10 +159,15 @@ class GetMeterResponse(messages.Message):
     Response to user information request
         ok: (Boolean) Meter search successful or failed
         error: (String) If search failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
 
         account_number: (String)
         balance: (Integer)
         model: (String)
+        last_measure: (Integer) measure of the newest reading
+        last_reading_date: (DateTime) date of the newest reading
+        last_reading_key: (String) urlsafe key of the newest reading
+        status: (String) onboarding status: Pending, Ready or Failed
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
@@ -128,6 +175,43 @@ class GetMeterResponse(messages.Message):
     account_number = messages.StringField(3)
     balance = messages.IntegerField(4)
     model = messages.StringField(5)
+    last_measure = messages.IntegerField(6)
+    last_reading_date = message_types.DateTimeField(7)
+    last_reading_key = messages.StringField(8)
+    status = messages.StringField(9)
+    error_code = messages.StringField(10)
+
+
+class GetOnboardingStatus(messages.Message):
+    """
+    Message containing the account number of the meter being onboarded
+        account_number: (String)
+    """
+    account_number = messages.StringField(1, required=True)
+
+
+class GetOnboardingStatusResponse(messages.Message):
+    """
+    Response to an onboarding status request
+        ok: (Boolean) Search successful or failed
+        error: (String) If search failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+
+        status: (String) onboarding status of the meter: Pending, Ready or Failed
+        history_status: (String) Pending, Running, Done or Failed, empty if the meter has no history import
+        history_total: (Integer) bills and readings to import
+        history_imported: (Integer) bills and readings already imported
+        history_error: (String) reason of the last failure of the history import, if any
+    """
+    ok = messages.BooleanField(1)
+    error = messages.StringField(2)
+
+    status = messages.StringField(3)
+    history_status = messages.StringField(4)
+    history_total = messages.IntegerField(5)
+    history_imported = messages.IntegerField(6)
+    history_error = messages.StringField(7)
+    error_code = messages.StringField(8)
 
 
 class AssignMeterToUser(messages.Message):
@@ -145,9 +229,11 @@ class AssignMeterToUserResponse(messages.Message):
     Response to user creation request
         ok: (Boolean) Meter creation successful or failed
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
+    error_code = messages.StringField(3)
 
 
 class GetMeters(messages.Message):
@@ -164,10 +250,12 @@ class GetMetersResponse(messages.Message):
         ok: (Boolean) Meter creation successful or failed
         meters: (Meter) Detailed info of each meter
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     meters = messages.MessageField(Meter, 2, repeated=True)
     error = messages.StringField(3)
+    error_code = messages.StringField(4)
 
 
 """
@@ -192,10 +280,18 @@ class Reading(messages.Message):
 
 class GetReadings(messages.Message):
     """
-    Message asking for Readings that meet certain criteria
+    Message asking for a page of Readings that meet certain criteria
         account_number: (String)
+        start_date: (DateTime) oldest reading to include, optional
+        end_date: (DateTime) newest reading to include, optional
+        page_size: (Integer) readings per page, optional
+        cursor: (String) next_cursor of the previous page, empty for the first page
     """
     account_number = messages.StringField(1, required=True)
+    start_date = message_types.DateTimeField(2)
+    end_date = message_types.DateTimeField(3)
+    page_size = messages.IntegerField(4)
+    cursor = messages.StringField(5)
 
 
 class GetReadingsResponse(messages.Message):
@@ -204,10 +300,58 @@ class GetReadingsResponse(messages.Message):
         ok: (Boolean) Bill search successful or failed
         readings: (String) If search successful contains a list of readings (see class Reading on messages.py)
         error: (String) If search failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+        next_cursor: (String) cursor of the next page, empty if this is the last one
+        more: (Boolean) True if there may be more pages
     """
     ok = messages.BooleanField(1)
     readings = messages.MessageField(Reading, 2, repeated=True)
     error = messages.StringField(3)
+    next_cursor = messages.StringField(4)
+    more = messages.BooleanField(5)
+    error_code = messages.StringField(6)
+
+
+class GetConsumptionSummary(messages.Message):
+    """
+    Message to get the consumption of a meter per period
+        account_number: (String)
+        granularity: (String) Daily or Monthly (default)
+        start_date: (DateTime) first period, by default 31 days or 12 months before end_date
+        end_date: (DateTime) last period, by default now
+    """
+    account_number = messages.StringField(1, required=True)
+    granularity = messages.StringField(2, default='Monthly')
+    start_date = message_types.DateTimeField(3)
+    end_date = message_types.DateTimeField(4)
+
+
+class ConsumptionPeriod(messages.Message):
+    """
+    Consumption of a meter in a day or month
+        period_start: (DateTime) first instant of the period
+        consumption: (Integer) m3 consumed
+        readings: (Integer) readings stored in the period
+    """
+    period_start = message_types.DateTimeField(1)
+    consumption = messages.IntegerField(2)
+    readings = messages.IntegerField(3)
+
+
+class GetConsumptionSummaryResponse(messages.Message):
+    """
+    Response to a consumption summary request
+        ok: (Boolean) Search successful or failed
+        error: (String) If search failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+        periods: (ConsumptionPeriod) one per period, oldest first, at most consumption.MAX_SUMMARY_PERIODS
+        total: (Integer) m3 consumed in all the periods
+    """
+    ok = messages.BooleanField(1)
+    error = messages.StringField(2)
+    periods = messages.MessageField(ConsumptionPeriod, 3, repeated=True)
+    total = messages.IntegerField(4)
+    error_code = messages.StringField(5)
 
 
 class NewImageForProcessing(messages.Message):
@@ -225,9 +369,54 @@ class NewImageForProcessingResponse(messages.Message):
     Response to reading creation request
         ok: (Boolean) Process creation successful or failed
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    error = messages.StringField(2)
+    error_code = messages.StringField(3)
+
+
+class LeaseTasks(messages.Message):
+    """
+    Message requesting OCR-Worker tasks
+        queue: (String) image-processing-queue (default), negative-consumption-queue or need-help-queue
+        tag: (String) meter model of the tasks: AV3-STAR, Dorot, Cicasa or IUSA. Empty to lease the model of
+             the oldest task
+        max_tasks: (Integer) tasks to lease, at most reading.MAX_LEASED_TASKS
+        lease_seconds: (Integer) seconds the tasks are reserved for the worker, at most reading.MAX_LEASE_SECONDS
+    """
+    queue = messages.StringField(1, default='image-processing-queue')
+    tag = messages.StringField(2)
+    max_tasks = messages.IntegerField(3, default=10)
+    lease_seconds = messages.IntegerField(4, default=300)
+
+
+class LeasedTask(messages.Message):
+    """
+    An OCR-Worker task
+        task_name: (String) Process--[image_name]
+        task_payload: (String) [account_number]--[image_name]
+        tag: (String) meter model
+        retry_count: (Integer) times the task was leased before
+    """
+    task_name = messages.StringField(1)
+    task_payload = messages.StringField(2)
+    tag = messages.StringField(3)
+    retry_count = messages.IntegerField(4)
+
+
+class LeaseTasksResponse(messages.Message):
+    """
+    Response to a lease request
+        ok: (Boolean) Lease successful or failed
+        error: (String) If lease failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+        tasks: (LeasedTask) leased tasks, all of the same tag
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
+    tasks = messages.MessageField(LeasedTask, 3, repeated=True)
+    error_code = messages.StringField(4)
 
 
 class ImageProcessingResult(messages.Message):
@@ -251,9 +440,55 @@ class ImageProcessingResultResponse(messages.Message):
     Response to reading creation request
         ok: (Boolean) Result received and reading created
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+        outcome: (String) Saved, NegativeConsumption or Error
+        duplicate: (Boolean) True if the task result had already been applied, outcome is the original one
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
+    outcome = messages.StringField(3)
+    duplicate = messages.BooleanField(4)
+    error_code = messages.StringField(5)
+
+
+class ImageProcessingResultsBatch(messages.Message):
+    """
+    Message containing the results of several image processing tasks, applied in order per meter
+        results: (ImageProcessingResult) see class ImageProcessingResult on messages.py
+    """
+    results = messages.MessageField(ImageProcessingResult, 1, repeated=True)
+
+
+class ImageProcessingResultStatus(messages.Message):
+    """
+    Outcome of one result of a batch
+        task_name: (String) Process--[image_name]
+        ok: (Boolean) Result applied
+        error: (String) If the result could not be applied, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+        outcome: (String) Saved, NegativeConsumption or Error
+        duplicate: (Boolean) True if the task result had already been applied, outcome is the original one
+    """
+    task_name = messages.StringField(1)
+    ok = messages.BooleanField(2)
+    error = messages.StringField(3)
+    outcome = messages.StringField(4)
+    duplicate = messages.BooleanField(5)
+    error_code = messages.StringField(6)
+
+
+class ImageProcessingResultsBatchResponse(messages.Message):
+    """
+    Response to a batch of image processing results
+        ok: (Boolean) Batch received, see results for the outcome of each item
+        results: (ImageProcessingResultStatus) one per submitted result, in the same order
+        error: (String) If the batch failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+    """
+    ok = messages.BooleanField(1)
+    results = messages.MessageField(ImageProcessingResultStatus, 2, repeated=True)
+    error = messages.StringField(3)
+    error_code = messages.StringField(4)
 
 
 """
@@ -293,19 +528,25 @@ class NewBillResponse(messages.Message):
     Response to Bill creation request
         ok: (Boolean) Reading creation successful or failed
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
+    error_code = messages.StringField(3)
 
 
 class GetBills(messages.Message):
     """
-    Message asking for Bills that meet certain criteria
+    Message asking for a page of Bills that meet certain criteria
         account_number: (String)
-        status: status of the bill ('Paid', 'Unpaid')
+        status: status of the bill ('Paid', 'Unpaid', 'All'). Empty means 'All'
+        page_size: (Integer) bills per page, optional
+        cursor: (String) next_cursor of the previous page, empty for the first page
     """
     account_number = messages.StringField(1, required=True)
-    status = messages.StringField(2, required=True)
+    status = messages.StringField(2)
+    page_size = messages.IntegerField(3)
+    cursor = messages.StringField(4)
 
 
 class GetBillsResponse(messages.Message):
@@ -314,10 +555,16 @@ class GetBillsResponse(messages.Message):
         ok: (Boolean) Bill search successful or failed
         bills: (String) If search successful contains a list of bills (see class Bill on messages.py)
         error: (String) If search failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
+        next_cursor: (String) cursor of the next page, empty if this is the last one
+        more: (Boolean) True if there may be more pages
     """
     ok = messages.BooleanField(1)
     bills = messages.MessageField(Bill, 2, repeated=True)
     error = messages.StringField(3)
+    next_cursor = messages.StringField(4)
+    more = messages.BooleanField(5)
+    error_code = messages.StringField(6)
 
 
 class PayBill(messages.Message):
@@ -333,9 +580,11 @@ class PayBillResponse(messages.Message):
     Response to Bill payment request
         ok: (Boolean) Reading creation successful or failed
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     error = messages.StringField(2)
+    error_code = messages.StringField(3)
 
 """
 PREPAY
@@ -378,10 +627,12 @@ class NewPrepayResponse(messages.Message):
         amount_to_pay: (Integer) Amount in currency to pay for the solicited m3_to_prepay (see class NewPrepay on
         messages.py)
         error: (String) If creation failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     amount_to_pay = messages.IntegerField(2)
     error = messages.StringField(3)
+    error_code = messages.StringField(4)
 
 
 class GetPrepayFactor(messages.Message):
@@ -398,10 +649,12 @@ class GetPrepayFactorResponse(messages.Message):
         ok: (Boolean)
         factor: (Float) factor corresponding to the amount of m3 to prepay
         error: (String) If failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     factor = messages.FloatField(2)
     error = messages.StringField(3)
+    error_code = messages.StringField(4)
 
 
 class GetPrepays(messages.Message):
@@ -418,8 +671,10 @@ class GetPrepaysResponse(messages.Message):
         ok: (Boolean) Bill search successful or failed
         prepays: (String) If search successful contains a list of prepay events (see class Prepay on messages.py)
         error: (String) If search failed, contains the reason, otherwise empty.
+        error_code: (String) If failed, the type of the error (see errors.py), otherwise empty.
     """
     ok = messages.BooleanField(1)
     prepays = messages.MessageField(Prepay, 2, repeated=True)
     error = messages.StringField(3)
+    error_code = messages.StringField(4)
 
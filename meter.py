@@ -3,26 +3,65 @@ Defines the datastore and all interfaces needed for a Meter in the OCR platform
 """
 __author__ = 'Cesar'
 
+import collections
 import logging
 from google.appengine.ext import ndb
 from user import User, GetUserError
 import jmas_api
+import cache
+import errors
+import history
+
+# Times a balance transaction is retried when it collides with another write to the same meter
+BALANCE_TRANSACTION_RETRIES = 5
+# Meters created per transaction by create_batch, XG transactions allow 25 entity groups
+METERS_PER_TRANSACTION = 20
+MAX_METERS_PER_BATCH = 1000
 
 
 class Meter(ndb.Model):
     """
     Represents a meter in the platform. A user may be several meters assigned.
+    Meters are keyed by their account number (see get_key) so lookups are a single get. Meters still under a
+    legacy auto generated id are re-keyed the first time they are looked up (see migrate_legacy).
 
         - user: The user that has this meter assigned.
         - account_number: Key that ties to JMAS system.
         - balance: + - m3. Positive balance means debt, negative balance means prepay.
         - model: Model of the physical meter, for OCR purposes.
+        - installation_id: Copy of the assigned user's Parse installation id, so push notifications
+          for a meter need a single get.
+        - last_measure, last_reading_date, last_reading_key: Snapshot of the newest Reading, updated in the
+          transaction that stores it, so consumption is computed without a query.
+        - status: Onboarding status. Pending until its JMAS data and history are loaded, then Ready,
+          or Failed if the last onboarding attempt failed. Meters created before onboarding read as Ready.
     """
     # TODO: add geolocation property
     user = ndb.KeyProperty(kind=User)
     account_number = ndb.StringProperty()
     balance = ndb.IntegerProperty()
     model = ndb.StringProperty(choices=['AV3-STAR', 'Dorot', 'Cicasa', 'IUSA'])
+    installation_id = ndb.StringProperty(indexed=False)
+    last_measure = ndb.IntegerProperty(indexed=False)
+    last_reading_date = ndb.DateTimeProperty(indexed=False)
+    last_reading_key = ndb.KeyProperty(kind='Reading', indexed=False)
+    status = ndb.StringProperty(choices=['Pending', 'Ready', 'Failed'], default='Ready')
+
+    # Reads go through cache.meters, which keeps its own memcache tier
+    _use_memcache = False
+
+    @classmethod
+    def get_key(cls, account_number):
+        """
+        Builds the datastore key of a meter from its account number.
+
+        Args:
+            account_number: (String) account_number from request
+
+        Returns:
+            ndb Key of the meter
+        """
+        return ndb.Key(cls, account_number)
 
     @classmethod
     def exists(cls, account_number):
@@ -35,21 +74,49 @@ class Meter(ndb.Model):
         Returns:
             True if account exist False otherwise
         """
-        return cls.query(cls.account_number == account_number).count(1) == 1
+        return cls.get_key(account_number).get() is not None or cls.migrate_legacy(account_number) is not None
+
+    @classmethod
+    def migrate_legacy(cls, account_number):
+        """
+        Until the meter_keys migration is done a meter may still be stored under its legacy auto generated id.
+        Looks it up by account number and re-keys it at once (see migrations.rekey_meter), so it is found by
+        key from then on.
+
+        Args:
+            account_number: (String) account number of a meter not found under its key
+
+        Returns:
+            The re-keyed Meter, None if there is no legacy meter with that account number
+        """
+        # Import in the function to avoid circular import
+        import migrations
+        if ndb.in_transaction() or migrations.is_done('meter_keys'):
+            # Transactions cannot run the query, they read meters already looked up by their request
+            return None
+        key = Meter.get_key(account_number)
+        legacy = [m for m in Meter.query(Meter.account_number == account_number).fetch() if m.key != key]
+        if not legacy:
+            return None
+        for m in legacy:
+            migrations.rekey_meter(m)
+        logging.info('[Meter] - Legacy meter {0} re-keyed on lookup'.format(account_number))
+        return key.get()
 
     @classmethod
     def create_in_datastore(cls, account_number):
         """
         Creates a new meter in datastore. Checks if the account number is already in the platform
         if not, calls the transactional create of the datastore objects.
+        The meter is created Pending, its JMAS data and history are loaded by the onboarding task
+        (see history.import_history), so creation does not wait on JMAS.
         """
         try:
-            if Meter.exists(account_number):
-                raise MeterCreationError('Meter account number already in platform')
-            else:
-                Meter.transactional_create(account_number)
+            if Meter.migrate_legacy(account_number) is not None:
+                raise MeterCreationError('Meter account number already in platform', errors.ALREADY_EXISTS)
+            Meter.transactional_create(account_number)
         except Exception as e:
-            raise MeterCreationError('Error creating the meter in platform: '+e.__str__())
+            raise errors.wrap(MeterCreationError, 'Error creating the meter in platform: ', e)
         else:
             return True
 
@@ -59,33 +126,136 @@ class Meter(ndb.Model):
         """
         Transactional to the datastore. A transaction is an operation
         or set of operations that either succeeds completely or fails completely.
+        Only datastore work runs here, no external calls.
 
             :param account_number: meter number to create
             :exception if transaction fails
         """
-        # Import in the function to avoid circular import
-        from reading import Reading
-        from bill import Bill
-
         try:
-            balance = jmas_api.get_balance(account_number)
-            model = jmas_api.get_model(account_number)
-            # Create Meter
-            m = Meter(account_number=account_number, balance=balance, model=model)
+            if Meter.get_key(account_number).get() is not None:
+                raise MeterCreationError('Meter account number already in platform', errors.ALREADY_EXISTS)
+            # Create Meter, the JMAS balance is added to it by load_account
+            m = Meter(id=account_number, account_number=account_number, balance=0, status='Pending')
             meter_key = m.put()
-            # Generate fake History TODO: TEMP!!
-            history = jmas_api.FakeHistory(meter_key, 6, 9321)
-            # Get and save historic bills
-            bills = history.bills
-            Bill.save_history_to_datastore(meter_key, bills)
-            # Get and save historic readings
-            measurements = history.readings
-            Reading.save_history_to_datastore(meter_key, measurements)
+            # Onboarding (JMAS data, historic bills and readings) runs in a task enqueued only if this
+            # transaction commits
+            history.schedule(account_number)
         except Exception as e:
-            raise MeterCreationError('Error in transactional create: '+e.__str__())
+            raise errors.wrap(MeterCreationError, 'Error in transactional create: ', e)
         else:
             logging.debug('[Meter] - New Meter Key = {0}'.format(meter_key))
 
+    @classmethod
+    def load_account(cls, account_number):
+        """
+        Onboarding stage: fetches the balance and model of a Pending meter from JMAS, then stores them in a
+        short transaction. The JMAS call is made outside the transaction. The balance is added to the one the
+        meter accumulated while Pending. Does nothing if the meter already has its JMAS data.
+
+        Args:
+            account_number: (String) account number of the meter
+        """
+        m = Meter.get_key(account_number).get()
+        if m is None:
+            raise GetMeterError('Meter does not exist', errors.NOT_FOUND)
+        if m.model is not None:
+            return
+        account = jmas_api.client.get_account(account_number)
+
+        @ndb.transactional(retries=BALANCE_TRANSACTION_RETRIES)
+        def txn():
+            meter = Meter.get_key(account_number).get()
+            if meter.model is not None:
+                return
+            meter.balance = (meter.balance or 0) + account['balance']
+            meter.model = account['model']
+            meter.put()
+
+        txn()
+        Meter.invalidate(account_number)
+
+    @classmethod
+    def set_status(cls, account_number, status):
+        """
+        Sets the onboarding status of a meter
+
+        Args:
+            account_number: (String) account number of the meter
+            status: (String) Pending, Ready or Failed
+        """
+        @ndb.transactional(retries=BALANCE_TRANSACTION_RETRIES)
+        def txn():
+            meter = Meter.get_key(account_number).get()
+            if meter is not None and meter.status != status:
+                meter.status = status
+                meter.put()
+
+        txn()
+        Meter.invalidate(account_number)
+
+    @classmethod
+    def create_batch(cls, account_numbers):
+        """
+        Creates many Pending meters at once, without calling JMAS. Meters are written with put_multi in
+        transactions of METERS_PER_TRANSACTION, each one also enqueuing the onboarding (JMAS data and history
+        import) of its meters. A failure of one account does not stop the others.
+
+        Args:
+            account_numbers: (List) of Strings, at most MAX_METERS_PER_BATCH
+
+        Returns:
+            An OrderedDict {account_number: None if created, the MeterCreationError otherwise}, in request order
+        """
+        if len(account_numbers) > MAX_METERS_PER_BATCH:
+            raise MeterCreationError('Too many meters in batch: {0}, max {1}'
+                                     .format(len(account_numbers), MAX_METERS_PER_BATCH), errors.INVALID_ARGUMENT)
+        results = collections.OrderedDict((a, None) for a in account_numbers)
+        existing = ndb.get_multi([Meter.get_key(a) for a in results])
+        for account_number, m in zip(results.keys(), existing):
+            if m is not None or Meter.migrate_legacy(account_number) is not None:
+                results[account_number] = MeterCreationError('Meter account number already in platform',
+                                                             errors.ALREADY_EXISTS)
+
+        # Created Pending, the JMAS balance and model are added by the onboarding task (see load_account)
+        meters = [Meter(id=a, account_number=a, balance=0, status='Pending')
+                  for a, error in results.items() if error is None]
+
+        created = []
+        for start in xrange(0, len(meters), METERS_PER_TRANSACTION):
+            group = meters[start:start+METERS_PER_TRANSACTION]
+            try:
+                created.extend(Meter._put_new(group))
+            except Exception as e:
+                error = errors.wrap(MeterCreationError, 'Error in transactional create: ', e)
+                for m in group:
+                    results[m.account_number] = error
+        stored = set(created)
+        for m in meters:
+            # Created by another request since the first get_multi
+            if m.account_number not in stored and results[m.account_number] is None:
+                results[m.account_number] = MeterCreationError('Meter account number already in platform',
+                                                               errors.ALREADY_EXISTS)
+        logging.debug('[Meter] - create_batch(): {0} requested, {1} created'.format(len(results), len(created)))
+        return results
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _put_new(cls, meters):
+        """
+        Stores the meters that do not exist yet and schedules their onboarding, in a single transaction: the
+        meters are never stored without the task that onboards them.
+
+        Returns:
+            List with the account numbers of the meters stored
+        """
+        current = ndb.get_multi([m.key for m in meters])
+        new = [m for m, c in zip(meters, current) if c is None]
+        ndb.put_multi(new)
+        account_numbers = [m.account_number for m in new]
+        if account_numbers:
+            history.schedule_batch(account_numbers)
+        return account_numbers
+
     @classmethod
     def get_all_from_datastore(cls, user):
         """
@@ -93,44 +263,50 @@ class Meter(ndb.Model):
         Args:
             user: (String) email
         Returns:
-            A List with all the meters assigned to a user
+            A List with all the meters assigned to a user, empty if the user has none
         """
         try:
             u = User.get_from_datastore(user)
-            query_response = Meter.query(Meter.user == u.key).fetch()
-            if query_response:
-                resp = []
-                for b in query_response:
-                    resp.append(b)
-            else:
-                raise GetMeterError('No Meters found under specified criteria: User: {0}'
-                                    .format(user))
+            resp = Meter.query(Meter.user == u.key).fetch()
         except Exception as e:
-                raise GetMeterError('Error getting Meter: '+e.__str__())
+            raise errors.wrap(GetMeterError, 'Error getting Meter: ', e)
         else:
             for r in resp:
                 logging.debug("[Meter] = {0}".format(r))
             return resp
 
     @classmethod
-    def get_from_datastore(cls, account_number):
+    def invalidate(cls, account_number):
+        """
+        Drops a meter from the read-through cache. Must be called after every write of a Meter.
+
+        Args:
+            account_number: (String) account number of the meter
+        """
+        cache.meters.invalidate(Meter.get_key(account_number))
+
+    @classmethod
+    def get_from_datastore(cls, account_number, use_cache=True):
         """
-        Gets meter from datastore based on account number
+        Gets meter from datastore based on account number. Writers should pass use_cache=False so the
+        read-modify-write starts from the datastore and not from a possibly stale cached copy.
         """
         try:
-            if Meter.exists(account_number):
-                m = Meter.query(Meter.account_number == account_number).fetch(limit=1)
-            else:
-                raise GetMeterError('Meter does not exist')
+            key = Meter.get_key(account_number)
+            m = cache.meters.get(key) if use_cache else key.get()
+            if m is None:
+                m = Meter.migrate_legacy(account_number)
+            if m is None:
+                raise GetMeterError('Meter does not exist', errors.NOT_FOUND)
         except Exception as e:
-            raise GetMeterError('Error getting meter: '+e.__str__())
+            raise errors.wrap(GetMeterError, 'Error getting meter: ', e)
         else:
-            logging.debug("[Meter] - Key = {0}".format(m[0].key))
-            logging.debug("[Meter] - User Key = {0}".format(m[0].user))
-            logging.debug("[Meter] - Account Number = {0}".format(m[0].account_number))
-            logging.debug("[Meter] - Balance = {0}".format(m[0].balance))
-            logging.debug("[Meter] - Model = {0}".format(m[0].model))
-            return m[0]
+            logging.debug("[Meter] - Key = {0}".format(m.key))
+            logging.debug("[Meter] - User Key = {0}".format(m.user))
+            logging.debug("[Meter] - Account Number = {0}".format(m.account_number))
+            logging.debug("[Meter] - Balance = {0}".format(m.balance))
+            logging.debug("[Meter] - Model = {0}".format(m.model))
+            return m
 
     @classmethod
     def assign_to_user(cls, email, account_number):
@@ -146,11 +322,11 @@ class Meter(ndb.Model):
         """
         try:
             u = User.get_from_datastore(email)
-            m = Meter.get_from_datastore(account_number)
-
-            meter = m.key.get()
+            meter = Meter.get_from_datastore(account_number, use_cache=False)
             meter.user = u.key
+            meter.installation_id = u.installation_id
             meter.put()
+            Meter.invalidate(account_number)
         except GetUserError:
             raise
         except GetMeterError:
@@ -173,17 +349,94 @@ class Meter(ndb.Model):
             True if assignment successful, False otherwise
         """
         try:
-            m = Meter.get_from_datastore(account_number)
-
-            meter = m.key.get()
+            meter = Meter.get_from_datastore(account_number, use_cache=False)
             meter.balance = new_balance
             meter.put()
+            Meter.invalidate(account_number)
         except Exception:
             # FIXME rise exception for error handling
             return False
         else:
             return True
 
+    @classmethod
+    def mutate_balance(cls, account_number, build_change):
+        """
+        Applies a signed delta to the balance of a meter and stores the entities generated by the change
+        (a Reading, a Bill, a Prepay...) in the same transaction as the meter. The meter is read once, inside
+        the transaction, and the transaction is retried on contention so concurrent changes are not lost.
+
+        Args:
+            account_number: (String) account number of the meter
+            build_change: function(meter) -> (delta, [entities]) called inside the transaction with the
+                current meter. Return None to leave the meter untouched, raise to abort. May be called
+                more than once if the transaction is retried, so its only side effects may be transactional
+                task adds.
+
+        Returns:
+            (meter, entities) as committed, None if build_change returned None
+        """
+        @ndb.transactional(xg=True, retries=BALANCE_TRANSACTION_RETRIES)
+        def txn():
+            meter = Meter.get_key(account_number).get()
+            if meter is None:
+                raise GetMeterError('Meter does not exist', errors.NOT_FOUND)
+            change = build_change(meter)
+            if change is None:
+                return None
+            delta, entities = change
+            meter.balance += delta
+            ndb.put_multi([meter] + list(entities))
+            return meter, entities
+
+        result = txn()
+        if result is not None:
+            Meter.invalidate(account_number)
+        return result
+
+    def set_last_reading(self, reading):
+        """
+        Updates the last reading snapshot if the reading is newer than the current one. Does not put the meter.
+
+        Args:
+            reading: (Reading) with key, date and measure
+
+        Returns:
+            True if the snapshot changed, False otherwise
+        """
+        if self.last_reading_date is not None and reading.date < self.last_reading_date:
+            return False
+        self.last_measure = reading.measure
+        self.last_reading_date = reading.date
+        self.last_reading_key = reading.key
+        return True
+
+    @classmethod
+    def update_last_reading(cls, account_number, reading):
+        """
+        Transactionally updates the last reading snapshot of a meter with an already stored reading
+        (history import, backfill).
+
+        Args:
+            account_number: (String) account number of the meter
+            reading: (Reading) with key, date and measure
+
+        Returns:
+            True if the snapshot changed, False otherwise
+        """
+        @ndb.transactional(retries=BALANCE_TRANSACTION_RETRIES)
+        def txn():
+            meter = Meter.get_key(account_number).get()
+            if meter is None or not meter.set_last_reading(reading):
+                return False
+            meter.put()
+            return True
+
+        changed = txn()
+        if changed:
+            Meter.invalidate(account_number)
+        return changed
+
     @classmethod
     def get_balance(cls, account_number):
         """
@@ -195,7 +448,8 @@ class Meter(ndb.Model):
         Returns:
             (Int) balance
         """
-        m = Meter.get_from_datastore(account_number)
+        # Callers use the balance to compute the next one, never serve it from the cache
+        m = Meter.get_from_datastore(account_number, use_cache=False)
 
         return m.balance
 
@@ -211,12 +465,12 @@ class Meter(ndb.Model):
         Returns:
             True if assignment successful, False otherwise
         """
-        m = Meter.get_from_datastore(account_number)
+        meter = Meter.get_from_datastore(account_number, use_cache=False)
 
         try:
-            meter = m.key.get()
             meter.model = new_model
             meter.put()
+            Meter.invalidate(account_number)
         except Exception:
             # FIXME rise exception for error handling
             return False
@@ -239,18 +493,9 @@ class Meter(ndb.Model):
         return m.model
 
 
-class MeterCreationError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Meter] - '+value, exc_info=True)
-
-    def __str__(self):
-        return repr(self.value)
-
+class MeterCreationError(errors.PlatformError):
+    pass
 
-class GetMeterError(Exception):
-    def __init__(self, value):
-        self.value = value
 
-    def __str__(self):
-        return repr(self.value)
+class GetMeterError(errors.PlatformError):
+    pass
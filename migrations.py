@@ -0,0 +1,246 @@
+"""
+Resumable data migrations for the OCR platform. Each migration walks a kind with query cursors,
+processes one page per deferred task and checkpoints its cursor in a MigrationState entity so that
+it can be resumed after a failure.
+"""
+__author__ = 'Cesar'
+
+import logging
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.datastore.datastore_query import Cursor
+from meter import Meter
+from user import User
+import consumption
+import errors
+
+MIGRATION_QUEUE = 'migrations'
+MIGRATION_BATCH_SIZE = 100
+# Passes over the children of a re-keyed meter before its old key is deleted, the last one must find none
+REKEY_PASSES = 3
+
+# Migrations known to be done by this instance
+_done = set()
+
+
+class MigrationState(ndb.Model):
+    """
+    Checkpoint of a migration run. Keyed by the migration name.
+
+        - cursor: urlsafe cursor of the next page to process.
+        - processed: number of entities visited so far.
+        - migrated: number of entities that actually needed changes.
+        - done: True once the last page has been processed.
+    """
+    cursor = ndb.StringProperty(indexed=False)
+    processed = ndb.IntegerProperty(default=0)
+    migrated = ndb.IntegerProperty(default=0)
+    done = ndb.BooleanProperty(default=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+def rekey_meter(legacy):
+    """
+    Moves a meter stored under an auto generated id to the key derived from its account number and
+    re-points every Reading, Bill and Prepay that referenced the old key. The children are found with an
+    eventually consistent query, so the old meter is only deleted once a new pass finds none left.
+        :param legacy: Meter entity stored under the old key
+        :return: True if the meter was migrated, False if it was already keyed by account number
+    """
+    new_key = Meter.get_key(legacy.account_number)
+    if legacy.key == new_key:
+        return False
+
+    if new_key.get() is None:
+        Meter(key=new_key, **legacy.to_dict()).put()
+
+    for _ in xrange(REKEY_PASSES):
+        if not _repoint_children(legacy.key, new_key):
+            break
+    else:
+        # Let the task retry once the index has caught up
+        raise MigrationError('Meter {0}: children still point to {1}'.format(legacy.account_number, legacy.key),
+                             errors.UNAVAILABLE)
+
+    legacy.key.delete()
+    Meter.invalidate(legacy.account_number)
+    logging.debug('[Migrations] - Meter {0} re-keyed from {1} to {2}'.format(legacy.account_number,
+                                                                             legacy.key, new_key))
+    return True
+
+
+def _repoint_children(old_key, new_key):
+    """
+    Points every Reading, Bill and Prepay of the meter old_key to new_key.
+        :return: number of children found still pointing to old_key
+    """
+    # Import in the function to avoid circular import
+    from reading import Reading
+    from bill import Bill
+    from prepay import Prepay
+
+    moved = 0
+    for model in (Reading, Bill, Prepay):
+        cursor = None
+        more = True
+        while more:
+            children, cursor, more = model.query(model.meter == old_key).fetch_page(MIGRATION_BATCH_SIZE,
+                                                                                    start_cursor=cursor)
+            for child in children:
+                child.meter = new_key
+            ndb.put_multi(children)
+            moved += len(children)
+    return moved
+
+
+def is_done(name):
+    """
+    :param name: (String) one of MIGRATIONS
+    :return: True if the migration has processed its last page
+    """
+    if name in _done:
+        return True
+    state = MigrationState.get_by_id(name)
+    if state is not None and state.done:
+        # A finished migration stays finished, no need to read it again in this instance
+        _done.add(name)
+        return True
+    return False
+
+
+def _rekey_user(legacy):
+    """
+    Moves a user stored under an auto generated id to the key derived from its normalized email,
+    re-points the meters assigned to it and copies its installation id onto those meters.
+        :param legacy: User entity
+        :return: True if the user or any of its meters changed, False otherwise
+    """
+    new_key = User.get_key(legacy.email)
+    target = legacy
+    changed = False
+    if legacy.key != new_key:
+        target = new_key.get()
+        if target is None:
+            values = legacy.to_dict()
+            values['email'] = new_key.id()
+            target = User(key=new_key, **values)
+            target.put()
+        changed = True
+
+    cursor = None
+    more = True
+    while more:
+        meters, cursor, more = Meter.query(Meter.user == legacy.key).fetch_page(MIGRATION_BATCH_SIZE,
+                                                                                start_cursor=cursor)
+        stale = [m for m in meters if m.user != new_key or m.installation_id != target.installation_id]
+        for m in stale:
+            m.user = new_key
+            m.installation_id = target.installation_id
+        ndb.put_multi(stale)
+        for m in stale:
+            Meter.invalidate(m.account_number)
+        changed = changed or bool(stale)
+
+    if legacy.key != new_key:
+        legacy.key.delete()
+        logging.debug('[Migrations] - User {0} re-keyed from {1} to {2}'.format(legacy.email, legacy.key, new_key))
+    return changed
+
+
+def _backfill_last_reading(meter):
+    """
+    Populates the last reading snapshot of a meter from its newest Reading.
+        :param meter: Meter entity
+        :return: True if the snapshot changed, False otherwise
+    """
+    # Import in the function to avoid circular import
+    from reading import Reading
+
+    if meter.key != Meter.get_key(meter.account_number):
+        # Not re-keyed yet (see meter_keys)
+        return False
+    last = Reading.query(Reading.meter == meter.key).order(-Reading.date).get()
+    if last is None:
+        return False
+    return Meter.update_last_reading(meter.account_number, last)
+
+
+def _rebuild_consumption(meter):
+    """
+    Recomputes the daily and monthly consumption rollups of a meter from its readings. Safe on live meters,
+    see consumption.rebuild.
+        :param meter: Meter entity
+        :return: True if the meter has rollups
+    """
+    if meter.key != Meter.get_key(meter.account_number):
+        # Not re-keyed yet (see meter_keys)
+        return False
+    if meter.status == 'Pending':
+        # The history import adds the readings of the meter to its rollups
+        return False
+    return consumption.rebuild(meter.account_number) > 0
+
+
+MIGRATIONS = {
+    'meter_keys': (Meter, rekey_meter),
+    'user_keys': (User, _rekey_user),
+    'meter_last_reading': (Meter, _backfill_last_reading),
+    'consumption_rollups': (Meter, _rebuild_consumption),
+}
+
+
+def start(name, restart=False):
+    """
+    Starts (or resumes from its last checkpoint) a migration.
+        :param name: (String) one of MIGRATIONS
+        :param restart: (Boolean) discard the checkpoint and start from the beginning
+        :return: MigrationState of the run
+    """
+    if name not in MIGRATIONS:
+        raise MigrationError('Unknown migration: {0}'.format(name), errors.NOT_FOUND)
+    state = MigrationState.get_or_insert(name)
+    if restart:
+        _done.discard(name)
+        state.cursor = None
+        state.processed = 0
+        state.migrated = 0
+        state.done = False
+        state.put()
+    if not state.done:
+        deferred.defer(run_page, name, _queue=MIGRATION_QUEUE)
+    return state
+
+
+def run_page(name, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    Processes one page of a migration and chains the next one. Safe to run more than once for the same
+    page: every migration function is idempotent.
+        :param name: (String) one of MIGRATIONS
+        :param batch_size: (Integer) entities per page
+    """
+    model, migrate = MIGRATIONS[name]
+    state = MigrationState.get_or_insert(name)
+    if state.done:
+        return
+
+    start_cursor = Cursor(urlsafe=state.cursor) if state.cursor else None
+    entities, next_cursor, more = model.query().fetch_page(batch_size, start_cursor=start_cursor)
+    migrated = 0
+    for entity in entities:
+        if migrate(entity):
+            migrated += 1
+
+    state.cursor = next_cursor.urlsafe() if next_cursor else None
+    state.processed += len(entities)
+    state.migrated += migrated
+    state.done = not more
+    state.put()
+    logging.info('[Migrations] - {0}: processed = {1} migrated = {2} done = {3}'
+                 .format(name, state.processed, state.migrated, state.done))
+
+    if more:
+        deferred.defer(run_page, name, batch_size=batch_size, _queue=MIGRATION_QUEUE)
+
+
+class MigrationError(errors.PlatformError):
+    pass
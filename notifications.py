@@ -0,0 +1,247 @@
+"""
+Push notifications dispatch. Request handlers only add notifications to the push-outbox pull queue and make
+sure a dispatch task is scheduled. The dispatch task (see tasks.py) leases the pending notifications, collapses
+duplicates, sends them to Parse in /1/batch requests and deletes the delivered ones. Notifications that fail
+stay in the outbox with their lease extended exponentially with their attempts (see _back_off), so a Parse
+outage is retried with growing, spread out delays; after MAX_PUSH_ATTEMPTS they are stored as a PushDeadLetter.
+"""
+__author__ = 'Cesar'
+
+import collections
+import json
+import logging
+import random
+import threading
+import time
+from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.api import taskqueue
+from parse_api import PushBatch
+
+OUTBOX_QUEUE = 'push-outbox'
+DISPATCH_QUEUE = 'push-notifications'
+DISPATCH_TASK_URL = '/tasks/push/dispatch'
+# Notifications queued within the same window are sent by the same dispatch task
+DISPATCH_WINDOW_SECONDS = 5
+# Identical notifications for the same installation queued within this window are sent once
+COLLAPSE_WINDOW_SECONDS = 60
+# Seconds the notifications leased by a dispatch are reserved for it
+LEASE_SECONDS = 60
+# A failed notification waits RETRY_BASE_SECONDS * 2^(attempts - 1), at most MAX_RETRY_SECONDS, before it is
+# retried: the attempts span about two hours
+RETRY_BASE_SECONDS = 60
+MAX_RETRY_SECONDS = 3600
+MAX_LEASED_PER_DISPATCH = 1000
+BATCH_SIZE = PushBatch.Max_Size
+MAX_PUSH_ATTEMPTS = 8
+LATENCY_SAMPLES = 1000
+
+
+class PushDeadLetter(ndb.Model):
+    """
+    A push notification that could not be delivered to Parse after MAX_PUSH_ATTEMPTS.
+
+        - installation_id: Parse installation id of the recipient.
+        - title, message: content of the notification.
+        - attempts: number of delivery attempts.
+        - error: reason of the last failure.
+    """
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    installation_id = ndb.StringProperty()
+    title = ndb.StringProperty(indexed=False)
+    message = ndb.TextProperty()
+    attempts = ndb.IntegerProperty()
+    error = ndb.TextProperty()
+
+
+class DeliveryStats(object):
+    """
+    Delivery metrics of this instance: batch sizes, collapsed duplicates, failures and the latency between
+    the moment a notification is queued and the moment Parse accepts it.
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=samples)
+        self._counters = dict.fromkeys(['batches', 'delivered', 'collapsed', 'failed', 'dead_lettered'], 0)
+        self._max_batch_size = 0
+
+    def record_batch(self, size, latencies):
+        with self._lock:
+            self._counters['batches'] += 1
+            self._counters['delivered'] += len(latencies)
+            self._max_batch_size = max(self._max_batch_size, size)
+            self._latencies.extend(latencies)
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] += value
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._counters)
+            latencies = sorted(self._latencies)
+            s['max_batch_size'] = self._max_batch_size
+        s['mean_batch_size'] = float(s['delivered']) / s['batches'] if s['batches'] else 0.0
+        if latencies:
+            s['latency_p50'] = latencies[len(latencies) / 2]
+            s['latency_p99'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return s
+
+
+delivery_stats = DeliveryStats()
+
+
+def _task(installation_id, title, message):
+    return taskqueue.Task(payload=json.dumps({'installation_id': installation_id,
+                                              'title': title,
+                                              'message': message,
+                                              'queued': time.time()}),
+                          method='PULL')
+
+
+def _schedule_dispatch(countdown=DISPATCH_WINDOW_SECONDS):
+    """
+    Adds the dispatch task of the window in which it will run. The task is named after that window, so only
+    the first caller of each window actually adds it.
+    """
+    window = int((time.time() + countdown) / DISPATCH_WINDOW_SECONDS)
+    try:
+        taskqueue.Queue(DISPATCH_QUEUE).add(taskqueue.Task(url=DISPATCH_TASK_URL,
+                                                           name='dispatch-{0}'.format(window),
+                                                           countdown=countdown))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def enqueue(installation_id, title, message):
+    """
+    Queues a push notification for background delivery. Inside a transaction the notification is only
+    queued if the transaction commits.
+        :param installation_id: Parse installation id of the recipient
+        :param title: (String)
+        :param message: (String)
+    """
+    taskqueue.Queue(OUTBOX_QUEUE).add(_task(installation_id, title, message), transactional=ndb.in_transaction())
+    _schedule_dispatch()
+    logging.debug('[Notifications] - Push queued for installation_id = {0}'.format(installation_id))
+
+
+def enqueue_multi(notifications):
+    """
+    Queues several push notifications, taskqueue.MAX_TASKS_PER_ADD per call. Inside a transaction, which takes
+    at most 5 transactional tasks, a single task that queues them all is added and only if the transaction
+    commits.
+        :param notifications: (List) of (installation_id, title, message) tuples
+    """
+    if not notifications:
+        return
+    if ndb.in_transaction():
+        deferred.defer(enqueue_multi, notifications, _queue=DISPATCH_QUEUE, _transactional=True)
+        return
+    tasks = [_task(*n) for n in notifications]
+    q = taskqueue.Queue(OUTBOX_QUEUE)
+    for start in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        q.add(tasks[start:start+taskqueue.MAX_TASKS_PER_ADD])
+    _schedule_dispatch()
+    logging.debug('[Notifications] - {0} Push queued'.format(len(tasks)))
+
+
+def dispatch(max_tasks=MAX_LEASED_PER_DISPATCH, batch_size=BATCH_SIZE):
+    """
+    Delivers the pending notifications of the outbox. Called by the dispatch task handler.
+        :param max_tasks: (Integer) notifications leased from the outbox
+        :param batch_size: (Integer) notifications per Parse batch request (at most PushBatch.Max_Size)
+        :return: number of notifications delivered
+    """
+    batch_size = min(batch_size, PushBatch.Max_Size)
+    q = taskqueue.Queue(OUTBOX_QUEUE)
+    leased = q.lease_tasks(LEASE_SECONDS, max_tasks)
+    if not leased:
+        return 0
+    if len(leased) == max_tasks:
+        # The outbox may hold more, keep draining
+        taskqueue.Queue(DISPATCH_QUEUE).add(taskqueue.Task(url=DISPATCH_TASK_URL))
+
+    # Collapse duplicates: the same notification for the same installation is sent once per window
+    pending = collections.OrderedDict()
+    for task in leased:
+        n = json.loads(task.payload)
+        notification = (n['installation_id'], n['title'], n['message'], int(n['queued'] / COLLAPSE_WINDOW_SECONDS))
+        pending.setdefault(notification, []).append((task, n['queued']))
+    delivery_stats.count('collapsed', len(leased) - len(pending))
+
+    done = []
+    retry_delays = []
+    items = pending.items()
+    for start in xrange(0, len(items), batch_size):
+        chunk = items[start:start+batch_size]
+        batch = PushBatch()
+        for notification, tasks in chunk:
+            batch.add(*notification[:3])
+        try:
+            errors = batch.send()
+        except Exception as e:
+            errors = [e.__str__()] * len(chunk)
+        now = time.time()
+        latencies = []
+        for (notification, tasks), error in zip(chunk, errors):
+            if error is None:
+                done.extend(task for task, queued in tasks)
+                latencies.append(now - min(queued for task, queued in tasks))
+            else:
+                delivery_stats.count('failed')
+                finished = _dead_letter(notification, tasks, error)
+                done.extend(finished)
+                if not finished:
+                    retry_delays.append(_back_off(q, tasks))
+        delivery_stats.record_batch(len(chunk), latencies)
+
+    if done:
+        q.delete_tasks(done)
+    if retry_delays:
+        # Failed notifications become available again once their extended lease expires
+        _schedule_dispatch(countdown=min(retry_delays))
+    logging.debug('[Notifications] - Dispatch: leased = {0} unique = {1} finished = {2}'
+                  .format(len(leased), len(pending), len(done)))
+    return len(done)
+
+
+def _attempts(tasks):
+    """
+    :return: delivery attempts of a notification, including the current one
+    """
+    return max(task.retry_count for task, queued in tasks) + 1
+
+
+def _back_off(q, tasks):
+    """
+    Extends the lease of the tasks of a failed notification, exponentially with its attempts and with jitter so
+    the notifications that failed together are not all retried at the same moment.
+        :return: seconds until the notification is available again
+    """
+    delay = min(RETRY_BASE_SECONDS * 2 ** (_attempts(tasks) - 1), MAX_RETRY_SECONDS)
+    delay = max(1, int(delay * random.uniform(0.5, 1)))
+    for task, queued in tasks:
+        q.modify_task_lease(task, delay)
+    return delay
+
+
+def _dead_letter(notification, tasks, error):
+    """
+    Stores the notification as a PushDeadLetter if it ran out of attempts.
+        :return: the tasks to delete from the outbox (empty if the notification will be retried)
+    """
+    attempts = _attempts(tasks)
+    if attempts < MAX_PUSH_ATTEMPTS:
+        logging.warning('[Notifications] - Push attempt {0} failed, will retry: {1}'.format(attempts, error))
+        return []
+    installation_id, title, message = notification[:3]
+    PushDeadLetter(installation_id=installation_id,
+                   title=title,
+                   message=message,
+                   attempts=attempts,
+                   error='{0}'.format(error)).put()
+    delivery_stats.count('dead_lettered')
+    logging.error('[Notifications] - Push dead lettered after {0} attempts: {1}'.format(attempts, error))
+    return [task for task, queued in tasks]
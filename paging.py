@@ -0,0 +1,44 @@
+"""
+Paging of the list endpoints: one page of a query per call, continued with the urlsafe cursor returned with the
+previous page. Page size and cursor are validated here, so every model answers a bad one the same way.
+"""
+__author__ = 'Cesar'
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+import errors
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def fetch_page(query, page_size, cursor, error_class, **options):
+    """
+    Fetches one page of a query.
+        :param query: ndb Query, ordered
+        :param page_size: (Integer) None for DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE are fetched
+        :param cursor: (String) urlsafe cursor returned with the previous page, None for the first page
+        :param error_class: PlatformError subclass of the caller
+        :param options: query options of fetch_page (keys_only...)
+        :return: (results, next_cursor, more): the List of results of the page, the urlsafe cursor of the next page
+                 (None on the last one) and True if there may be more pages
+        :exception error_class INVALID_ARGUMENT if the page size is negative or the cursor is not a cursor of
+                   this query
+    """
+    if page_size is not None and page_size < 0:
+        raise error_class('Invalid page size: {0}'.format(page_size), errors.INVALID_ARGUMENT)
+    start_cursor = None
+    if cursor:
+        try:
+            start_cursor = Cursor(urlsafe=cursor)
+        except datastore_errors.BadValueError:
+            raise error_class('Invalid cursor: {0}'.format(cursor), errors.INVALID_ARGUMENT)
+    try:
+        results, next_cursor, more = query.fetch_page(min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE),
+                                                      start_cursor=start_cursor, **options)
+    except datastore_errors.BadRequestError:
+        if start_cursor is None:
+            raise
+        # A well formed cursor of another query
+        raise error_class('Invalid cursor: {0}'.format(cursor), errors.INVALID_ARGUMENT)
+    return results, next_cursor.urlsafe() if next_cursor and more else None, more
@@ -5,55 +5,80 @@ Parse backend interface
 __author__ = 'cesar'
 
 import logging
+import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import instrumentation
 
-REST_API_URL = "https://api.parse.com"
-REST_API_Port = '443'
+# Overridable so local runs can point to a stand-in server (see fake_parse.py)
+REST_API_URL = os.environ.get('PARSE_API_URL', "https://api.parse.com")
+REST_API_Port = os.environ.get('PARSE_API_PORT', '443')
 Application_Id = 'vewdKbKAPt6y9ufviEEYHlq62dXhlEAPldiwNi5P'
 REST_API_Key = 'XBs6U4aoAgNCZtXnupadG7b74UvglZGCPvOu2x8C'
+REQUEST_TIMEOUT_SECONDS = 10
 
+# One pooled session per instance, connections to Parse are reused across requests
+_session = requests.Session()
+_session.headers.update({'X-Parse-Application-Id': Application_Id,
+                         'X-Parse-REST-API-Key': REST_API_Key,
+                         'Content-Type': 'application/json'})
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=10))
+_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=10))
 
-class Push():
+
+def _push_body(installation_id, title, message):
+    return {"where": {"installationId": installation_id},
+            "data": {"alert": "{0}".format(message),
+                     "title": "{0}".format(title)}}
+
+
+class PushBatch():
     """
-    Defines a Push notification using Parse backend
+    Sends several Push notifications in a single Parse batch request
     """
 
+    Batch_URI = '/1/batch'
     Push_URI = '/1/push'
-    Installation_Id = None
+    # Parse rejects batches with more than 50 requests
+    Max_Size = 50
 
-    def __init__(self, installation_id):
+    def __init__(self):
+        self.notifications = []
+
+    def add(self, installation_id, title, message):
         """
-        Push object constructor. Gets the installation_id to identify the recipient of the Push notification.
-            :param: installation_ind: Parse identification of a particular User app installation
-            :return: True if successful Exception otherwise
+        Adds a notification to the batch.
+            :param: installation_id: Parse identification of a particular User app installation
+            :return: False if the batch is already full, True otherwise
         """
-        self.Installation_Id = installation_id
+        if len(self.notifications) >= self.Max_Size:
+            return False
+        self.notifications.append((installation_id, title, message))
+        return True
 
-    def send(self, title, message):
+    def send(self):
         """
-        Push object constructor. Gets the installation_id to identify the recipient of the Push notification.
-            :param: installation_ind: Parse identification of a particular User app installation
-            :return: A push object.
+        Sends the batch to Parse.
+            :return: List with one entry per notification, in order: None if delivered, the error otherwise.
+            :exception if the whole batch request failed
         """
         try:
-            headers = {'X-Parse-Application-Id': Application_Id,
-                       'X-Parse-REST-API-Key': REST_API_Key,
-                       'Content-Type': 'application/json'}
-
-            payload = json.dumps({"where": {"installationId": self.Installation_Id},
-                                  "data": {"alert": "{0}".format(message),
-                                           "title": "{0}".format(title)}})
+            payload = json.dumps({"requests": [{"method": "POST",
+                                                "path": PushBatch.Push_URI,
+                                                "body": _push_body(*n)}
+                                               for n in self.notifications]})
 
-            r = requests.post("{0}:{1}{2}".format(REST_API_URL, REST_API_Port, self.Push_URI),
+            instrumentation.count_http('parse')
+            r = _session.post("{0}:{1}{2}".format(REST_API_URL, REST_API_Port, self.Batch_URI),
                               data=payload,
-                              headers=headers)
+                              timeout=REQUEST_TIMEOUT_SECONDS)
         except Exception as e:
-            logging.error('Error sending Push notification to Parse: {0}'.format(e.__str__()))
-            raise Exception
+            logging.error('Error sending Push batch to Parse: {0}'.format(e.__str__()))
+            raise Exception('Error sending Push batch to Parse: {0}'.format(e.__str__()))
         else:
             if r.status_code == 200:
-                return True
+                return [None if 'success' in result else result.get('error', result) for result in r.json()]
             else:
-                logging.error('Error response to Push notification request: {0}'.format(r.status_code))
-                raise Exception
\ No newline at end of file
+                logging.error('Error response to Push batch request: {0}'.format(r.status_code))
+                raise Exception('Error response to Push batch request: {0}'.format(r.status_code))
@@ -8,6 +8,7 @@ import logging
 from google.appengine.ext import ndb
 from meter import Meter, GetMeterError
 import jmas_api
+import errors
 
 
 class Prepay(ndb.Model):
@@ -33,20 +34,13 @@ class Prepay(ndb.Model):
         Args:
             account_number: (String)
         Returns:
-            A List with all the prepay events that match the criteria
+            A List with all the prepay events that match the criteria, empty if there are none
         """
         try:
             meter = Meter.get_from_datastore(account_number)
-            query_response = Prepay.query(ndb.AND(Prepay.meter == meter.key)).fetch()
-            if query_response:
-                resp = []
-                for p in query_response:
-                    resp.append(p)
-            else:
-                raise GetPrepayError('No Prepay events found under specified criteria: Account Number: {0}'
-                                     .format(account_number))
+            resp = Prepay.query(ndb.AND(Prepay.meter == meter.key)).fetch()
         except Exception as e:
-                raise GetPrepayError('Error getting prepay: '+e.__str__())
+            raise errors.wrap(GetPrepayError, 'Error getting prepay: ', e)
         else:
             for r in resp:
                 logging.debug("[Prepay] = {0}".format(r))
@@ -67,58 +61,38 @@ class Prepay(ndb.Model):
 
         """
         try:
-            m = Meter.get_from_datastore(meter)
-            if m.balance <= 0:
-                factor = jmas_api.get_prepay_conversion_factor()
-                calculated_amount = m3_to_prepay*factor
+            factor = jmas_api.get_prepay_conversion_factor()
+
+            def build_prepay(m):
+                if m.balance > 0:
+                    raise PrepayCreationError('Positive Balance, pay first! Current Balance: {0} <= 0 '
+                                              .format(m.balance), errors.POSITIVE_BALANCE)
                 p = Prepay(
                     meter=m.key,
                     balance=m.balance,
                     prepay=m3_to_prepay,
-                    amount=calculated_amount)
-                key = p.put()
-            else:
-                raise PrepayCreationError('Positive Balance, pay first! Current Balance: {0} <= 0 '.format(m.balance))
+                    amount=m3_to_prepay*factor)
+                return -p.prepay, [p]
+
+            m, (p,) = Meter.mutate_balance(meter, build_prepay)
         except Exception as e:
-            logging.exception("[Prepay] - "+e.message)
-            raise PrepayCreationError('Error creating the prepay event in datastore: '+e.__str__())
+            raise errors.wrap(PrepayCreationError, 'Error creating the prepay event in datastore: ', e)
         else:
-            # Update balance in datastore
-            current_balance = Meter.get_balance(m.account_number)
-            new_balance = current_balance - p.prepay
-            # FIXME handle exception from Meter class
-            Meter.set_balance(m.account_number, new_balance)
-
             logging.debug('[Prepay] - Prepay with Key = {0} - Amount: ${1} = (m3 to Prepay = {2})*(Factor = {3})'
-                          .format(key, calculated_amount, m3_to_prepay, factor))
+                          .format(p.key, p.amount, m3_to_prepay, factor))
             logging.debug('[Prepay] - New Balance: {0} = (Old Balance = {1}) - (Prepay = {2})'
-                          .format(new_balance, current_balance, p.prepay))
+                          .format(m.balance, m.balance + p.prepay, p.prepay))
 
             return True
 
 
-class PrepayCreationError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Prepay] - Creation Error: '+value, exc_info=True)
-
-    def __str__(self):
-        return repr(self.value)
-
-
-class GetPrepayError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Prepay] - Get Error: '+value, exc_info=True)
+class PrepayCreationError(errors.PlatformError):
+    pass
 
-    def __str__(self):
-        return repr(self.value)
 
+class GetPrepayError(errors.PlatformError):
+    pass
 
-class PrepayPaymentError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Prepay] - Payment Error: '+value, exc_info=True)
 
-    def __str__(self):
-        return repr(self.value)
+class PrepayPaymentError(errors.PlatformError):
+    pass
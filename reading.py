@@ -6,8 +6,24 @@ __author__ = 'Cesar'
 import logging
 from google.appengine.ext import ndb
 from google.appengine.api import taskqueue
-from meter import Meter
-from datetime import datetime
+from meter import Meter, GetMeterError
+import history
+import cache
+import consumption
+import notifications
+import paging
+import errors
+from datetime import datetime, timedelta
+
+# An XG transaction spans at most 25 entity groups and every Reading is its own group (plus the Meter)
+MAX_READINGS_PER_TRANSACTION = 20
+# Pull queues read by the OCR-Workers, tasks are tagged with the meter model
+OCR_TASK_QUEUES = ('image-processing-queue', 'negative-consumption-queue', 'need-help-queue')
+DEFAULT_LEASED_TASKS = 10
+MAX_LEASED_TASKS = 1000
+DEFAULT_LEASE_SECONDS = 300
+# A worker that stops responding hides its tasks from the others for at most this long
+MAX_LEASE_SECONDS = 600
 
 
 class Reading(ndb.Model):
@@ -29,46 +45,74 @@ class Reading(ndb.Model):
         Args:
             account_number: (String)
         Returns:
-            A reading
+            A reading, None if the meter has no readings
         """
         try:
-            meter = Meter.get_from_datastore(account_number)
-            query_response = Reading.query(Reading.meter == meter.key).order(-cls.date).fetch(limit=1)
-            if query_response:
-                resp = query_response[0]
-            else:
-                raise GetReadingError('No previous Readings found under specified criteria: Account Number: {0}'
-                                      .format(account_number))
+            # Memoised for the request, dropped when a reading of the meter is saved (see forget_last)
+            resp = cache.request.get(('last-reading', account_number))
+            if resp is None:
+                query_response = Reading.query(Reading.meter == Meter.get_key(account_number))\
+                    .order(-cls.date).fetch(limit=1)
+                resp = query_response[0] if query_response else None
+                if resp is not None:
+                    cache.request.set(('last-reading', account_number), resp)
         except Exception as e:
-            raise GetReadingError('Error getting Reading: '+e.__str__())
+            raise errors.wrap(GetReadingError, 'Error getting Reading: ', e)
         else:
             return resp
 
     @classmethod
-    def get_all_from_datastore(cls, account_number):
+    def forget_last(cls, account_number):
         """
-        Gets all readings from datastore based on:
+        Drops the last reading of a meter from the request scope. Call after storing readings of the meter.
         Args:
             account_number: (String)
+        """
+        cache.request.drop(('last-reading', account_number))
+
+    @classmethod
+    def get_page_from_datastore(cls, account_number, start_date=None, end_date=None,
+                                page_size=paging.DEFAULT_PAGE_SIZE, cursor=None):
+        """
+        Gets one page of readings from datastore, newest first, based on:
+        Args:
+            account_number: (String)
+            start_date: (Datetime) oldest reading date to include, optional
+            end_date: (Datetime) newest reading date to include, optional
+            page_size: (Integer) readings per page, at most paging.MAX_PAGE_SIZE
+            cursor: (String) urlsafe cursor returned with the previous page, None for the first page
         Returns:
-            A List with all the readings that match the criteria
+            (readings, next_cursor, more): the List of readings of the page (empty if there are none), the
+            urlsafe cursor of the next page and True if there may be more pages
         """
         try:
             meter = Meter.get_from_datastore(account_number)
-            query_response = Reading.query(Reading.meter == meter.key).fetch()
-            if query_response:
-                resp = []
-                for r in query_response:
-                    resp.append(r)
-            else:
-                raise GetReadingError('No Readings found under specified criteria: Account Number: {0}'
-                                      .format(account_number))
+            query = Reading.query(Reading.meter == meter.key)
+            if start_date:
+                query = query.filter(Reading.date >= start_date)
+            if end_date:
+                query = query.filter(Reading.date <= end_date)
+            # Served by the (meter, -date) index
+            query = query.order(-Reading.date)
+            readings, next_cursor, more = paging.fetch_page(query, page_size, cursor, GetReadingError)
         except Exception as e:
-            raise GetReadingError('Error getting Reading: '+e.__str__())
+            raise errors.wrap(GetReadingError, 'Error getting Reading: ', e)
         else:
-            for r in resp:
-                logging.debug("[Reading] = {0}".format(r))
-            return resp
+            logging.debug("[Reading] - Page of {0} readings, more = {1}".format(len(readings), more))
+            return readings, next_cursor, more
+
+    @classmethod
+    def build_key(cls, account_number, date):
+        """
+        Builds the key of the reading of a meter at a given date. Keys are deterministic so the key of a new
+        reading is known before it is stored (see Meter.last_reading_key) and re-imports do not duplicate.
+        Args:
+            account_number: (String)
+            date: (Datetime)
+        Returns:
+            ndb Key
+        """
+        return ndb.Key(cls, '{0}-{1:%Y%m%d%H%M%S%f}'.format(account_number, date))
 
     @classmethod
     def save_to_datastore(cls, meter, measure):
@@ -80,60 +124,225 @@ class Reading(ndb.Model):
         Returns:
             True if creation successful, False if negative consumption, exception otherwise
         """
+        # TODO associate reading with image!!!
+        saved = cls.save_batch_to_datastore(meter, [measure])[0]
+        logging.debug('[Reading] - New Reading, Measure = {0} Saved = {1}'.format(measure, saved))
+        return saved
+
+    @classmethod
+    def save_batch_to_datastore(cls, meter, measures):
+        """
+        Saves several Readings of the same meter, in the given order (see save_task_results_to_datastore).
+        Args:
+            meter: (String) account_number
+            measures: (List) of Integers, oldest first
+
+        Returns:
+            A List of booleans, one per measure: True if saved, False if negative consumption
+        """
+        outcomes, error = cls.save_task_results_to_datastore(meter, [(None, False, measure) for measure in measures])
+        if error is not None:
+            raise error
+        return [outcome == 'Saved' for outcome, duplicate in outcomes]
+
+    @classmethod
+    def save_task_result_to_datastore(cls, meter, task_name, human, measure, notification=None):
+        """
+        Applies the result of a single OCR task (see save_task_results_to_datastore).
+        Args:
+            notification: function(outcome) -> (title, text) of the push for the result, optional
+        Returns:
+            (outcome, duplicate)
+        """
+        notify = (lambda i, outcome: notification(outcome)) if notification else None
+        outcomes, error = cls.save_task_results_to_datastore(meter, [(task_name, human, measure)], notify)
+        if error is not None:
+            raise error
+        return outcomes[0]
+
+    @classmethod
+    def save_task_results_to_datastore(cls, meter, results, notify=None):
+        """
+        Applies the results of several OCR tasks of the same meter, in the given order. Consumption of each
+        measure is computed against the last accepted one, starting from the last reading snapshot of the
+        meter, and measures with negative consumption are skipped. Readings, balance, snapshot, consumption
+        rollups, the TaskResult of each task and the push notifications of the new results are written together
+        in as few transactions as the XG limit allows, so a committed result always has its push. A task whose
+        TaskResult already exists, or that appears earlier in results, is not applied again and its original
+        outcome is returned.
+        Args:
+            meter: (String) account_number
+            results: (List) of (task_name, human, measure) tuples, oldest first. measure is None if the OCR
+                     failed. task_name None does not record a TaskResult.
+            notify: function(index, outcome) -> (title, text) of the push sent to the user of the meter for a
+                    newly applied result, or None for no push. Optional.
+
+        Returns:
+            (outcomes, error): outcomes has one (outcome, duplicate) tuple per result applied, in order: outcome
+            is Saved, NegativeConsumption or Error, duplicate is True if the task had already been applied. If
+            a transaction fails, error is the PlatformError and outcomes only covers the results committed
+            before it, the rest are not applied. error is None otherwise.
+        """
+        outcomes = []
         try:
-            # TODO associate reading with image!!!
-            m = Meter.get_from_datastore(meter)
-            r = Reading(date=datetime.now(),
-                        meter=m.key,
-                        measure=measure)
-            # Get consumption. This reading - Last Reading
-            last_reading = cls.get_last_from_datastore(m.account_number)
-            logging.debug('[Reading] - Last Reading, Measure = {0}'.format(last_reading.measure))
-            consumption = measure - last_reading.measure
-            logging.debug('[Reading] - Consumption = {0}'.format(consumption))
-            if consumption < 0:
-                return False
-            else:
-                # Update balance with the calculated consumption in datastore
-                current_balance = Meter.get_balance(meter)
-                new_balance = current_balance + consumption
-                # FIXME handle exception from Meter class
-                Meter.set_balance(meter, new_balance)
-                logging.debug('[Reading] - New Balance: {0} = (Old Balance = {1}) + (Consumption = {2})'
-                              .format(new_balance, current_balance, consumption))
-            key = r.put()
+            fallback = None
+            if any(measure is not None for task_name, human, measure in results):
+                fallback = cls._last_measure_fallback(meter)
+            for start in xrange(0, len(results), MAX_READINGS_PER_TRANSACTION):
+                chunk = results[start:start+MAX_READINGS_PER_TRANSACTION]
+                chunk_outcomes = []
+
+                def build_readings(m):
+                    # May run again if the transaction is retried
+                    del chunk_outcomes[:]
+                    keys = [TaskResult.build_key(meter, task_name, human) if task_name else None
+                            for task_name, human, measure in chunk]
+                    task_keys = [k for k in keys if k]
+                    # {key: outcome} of the tasks already applied
+                    recorded = dict((k, r.outcome) for k, r in zip(task_keys, ndb.get_multi(task_keys)) if r)
+                    previous = m.last_measure if m.last_measure is not None else fallback
+                    first = previous
+                    now = datetime.now()
+                    entities = []
+                    consumptions = []
+                    pushes = []
+                    for i, (key, (task_name, human, measure)) in enumerate(zip(keys, chunk)):
+                        if key in recorded:
+                            chunk_outcomes.append((recorded[key], True))
+                            continue
+                        reading = None
+                        if measure is None:
+                            outcome = 'Error'
+                        else:
+                            if previous is None:
+                                raise GetReadingError('No previous Readings found under specified criteria: '
+                                                      'Account Number: {0}'.format(meter),
+                                                      errors.NO_PREVIOUS_READING)
+                            if measure >= previous:
+                                # Keep dates strictly increasing so the last reading is unambiguous
+                                date = now + timedelta(microseconds=i)
+                                reading = Reading(key=Reading.build_key(meter, date),
+                                                  date=date,
+                                                  meter=m.key,
+                                                  measure=measure)
+                                entities.append(reading)
+                                consumptions.append((date, measure - previous))
+                                m.set_last_reading(reading)
+                                previous = measure
+                                outcome = 'Saved'
+                            else:
+                                outcome = 'NegativeConsumption'
+                        chunk_outcomes.append((outcome, False))
+                        if key:
+                            # A task repeated later in the chunk gets this outcome, as a duplicate
+                            recorded[key] = outcome
+                            entities.append(TaskResult(key=key,
+                                                       outcome=outcome,
+                                                       measure=measure,
+                                                       reading=reading.key if reading else None))
+                        push = notify(start + i, outcome) if notify else None
+                        if push is not None:
+                            pushes.append(push)
+                    if not entities:
+                        return None
+                    if pushes:
+                        if m.installation_id is not None:
+                            # Transactional: queued only if the chunk commits
+                            notifications.enqueue_multi([(m.installation_id, title, text) for title, text in pushes])
+                        else:
+                            logging.warning('[Reading] - Meter {0} has no user assigned, {1} notifications not '
+                                            'sent'.format(meter, len(pushes)))
+                    # Daily and monthly rollups are children of the meter, same entity group
+                    entities.extend(consumption.add(m.key, consumptions))
+                    # Consumption of the chunk is added to the balance in the same transaction
+                    return (previous - first if first is not None else 0), entities
+
+                Meter.mutate_balance(meter, build_readings)
+                Reading.forget_last(meter)
+                outcomes.extend(chunk_outcomes)
         except Exception as e:
-            logging.exception("[Reading] - "+e.message)
-            raise ReadingCreationError('Error creating the reading in datastore: '+e.__str__())
+            # The chunks already committed keep their outcomes, their effects are still due
+            error = errors.wrap(ReadingCreationError, 'Error creating the readings in datastore: ', e)
+            logging.debug('[Reading] - {0} of {1} Results committed for meter {2} before: {3}'
+                          .format(len(outcomes), len(results), meter, error.value))
+            return outcomes, error
         else:
-            logging.debug('[Reading] - New Reading, Measure = {0} Key = {1}'.format(measure, key))
-            return True
+            logging.debug('[Reading] - {0} of {1} Results applied for meter {2}'
+                          .format(len([o for o in outcomes if not o[1]]), len(results), meter))
+            return outcomes, None
+
+    @classmethod
+    def _last_measure_fallback(cls, account_number):
+        """
+        Last measure of a meter whose last reading snapshot has not been backfilled yet.
+        Args:
+            account_number: (String)
+        Returns:
+            (Integer) measure of the last reading, None if the meter already has a snapshot or has no readings
+        """
+        if Meter.get_from_datastore(account_number).last_measure is not None:
+            return None
+        last = cls.get_last_from_datastore(account_number)
+        return last.measure if last is not None else None
 
     @classmethod
-    def save_history_to_datastore(cls, meter_key, measurements):
+    def save_history_to_datastore(cls, meter_key, measurements, chunk_size=history.HISTORY_CHUNK_SIZE,
+                                  on_progress=None):
         """
-        Saves historic Readings as a new entities on the datastore.
+        Saves historic Readings as a new entities on the datastore, chunk_size entities per put_multi_async call.
+        Readings are keyed by meter and date so importing the same history twice does not duplicate them.
         :param
-            account_number: (String) account_number
+            meter_key: (ndb Key) meter
             measurements: (Dictionary) from jmas_api
+            chunk_size: (Integer) entities per put_multi_async call
+            on_progress: function(count) called after each chunk is stored
 
         :return
             True if creation successful, exception otherwise
 
         """
         try:
-            for measure in measurements:
-                r = Reading(date=measure,
-                            meter=meter_key,
-                            measure=measurements[measure])
-                key = r.put()
+            entities = [Reading(key=Reading.build_key(meter_key.id(), measure),
+                                date=measure,
+                                meter=meter_key,
+                                measure=measurements[measure])
+                        for measure in measurements]
+            history.put_in_chunks(entities, chunk_size, on_progress)
+            if entities:
+                last = max(entities, key=lambda r: r.date)
+
+                def merge_history(m):
+                    # Snapshot and rollups change in the same transaction as any live reading of the meter,
+                    # so neither overwrites the other
+                    m.set_last_reading(last)
+                    return 0, consumption.add_history(m.key, entities)
+
+                Meter.mutate_balance(meter_key.id(), merge_history)
+                Reading.forget_last(meter_key.id())
         except Exception as e:
-            logging.exception("[Reading] - "+e.message)
-            raise ReadingCreationError('Error creating the reading in datastore: '+e.__str__())
+            raise errors.wrap(ReadingCreationError, 'Error creating the reading in datastore: ', e)
         else:
             logging.debug('[Reading] - Historical Measurements successfully stored')
             return True
 
+    @classmethod
+    def image_task_tags(cls, account_numbers):
+        """
+        Gets the tag of the OCR-Worker tasks of each meter: the meter model, so each worker pool only leases
+        images of the model it has loaded. Meters still being onboarded have no model and their tasks no tag.
+        Args:
+            account_numbers: iterable of account numbers
+        Returns:
+            dict {account_number: model or None}
+        """
+        tags = {}
+        for account_number in set(account_numbers):
+            try:
+                tags[account_number] = Meter.get_from_datastore(account_number).model
+            except GetMeterError:
+                tags[account_number] = None
+        return tags
+
     @classmethod
     def set_image_processing_task(cls, queue, meter, image_name):
         """
@@ -141,6 +350,7 @@ class Reading(ndb.Model):
             task_queue: [image-processing-queue] | [negative-consumption-queue] | [need-help-queue]
             name: Process--[image_name]
             payload: [account_number]--[image_name]
+            tag: model of the meter (see image_task_tags)
         Args:
             account_number: (String) account_number from request
             image_name: (String) name of the image in CloudStorage
@@ -148,50 +358,136 @@ class Reading(ndb.Model):
             True if task creation successful, exception otherwise
 
         """
+        return Reading.set_image_processing_tasks(queue, [(meter, image_name)])
+
+    @classmethod
+    def set_image_processing_tasks(cls, queue, tasks):
+        """
+        Creates several pull tasks at once (see set_image_processing_task).
+        Args:
+            queue: (String) name of the queue
+            tasks: (List) of (account_number, image_name) tuples
+        Returns:
+            True if task creation successful, exception otherwise
+        """
+        if not tasks:
+            return True
         try:
             q = taskqueue.Queue(queue)
+            tags = Reading.image_task_tags(meter for meter, image_name in tasks)
             tasks = [taskqueue.Task(name='Process--{0}'.format(image_name),
                                     payload='{0}--{1}'.format(meter, image_name),
-                                    method='PULL')]
-            q.add(tasks)
+                                    tag=tags[meter],
+                                    method='PULL')
+                     for meter, image_name in tasks]
+            for start in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+                try:
+                    q.add(tasks[start:start+taskqueue.MAX_TASKS_PER_ADD])
+                except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                    # Already created by a previous submission of the same result, the others were added
+                    pass
+        except Exception as e:
+            raise errors.wrap(TaskCreationError, 'Error creating OCR-Worker tasks: ', e)
+        else:
+            logging.debug('[Reading] - {0} Tasks successfully created in: {1}'.format(len(tasks), queue))
+            return True
+
+    @classmethod
+    def lease_image_processing_tasks(cls, queue, tag=None, max_tasks=DEFAULT_LEASED_TASKS,
+                                     lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Leases OCR-Worker tasks of a single tag (meter model). Leased tasks are not handed to other workers
+        until the lease expires; a worker that does not send the result in time lets the task be leased again.
+        Args:
+            queue: (String) one of OCR_TASK_QUEUES
+            tag: (String) model of the tasks to lease, None to lease the tag of the oldest task
+            max_tasks: (Integer) at most MAX_LEASED_TASKS
+            lease_seconds: (Integer) at most MAX_LEASE_SECONDS
+        Returns:
+            List of taskqueue.Task, exception otherwise
+        """
+        if queue not in OCR_TASK_QUEUES:
+            raise TaskLeaseError('Unknown OCR-Worker queue: {0}'.format(queue), errors.INVALID_ARGUMENT)
+        max_tasks = max(1, min(max_tasks, MAX_LEASED_TASKS))
+        lease_seconds = max(1, min(lease_seconds, MAX_LEASE_SECONDS))
+        try:
+            q = taskqueue.Queue(queue)
+            if tag:
+                tasks = q.lease_tasks_by_tag(lease_seconds, max_tasks, tag=tag)
+            else:
+                tasks = q.lease_tasks_by_tag(lease_seconds, max_tasks)
+        except Exception as e:
+            raise errors.wrap(TaskLeaseError, 'Error leasing OCR-Worker tasks: ', e)
+        else:
+            logging.debug('[Reading] - {0} Tasks leased from: {1} tag: {2}'.format(len(tasks), queue, tag))
+            return tasks
+
+    @classmethod
+    def delete_image_processing_tasks(cls, queue, task_names):
+        """
+        Deletes finished tasks from a pull queue with a single call.
+        Args:
+            queue: (String) name of the queue
+            task_names: (List) of task names
+        Returns:
+            True if deletion successful, exception otherwise
+        """
+        if not task_names:
+            return True
+        try:
+            # Deleting by list does not raise for tasks already deleted (a retried result)
+            taskqueue.Queue(queue).delete_tasks_by_name([str(name) for name in task_names])
         except Exception as e:
-            raise TaskCreationError('Error creating OCR-Worker task:'+e.__str__())
+            raise errors.wrap(TaskCreationError, 'Error deleting OCR-Worker tasks: ', e)
         else:
-            logging.debug('[Reading] - Task successfully created in: {0}'.format(queue))
+            logging.debug('[Reading] - {0} Tasks successfully deleted from: {1}'.format(len(task_names), queue))
             return True
 
 
-class ReadingCreationError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Reading] - Reading Error:'+value, exc_info=True)
+class ReadingCreationError(errors.PlatformError):
+    pass
+
 
-    def __str__(self):
-        return repr(self.value)
+class NotificationCreationError(errors.PlatformError):
+    pass
 
 
-class NotificationCreationError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Reading] - Notification Error:'+value, exc_info=True)
+class TaskResult(ndb.Model):
+    """
+    Outcome of an OCR task, child of its Meter and keyed by the task name, so it is written in the same
+    transaction (entity group) as the reading. A retried submission of the task finds it and is not applied
+    twice.
+
+        - outcome: Saved, NegativeConsumption or Error
+        - measure: measure submitted, empty if the OCR failed
+        - reading: key of the Reading stored, if any
+    """
+    outcome = ndb.StringProperty(choices=['Saved', 'NegativeConsumption', 'Error'], indexed=False)
+    measure = ndb.IntegerProperty(indexed=False)
+    reading = ndb.KeyProperty(kind=Reading, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
 
-    def __str__(self):
-        return repr(self.value)
+    @classmethod
+    def build_key(cls, account_number, task_name, human=False):
+        """
+        Results of the OCR engine and of the human review of the same image are kept apart.
+        Args:
+            account_number: (String)
+            task_name: (String) Process--[image_name]
+            human: (Boolean) True if done by human hand
+        Returns:
+            ndb Key
+        """
+        return ndb.Key(Meter, account_number, cls, '{0}--{1}'.format('human' if human else 'engine', task_name))
 
 
-class TaskCreationError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Reading] - Task Error:'+value, exc_info=True)
+class TaskCreationError(errors.PlatformError):
+    pass
 
-    def __str__(self):
-        return repr(self.value)
 
+class TaskLeaseError(errors.PlatformError):
+    pass
 
-class GetReadingError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[Reading] - Get Error: '+value, exc_info=True)
 
-    def __str__(self):
-        return repr(self.value)
+class GetReadingError(errors.PlatformError):
+    pass
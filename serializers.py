@@ -0,0 +1,79 @@
+"""
+Builds the ProtoRPC list responses of the API from datastore entities. The meter referenced by each entity is
+resolved once per response, never once per row.
+"""
+__author__ = 'Cesar'
+
+from google.appengine.ext import ndb
+import messages
+from meter import Meter
+
+
+def account_numbers(meter_keys, account_number=None):
+    """
+    Resolves the account number of every meter key.
+        :param meter_keys: iterable of Meter keys
+        :param account_number: (String) account number already known by the caller (from the request)
+        :return: dict {meter_key: account_number}
+    """
+    resolved = {}
+    unknown = []
+    for key in set(meter_keys):
+        if account_number is not None and key == Meter.get_key(account_number):
+            resolved[key] = account_number
+        elif isinstance(key.id(), basestring):
+            # Meters are keyed by their account number
+            resolved[key] = key.id()
+        else:
+            unknown.append(key)
+    if unknown:
+        # Meters still stored under an auto generated id, a single batched get for all of them
+        for key, m in zip(unknown, ndb.get_multi(unknown)):
+            resolved[key] = m.account_number if m else None
+    return resolved
+
+
+def readings(entities, account_number=None):
+    """
+    :param entities: List of Reading
+    :param account_number: (String) account number of the request, if known
+    :return: List of messages.Reading
+    """
+    numbers = account_numbers([e.meter for e in entities], account_number)
+    return [messages.Reading(urlsafe_key=e.key.urlsafe(),
+                             creation_date=e.date,
+                             account_number=numbers[e.meter],
+                             measure=e.measure)
+            for e in entities]
+
+
+def bills(entities, account_number=None):
+    """
+    :param entities: List of Bill
+    :param account_number: (String) account number of the request, if known
+    :return: List of messages.Bill
+    """
+    numbers = account_numbers([e.meter for e in entities], account_number)
+    return [messages.Bill(urlsafe_key=e.key.urlsafe(),
+                          creation_date=e.date,
+                          account_number=numbers[e.meter],
+                          balance=e.balance,
+                          amount=e.amount,
+                          status=e.status)
+            for e in entities]
+
+
+def prepays(entities, account_number=None):
+    """
+    :param entities: List of Prepay
+    :param account_number: (String) account number of the request, if known
+    :return: List of messages.Prepay
+    """
+    numbers = account_numbers([e.meter for e in entities], account_number)
+    return [messages.Prepay(urlsafe_key=e.key.urlsafe(),
+                            creation_date=e.created,
+                            account_number=numbers[e.meter],
+                            balance=e.balance,
+                            prepay=e.prepay,
+                            amount=e.amount)
+            for e in entities]
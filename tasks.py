@@ -0,0 +1,137 @@
+"""
+Administrative, cron and task queue handlers of the OCR platform. Served outside of Cloud Endpoints
+and restricted to admins in app.yaml.
+"""
+__author__ = 'Cesar'
+
+import json
+import logging
+import webapp2
+import billing
+import cache
+import instrumentation
+import migrations
+import notifications
+
+
+class JsonHandler(webapp2.RequestHandler):
+    """
+    Base handler that writes its response as JSON
+    """
+
+    def write_json(self, data, status=200):
+        self.response.status_int = status
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(data))
+
+
+class MigrationHandler(JsonHandler):
+    """
+    Starts or resumes a data migration (see migrations.py)
+        POST /admin/migrations/[name]?restart=1
+    """
+
+    def post(self, name):
+        logging.debug("[Tasks - MigrationHandler] - name = {0}".format(name))
+        try:
+            state = migrations.start(name, restart=self.request.get('restart') == '1')
+        except migrations.MigrationError as e:
+            self.write_json({'ok': False, 'error': e.value}, status=404)
+        else:
+            self.write_json({'ok': True,
+                             'processed': state.processed,
+                             'migrated': state.migrated,
+                             'done': state.done})
+
+    def get(self, name):
+        state = migrations.MigrationState.get_by_id(name)
+        if state is None:
+            self.write_json({'ok': False, 'error': 'Migration never started'}, status=404)
+        else:
+            self.write_json({'ok': True,
+                             'processed': state.processed,
+                             'migrated': state.migrated,
+                             'done': state.done})
+
+
+class CacheStatsHandler(JsonHandler):
+    """
+    Hit, miss and eviction counters of the entity caches of this instance (see cache.py)
+        GET /admin/cache/stats
+    """
+
+    def get(self):
+        self.write_json({'ok': True, 'caches': cache.stats()})
+
+
+class PushDispatchHandler(webapp2.RequestHandler):
+    """
+    Sends the pending push notifications of the outbox to Parse (see notifications.py)
+        POST /tasks/push/dispatch
+    """
+
+    def post(self):
+        notifications.dispatch()
+
+
+class InstrumentationStatsHandler(JsonHandler):
+    """
+    Rolling latency histograms and RPC counts per endpoint of this instance (see instrumentation.py)
+        GET /admin/instrumentation/stats
+    """
+
+    def get(self):
+        self.write_json({'ok': True,
+                         'window_minutes': instrumentation.endpoint_stats.window_minutes,
+                         'endpoints': instrumentation.endpoint_stats.stats()})
+
+
+class PushStatsHandler(JsonHandler):
+    """
+    Push delivery metrics of this instance: batch sizes, collapsed duplicates, failures and latency
+        GET /admin/push/stats
+    """
+
+    def get(self):
+        self.write_json({'ok': True, 'push': notifications.delivery_stats.stats()})
+
+
+class BillingStartHandler(JsonHandler):
+    """
+    Starts (or resumes) the billing run of the current month. Triggered by cron.yaml
+        GET /tasks/billing/start
+    """
+
+    def get(self):
+        run = billing.start()
+        self.write_json({'ok': True, 'run_id': run.key.id()})
+
+
+class BillingRunHandler(JsonHandler):
+    """
+    Summary of a billing run, POST starts or resumes it (see billing.py)
+        GET|POST /admin/billing/[run_id]
+    """
+
+    def get(self, run_id):
+        s = billing.summary(run_id)
+        if s is None:
+            self.write_json({'ok': False, 'error': 'Billing run never started'}, status=404)
+        else:
+            self.write_json({'ok': True, 'run': s})
+
+    def post(self, run_id):
+        logging.debug("[Tasks - BillingRunHandler] - run_id = {0}".format(run_id))
+        billing.start(run_id)
+        self.write_json({'ok': True, 'run': billing.summary(run_id)})
+
+
+app = cache.request_scoped(webapp2.WSGIApplication([
+    (r'/admin/migrations/(\w+)', MigrationHandler),
+    (r'/admin/cache/stats', CacheStatsHandler),
+    (r'/admin/push/stats', PushStatsHandler),
+    (r'/admin/instrumentation/stats', InstrumentationStatsHandler),
+    (r'/admin/billing/([\w-]+)', BillingRunHandler),
+    (r'/tasks/billing/start', BillingStartHandler),
+    (r'/tasks/push/dispatch', PushDispatchHandler),
+]))
@@ -0,0 +1,38 @@
+"""
+Base of the tests: the backend runs in-process on the App Engine testbed stubs, with a fake Parse server (see
+benchmark.LocalStack). The SDK is taken from the APPENGINE_SDK env variable.
+
+    APPENGINE_SDK=[path to google_appengine] python -m unittest discover tests
+"""
+__author__ = 'Cesar'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+benchmark.setup_sdk(None)
+
+
+class StackTestCase(unittest.TestCase):
+    """
+    Every test gets its own LocalStack: empty datastore, memcache and queues.
+    """
+
+    def setUp(self):
+        self.stack = benchmark.LocalStack()
+
+    def tearDown(self):
+        self.stack.stop()
+
+    def rpcs(self, func, *args, **kwargs):
+        """
+        Runs func as a request.
+            :return: (result, collections.Counter {service.call: RPCs made by func})
+        """
+        before = self.stack.rpc_counter.snapshot()
+        result = self.stack.request(func, *args, **kwargs)
+        after = self.stack.rpc_counter.snapshot()
+        after.subtract(before)
+        return result, after
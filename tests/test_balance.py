@@ -0,0 +1,80 @@
+"""
+Concurrent balance changes on one meter: a change committed between the read and the commit of another makes
+that one retry with the new balance, so no delta is lost.
+"""
+__author__ = 'Cesar'
+
+import threading
+import unittest
+import base
+import messages
+from bill import Bill
+from meter import Meter
+from prepay import Prepay
+
+ACCOUNT = '0001000001'
+
+
+class BalanceTest(base.StackTestCase):
+
+    def setUp(self):
+        base.StackTestCase.setUp(self)
+        self.mutate_balance = Meter.mutate_balance.im_func
+        self.builds = 0
+
+    def tearDown(self):
+        Meter.mutate_balance = classmethod(self.mutate_balance)
+        base.StackTestCase.tearDown(self)
+
+    def meter(self, balance):
+        Meter(key=Meter.get_key(ACCOUNT), account_number=ACCOUNT, balance=balance, last_measure=100,
+              installation_id='install-0').put()
+
+    def interleave(self, func, *args):
+        """
+        Runs func as its own request, in another thread, after the next balance change has read the meter and
+        before it commits.
+        """
+        mutate_balance = self.mutate_balance
+
+        def interleaved(cls, account_number, build_change):
+            Meter.mutate_balance = classmethod(mutate_balance)
+
+            def build(m):
+                self.builds += 1
+                if self.builds == 1:
+                    t = threading.Thread(target=self.stack.request, args=(func,) + args)
+                    t.start()
+                    t.join()
+                return build_change(m)
+            return mutate_balance(cls, account_number, build)
+
+        Meter.mutate_balance = classmethod(interleaved)
+
+    def test_reading_during_bill(self):
+        self.meter(10)
+        self.stack.setup('new_image_for_processing',
+                         messages.NewImageForProcessing(account_number=ACCOUNT, image_name='a.jpg'))
+        result = messages.ImageProcessingResult(task_name='Process--a.jpg', task_payload=ACCOUNT + '--a.jpg',
+                                                result=105, error='', human=False)
+        self.interleave(self.stack.call, 'set_image_processing_result', result)
+
+        b = self.stack.request(Bill.save_to_datastore, ACCOUNT)
+
+        self.assertGreater(self.builds, 1)
+        self.assertEqual(15, b.balance)
+        self.assertEqual(0, Meter.get_key(ACCOUNT).get().balance)
+
+    def test_prepay_during_prepay(self):
+        self.meter(0)
+        self.interleave(Prepay.save_to_datastore, ACCOUNT, 4)
+
+        self.stack.request(Prepay.save_to_datastore, ACCOUNT, 5)
+
+        self.assertGreater(self.builds, 1)
+        self.assertEqual(2, Prepay.query().count())
+        self.assertEqual(-9, Meter.get_key(ACCOUNT).get().balance)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+Billing runs: a run started twice, or walked by a second chain, still bills every meter once and keeps a single
+walk chain.
+"""
+__author__ = 'Cesar'
+
+import unittest
+import base
+import billing
+from bill import Bill
+from meter import Meter
+
+RUN_ID = '2026-01'
+METERS = 5
+
+
+class BillingRunTest(base.StackTestCase):
+
+    def setUp(self):
+        base.StackTestCase.setUp(self)
+        self.page_size = billing.WALK_PAGE_SIZE
+        billing.WALK_PAGE_SIZE = 2
+        for i in xrange(METERS):
+            account_number = '00010000{0:02d}'.format(i)
+            Meter(key=Meter.get_key(account_number), account_number=account_number, balance=10,
+                  last_measure=100).put()
+
+    def tearDown(self):
+        billing.WALK_PAGE_SIZE = self.page_size
+        base.StackTestCase.tearDown(self)
+
+    def walks(self):
+        return [t for t in self.stack.taskqueue_stub.get_filtered_tasks(queue_names=[billing.BILLING_QUEUE])
+                if t.name.startswith('billing-walk-')]
+
+    def test_second_start_does_not_chain_again(self):
+        self.stack.request(billing.start, RUN_ID)
+        self.stack.request(billing.start, RUN_ID)
+        self.assertEqual(['billing-walk-{0}-0'.format(RUN_ID)], [t.name for t in self.walks()])
+
+    def test_single_chain_bills_once(self):
+        self.stack.request(billing.start, RUN_ID)
+        # A second chain walks the first page before the queued walk runs
+        self.stack.request(billing.walk, RUN_ID, 0)
+        self.stack.drain([billing.BILLING_QUEUE])
+
+        run = billing.BillingRun.get_by_id(RUN_ID)
+        self.assertTrue(run.walked)
+        bills = Bill.query().fetch()
+        self.assertEqual(METERS, len(bills))
+        self.assertEqual(METERS, len(set(b.meter for b in bills)))
+        s = self.stack.request(billing.summary, RUN_ID)
+        self.assertEqual('Done', s['status'])
+        self.assertEqual(METERS, s['billed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
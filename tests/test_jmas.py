@@ -0,0 +1,115 @@
+"""
+JMAS client against fake_jmas.py: retries, the circuit breaker (open, half open with a single trial call,
+closed), stale values and rejected requests.
+"""
+__author__ = 'Cesar'
+
+import threading
+import time
+import unittest
+import base
+import errors
+import fake_jmas
+import jmas_api
+
+RESET_SECONDS = 0.2
+
+
+class JmasClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = (jmas_api.RETRY_BACKOFF_SECONDS, jmas_api.CIRCUIT_RESET_SECONDS,
+                         jmas_api.TARIFF_TTL_SECONDS)
+        jmas_api.RETRY_BACKOFF_SECONDS = 0
+        jmas_api.CIRCUIT_RESET_SECONDS = RESET_SECONDS
+        self.server = fake_jmas.FakeJmasServer().start()
+        self.client = jmas_api.JmasClient(base_url=self.server.url, timeout=2, retries=2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        (jmas_api.RETRY_BACKOFF_SECONDS, jmas_api.CIRCUIT_RESET_SECONDS,
+         jmas_api.TARIFF_TTL_SECONDS) = self.settings
+
+    def requests(self):
+        with self.server.lock:
+            return len(self.server.requests)
+
+    def get(self, path='/tariffs'):
+        """
+        :return: the decoded response, or the code of the JmasError raised
+        """
+        try:
+            return self.client._get(path)
+        except jmas_api.JmasError as e:
+            return e.code
+
+    def open_circuit(self):
+        self.server.failure_rate = 1.0
+        for _ in xrange(jmas_api.CIRCUIT_FAILURE_THRESHOLD):
+            self.assertEqual(errors.UNAVAILABLE, self.get())
+
+    def test_retries(self):
+        self.server.failure_rate = 1.0
+        self.assertEqual(errors.UNAVAILABLE, self.get())
+        self.assertEqual(1 + self.client.retries, self.requests())
+
+    def test_circuit_opens(self):
+        self.open_circuit()
+        sent = self.requests()
+        self.server.failure_rate = 0.0
+        # Open: fails fast without calling JMAS
+        self.assertEqual(errors.UNAVAILABLE, self.get())
+        self.assertEqual(sent, self.requests())
+
+    def test_half_open_lets_a_single_trial_through(self):
+        self.open_circuit()
+        self.server.failure_rate = 0.0
+        self.server.latency = 0.3
+        time.sleep(RESET_SECONDS)
+        sent = self.requests()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.get())) for _ in xrange(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, self.requests() - sent)
+        self.assertEqual(4, results.count(errors.UNAVAILABLE))
+        self.assertEqual([jmas_api.fake_tariffs()], [r for r in results if r != errors.UNAVAILABLE])
+        # The trial closed the circuit
+        self.server.latency = 0.0
+        self.assertEqual(jmas_api.fake_tariffs(), self.get())
+
+    def test_failed_trial_opens_again(self):
+        self.open_circuit()
+        time.sleep(RESET_SECONDS)
+        self.assertEqual(errors.UNAVAILABLE, self.get())
+        sent = self.requests()
+        self.server.failure_rate = 0.0
+        # A single failed trial opens the circuit for another CIRCUIT_RESET_SECONDS
+        self.assertEqual(errors.UNAVAILABLE, self.get())
+        self.assertEqual(sent, self.requests())
+        time.sleep(RESET_SECONDS)
+        self.assertEqual(jmas_api.fake_tariffs(), self.get())
+
+    def test_stale_value_served(self):
+        jmas_api.TARIFF_TTL_SECONDS = -1
+        factor = self.client.get_postpay_conversion_factor()
+        self.server.failure_rate = 1.0
+        self.assertEqual(factor, self.client.get_postpay_conversion_factor())
+        self.open_circuit()
+        self.assertEqual(factor, self.client.get_postpay_conversion_factor())
+
+    def test_rejected_request(self):
+        for _ in xrange(jmas_api.CIRCUIT_FAILURE_THRESHOLD + 1):
+            self.assertEqual(errors.NOT_FOUND, self.get('/unknown'))
+        # Not retried, and JMAS answered so the circuit stays closed
+        self.assertEqual(jmas_api.CIRCUIT_FAILURE_THRESHOLD + 1, self.requests())
+        self.assertEqual(jmas_api.fake_tariffs(), self.get())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+"""
+Leasing OCR-Worker tasks through the API: only OCR-Worker accounts, and for at most MAX_LEASE_SECONDS.
+"""
+__author__ = 'Cesar'
+
+import os
+import time
+import unittest
+import base
+import errors
+import messages
+import reading
+
+ACCOUNT = '0001000001'
+QUEUE = 'image-processing-queue'
+
+
+class LeaseTest(base.StackTestCase):
+
+    def setUp(self):
+        base.StackTestCase.setUp(self)
+        self.stack.setup('new_image_for_processing',
+                         messages.NewImageForProcessing(account_number=ACCOUNT, image_name='a.jpg'))
+
+    def lease(self, lease_seconds=60):
+        return self.stack.call('lease_tasks', messages.LeaseTasks(queue=QUEUE, lease_seconds=lease_seconds))
+
+    def test_worker_leases(self):
+        resp = self.lease()
+        self.assertTrue(resp.ok, resp.error)
+        self.assertEqual(['Process--a.jpg'], [t.task_name for t in resp.tasks])
+
+    def test_other_accounts_are_denied(self):
+        for email in ('someone@example.com', ''):
+            os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+            resp = self.lease()
+            self.assertFalse(resp.ok)
+            self.assertEqual(errors.PERMISSION_DENIED, resp.error_code)
+        # Nothing was leased, the task is still available
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = 'cesar@golocky.com'
+        self.assertEqual(1, len(self.lease().tasks))
+
+    def test_lease_is_capped(self):
+        resp = self.lease(lease_seconds=7 * 24 * 3600)
+        self.assertEqual(1, len(resp.tasks))
+        task, = self.stack.taskqueue_stub.get_filtered_tasks(queue_names=[QUEUE])
+        self.assertLessEqual(task.eta_posix, time.time() + reading.MAX_LEASE_SECONDS + 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
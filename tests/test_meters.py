@@ -0,0 +1,25 @@
+"""
+Batch meter creation: every account number has its own outcome, failures carry their error code.
+"""
+__author__ = 'Cesar'
+
+import unittest
+import base
+import errors
+import messages
+
+
+class CreateMetersTest(base.StackTestCase):
+
+    def test_existing_meter_fails_alone(self):
+        self.stack.setup('new_meters', messages.CreateMeters(account_numbers=['0001000001']))
+
+        resp = self.stack.call('new_meters', messages.CreateMeters(account_numbers=['0001000001', '0001000002']))
+
+        self.assertTrue(resp.ok, resp.error)
+        self.assertEqual([False, True], [r.ok for r in resp.results])
+        self.assertEqual([errors.ALREADY_EXISTS, None], [r.error_code for r in resp.results])
+
+
+if __name__ == '__main__':
+    unittest.main()
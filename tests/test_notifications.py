@@ -0,0 +1,105 @@
+"""
+Push notifications from the outbox to the fake Parse server: delivery, retries of a failed notification with
+an exponentially growing delay, and dead-lettering after MAX_PUSH_ATTEMPTS.
+"""
+__author__ = 'Cesar'
+
+import time
+import unittest
+import base
+from google.appengine.api import taskqueue
+import notifications
+
+# Shorter than the real ones, so a test waits seconds for the retries
+TEST_RETRY_BASE_SECONDS = 1
+TEST_MAX_PUSH_ATTEMPTS = 4
+
+
+class NotificationsTest(base.StackTestCase):
+
+    def setUp(self):
+        base.StackTestCase.setUp(self)
+        self.settings = notifications.RETRY_BASE_SECONDS, notifications.MAX_PUSH_ATTEMPTS
+        notifications.RETRY_BASE_SECONDS = TEST_RETRY_BASE_SECONDS
+        notifications.MAX_PUSH_ATTEMPTS = TEST_MAX_PUSH_ATTEMPTS
+
+    def tearDown(self):
+        notifications.RETRY_BASE_SECONDS, notifications.MAX_PUSH_ATTEMPTS = self.settings
+        base.StackTestCase.tearDown(self)
+
+    def outbox(self):
+        return len(self.stack.taskqueue_stub.get_filtered_tasks(queue_names=[notifications.OUTBOX_QUEUE]))
+
+    def dispatches(self):
+        return len(self.stack.taskqueue_stub.get_filtered_tasks(queue_names=[notifications.DISPATCH_QUEUE]))
+
+    def retry_delay(self):
+        """
+        :return: seconds until the only notification of the outbox can be leased again
+        """
+        task, = self.stack.taskqueue_stub.get_filtered_tasks(queue_names=[notifications.OUTBOX_QUEUE])
+        return task.eta_posix - time.time()
+
+    def dispatch_when_due(self):
+        time.sleep(max(0, self.retry_delay()) + 0.2)
+        return self.stack.request(notifications.dispatch)
+
+    def test_enqueue_dispatch_delivery(self):
+        n = taskqueue.MAX_TASKS_PER_ADD + 5
+        self.stack.request(notifications.enqueue, 'install-0', 'Title', 'Message')
+        self.stack.request(notifications.enqueue_multi,
+                           [('install-{0}'.format(i), 'Title', 'Message') for i in xrange(1, n)])
+        self.assertEqual(n, self.outbox())
+        # A single dispatch task for the whole window
+        self.assertEqual(1, self.dispatches())
+
+        self.stack.drain([notifications.DISPATCH_QUEUE])
+
+        self.assertEqual(0, self.outbox())
+        received = sorted(r['where']['installationId'] for r in self.stack.parse_server.received)
+        self.assertEqual(sorted('install-{0}'.format(i) for i in xrange(n)), received)
+        self.assertTrue(all(size <= notifications.BATCH_SIZE for size in self.stack.parse_server.batches))
+        self.assertEqual(0, notifications.PushDeadLetter.query().count())
+
+    def test_failure_is_retried_after_backoff(self):
+        self.stack.request(notifications.enqueue, 'install-0', 'Title', 'Message')
+        self.stack.parse_server.failure_rate = 1.0
+
+        self.assertEqual(0, self.stack.request(notifications.dispatch))
+        # Still in the outbox, leased until its retry, with a retry dispatch scheduled
+        self.assertEqual(1, self.outbox())
+        self.assertGreaterEqual(self.dispatches(), 1)
+        self.assertEqual(0, self.stack.request(notifications.dispatch))
+        self.assertEqual([], self.stack.parse_server.received)
+
+        self.stack.parse_server.failure_rate = 0.0
+        self.assertEqual(1, self.dispatch_when_due())
+        self.assertEqual(0, self.outbox())
+        self.assertEqual(['install-0'], [r['where']['installationId'] for r in self.stack.parse_server.received])
+        self.assertEqual(0, notifications.PushDeadLetter.query().count())
+
+    def test_retry_delay_grows_until_dead_letter(self):
+        self.stack.request(notifications.enqueue, 'install-0', 'Title', 'Message')
+        self.stack.parse_server.failure_rate = 1.0
+
+        self.assertEqual(0, self.stack.request(notifications.dispatch))
+        delays = [self.retry_delay()]
+        self.assertEqual(0, notifications.PushDeadLetter.query().count())
+        # Retried until the last attempt fails too and the notification leaves the outbox as a dead letter
+        for _ in xrange(TEST_MAX_PUSH_ATTEMPTS):
+            if self.dispatch_when_due():
+                break
+            delays.append(self.retry_delay())
+        self.assertGreater(delays[-1], TEST_RETRY_BASE_SECONDS * 1.5)
+
+        self.assertEqual(0, self.outbox())
+        self.assertEqual([], self.stack.parse_server.received)
+        letters = notifications.PushDeadLetter.query().fetch()
+        self.assertEqual(1, len(letters))
+        self.assertEqual('install-0', letters[0].installation_id)
+        self.assertEqual('Message', letters[0].message)
+        self.assertGreaterEqual(letters[0].attempts, TEST_MAX_PUSH_ATTEMPTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Submission of OCR results: a task repeated in the same batch is applied, deleted and moved once, and every
+applied result sends its push once.
+"""
+__author__ = 'Cesar'
+
+import unittest
+import base
+import errors
+import messages
+import notifications
+import reading
+from meter import Meter
+from reading import Reading
+
+ACCOUNT = '0001000001'
+IMAGE_QUEUE = 'image-processing-queue'
+NEGATIVE_QUEUE = 'negative-consumption-queue'
+# More results than one reading transaction takes
+ROWS = reading.MAX_READINGS_PER_TRANSACTION + 5
+
+
+def result(image, measure):
+    return messages.ImageProcessingResult(task_name='Process--{0}'.format(image),
+                                          task_payload='{0}--{1}'.format(ACCOUNT, image),
+                                          result=measure,
+                                          error='',
+                                          human=False)
+
+
+class ResultsTest(base.StackTestCase):
+
+    def setUp(self):
+        base.StackTestCase.setUp(self)
+        Meter(key=Meter.get_key(ACCOUNT), account_number=ACCOUNT, balance=0, last_measure=100,
+              installation_id='install-0').put()
+        self.images(['a.jpg', 'b.jpg'])
+
+    def images(self, names):
+        for image in names:
+            self.stack.setup('new_image_for_processing',
+                             messages.NewImageForProcessing(account_number=ACCOUNT, image_name=image))
+
+    def pushes(self):
+        self.stack.drain([notifications.DISPATCH_QUEUE])
+        return [r['data']['title'] for r in self.stack.parse_server.received]
+
+    def tasks(self, queue):
+        return [t.name for t in self.stack.taskqueue_stub.get_filtered_tasks(queue_names=[queue])]
+
+    def test_repeated_task_in_batch(self):
+        results = [result('a.jpg', 105), result('a.jpg', 105), result('b.jpg', 90), result('b.jpg', 90)]
+
+        resp = self.stack.call('set_image_processing_results_batch',
+                               messages.ImageProcessingResultsBatch(results=results))
+
+        self.assertTrue(resp.ok, resp.error)
+        self.assertEqual([True] * 4, [s.ok for s in resp.results])
+        self.assertEqual(['Saved', 'Saved', 'NegativeConsumption', 'NegativeConsumption'],
+                         [s.outcome for s in resp.results])
+        self.assertEqual([False, True, False, True], [s.duplicate for s in resp.results])
+        self.assertEqual(1, Reading.query().count())
+        self.assertEqual(5, Meter.get_key(ACCOUNT).get().balance)
+        self.assertEqual([], self.tasks(IMAGE_QUEUE))
+        self.assertEqual(['Process--b.jpg'], self.tasks(NEGATIVE_QUEUE))
+        self.assertEqual(2, len(self.pushes()))
+
+        # A retry of the whole batch is a duplicate of every result and still succeeds
+        resp = self.stack.call('set_image_processing_results_batch',
+                               messages.ImageProcessingResultsBatch(results=results))
+        self.assertTrue(resp.ok, resp.error)
+        self.assertEqual([True] * 4, [s.duplicate for s in resp.results])
+        self.assertEqual(1, Reading.query().count())
+        self.assertEqual(2, len(self.pushes()))
+
+    def test_push_queued_with_single_result(self):
+        resp = self.stack.call('set_image_processing_result', result('a.jpg', 105))
+
+        self.assertTrue(resp.ok, resp.error)
+        self.assertEqual('Saved', resp.outcome)
+        self.assertEqual(1, len(self.pushes()))
+        # The reading and its push were committed together, a retry is a duplicate and sends nothing
+        resp = self.stack.call('set_image_processing_result', result('a.jpg', 105))
+        self.assertTrue(resp.duplicate)
+        self.assertEqual(1, len(self.pushes()))
+
+
+    def test_committed_chunks_survive_a_failed_one(self):
+        images = ['{0}.jpg'.format(n) for n in xrange(ROWS)]
+        self.images(images)
+        results = [result(image, 100 + n) for n, image in enumerate(images)]
+        mutate_balance = Meter.mutate_balance.im_func
+        calls = []
+
+        def failing_second_chunk(cls, account_number, build_change):
+            calls.append(account_number)
+            if len(calls) == 2:
+                raise Exception('Datastore unavailable')
+            return mutate_balance(cls, account_number, build_change)
+
+        Meter.mutate_balance = classmethod(failing_second_chunk)
+        try:
+            resp = self.stack.call('set_image_processing_results_batch',
+                                   messages.ImageProcessingResultsBatch(results=results))
+        finally:
+            Meter.mutate_balance = classmethod(mutate_balance)
+
+        committed = reading.MAX_READINGS_PER_TRANSACTION
+        self.assertTrue(resp.ok, resp.error)
+        self.assertEqual([True] * committed + [False] * (ROWS - committed), [s.ok for s in resp.results])
+        self.assertTrue(all(s.error_code == errors.INTERNAL for s in resp.results[committed:]))
+        self.assertEqual(committed, Reading.query().count())
+        # The committed results have their task deleted and their push, the others can be retried
+        self.assertEqual(sorted('Process--{0}.jpg'.format(n) for n in xrange(committed, ROWS)),
+                         sorted(t for t in self.tasks(IMAGE_QUEUE) if t not in ('Process--a.jpg', 'Process--b.jpg')))
+        self.assertEqual(committed, len(self.pushes()))
+
+        resp = self.stack.call('set_image_processing_results_batch',
+                               messages.ImageProcessingResultsBatch(results=results))
+        self.assertTrue(all(s.ok for s in resp.results))
+        self.assertEqual([True] * committed + [False] * (ROWS - committed), [s.duplicate for s in resp.results])
+        self.assertEqual(ROWS, Reading.query().count())
+        self.assertEqual(ROWS, len(self.pushes()))
+
+
+if __name__ == '__main__':
+    unittest.main()
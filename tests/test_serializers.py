@@ -0,0 +1,71 @@
+"""
+The list endpoints resolve the meter of their rows once per response: listing N rows costs the same datastore
+gets as listing one.
+"""
+__author__ = 'Cesar'
+
+import datetime
+import unittest
+import base
+from google.appengine.api import memcache
+import cache
+import messages
+from bill import Bill
+from meter import Meter
+from prepay import Prepay
+from reading import Reading
+
+ACCOUNT = '0001000001'
+ROWS = 20
+
+
+class ListingGetsTest(base.StackTestCase):
+
+    def setUp(self):
+        base.StackTestCase.setUp(self)
+        self.meter = Meter(key=Meter.get_key(ACCOUNT), account_number=ACCOUNT, balance=0)
+        self.meter.put()
+        self.rows = 0
+
+    def add_rows(self, n):
+        start = datetime.datetime(2016, 1, 1)
+        for i in xrange(self.rows, self.rows + n):
+            date = start + datetime.timedelta(days=i)
+            Reading(key=Reading.build_key(ACCOUNT, date), date=date, meter=self.meter.key, measure=i).put()
+            Bill(date=date, meter=self.meter.key, balance=i, amount=i * 1.5, status='Unpaid').put()
+            Prepay(meter=self.meter.key, balance=0, prepay=i, amount=i * 1.5).put()
+        self.rows += n
+
+    def gets(self, method, request):
+        """
+        Datastore gets of one endpoint call, with cold entity caches so every call starts from the same state
+        """
+        memcache.flush_all()
+        cache.meters.clear()
+        resp, rpcs = self.rpcs(getattr(self.stack.api, method), request)
+        self.assertTrue(resp.ok, resp.error)
+        return resp, rpcs['datastore_v3.Get']
+
+    def assert_same_gets(self, method, request, field):
+        self.add_rows(1)
+        resp, one = self.gets(method, request)
+        self.assertEqual(1, len(getattr(resp, field)))
+        self.add_rows(ROWS - 1)
+        resp, many = self.gets(method, request)
+        self.assertEqual(ROWS, len(getattr(resp, field)))
+        self.assertTrue(all(r.account_number == ACCOUNT for r in getattr(resp, field)))
+        self.assertEqual(one, many)
+
+    def test_readings(self):
+        self.assert_same_gets('get_readings', messages.GetReadings(account_number=ACCOUNT, page_size=ROWS),
+                              'readings')
+
+    def test_bills(self):
+        self.assert_same_gets('get_bills', messages.GetBills(account_number=ACCOUNT, page_size=ROWS), 'bills')
+
+    def test_prepays(self):
+        self.assert_same_gets('get_prepays', messages.GetPrepays(account_number=ACCOUNT), 'prepays')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,11 +6,13 @@ __author__ = 'Cesar'
 
 import logging
 from google.appengine.ext import ndb
+import cache
+import errors
 
 
 class User(ndb.Model):
     """
-    Represents a user of the platform.
+    Represents a user of the platform. Users are keyed by their normalized email (see get_key).
 
         - account_type: Authentication used to validate the User.
         - installation_id: Parse parameter for Push notifications.
@@ -23,6 +25,35 @@ class User(ndb.Model):
     account_type = ndb.StringProperty(choices=['Facebook', 'G+'])
     installation_id = ndb.StringProperty()
 
+    # Reads go through cache.users, which keeps its own memcache tier
+    _use_memcache = False
+
+    @staticmethod
+    def normalize_email(email):
+        """
+        Normalizes an email so that the same address always maps to the same key.
+
+        Args:
+            email: (String) email from request
+
+        Returns:
+            (String) stripped, lower case email
+        """
+        return email.strip().lower()
+
+    @classmethod
+    def get_key(cls, email):
+        """
+        Builds the datastore key of a user from its email.
+
+        Args:
+            email: (String) email from request
+
+        Returns:
+            ndb Key of the user
+        """
+        return ndb.Key(cls, cls.normalize_email(email))
+
     @classmethod
     def exists(cls, email):
         """
@@ -34,7 +65,7 @@ class User(ndb.Model):
         Returns:
             True if email exist False otherwise
         """
-        return cls.query(cls.email == email).count(1) == 1
+        return cls.get_key(email).get() is not None
 
     @classmethod
     def create_in_datastore(cls, account_type, age, email, name, installation_id):
@@ -42,49 +73,41 @@ class User(ndb.Model):
         Creates a new user in datastore
         """
         try:
-            if User.exists(email):
-                raise UserCreationError('User email already in platform')
-            else:
-                u = User(account_type=account_type, age=age, email=email, name=name, installation_id=installation_id)
-                key = u.put()
+            key = User.transactional_create(account_type, age, email, name, installation_id)
+            cache.users.invalidate(key)
         except Exception as e:
-            raise UserCreationError('Error creating the user in platform: '+e.__str__())
+            raise errors.wrap(UserCreationError, 'Error creating the user in platform: ', e)
         else:
             logging.debug('[User] - New User Key = {0}'.format(key))
             return True
 
     @classmethod
-    def get_from_datastore(cls, email):
+    @ndb.transactional
+    def transactional_create(cls, account_type, age, email, name, installation_id):
         """
-        Gets user from datastore based on email
+        Creates the user under its email key only if that key is still free.
+
+            :return: key of the new user
+            :exception UserCreationError if the email is already in use
         """
-        try:
-            if User.exists(email):
-                query = User.query(User.email == email).fetch(limit=1)
-                u = query
-            else:
-                raise GetUserError('User does not exist')
-        except Exception as e:
-                raise GetUserError('Error getting user: '+e.__str__())
-        else:
-            logging.debug("[User] - Key = {0}".format(u[0].key))
-            logging.debug("[User] - email = {0}".format(u[0].email))
-            logging.debug("[User] - name = {0}".format(u[0].name))
-            logging.debug("[User] - age = {0}".format(u[0].age))
-            logging.debug("[User] - account_type = {0}".format(u[0].account_type))
-            logging.debug("[User] - installation_id = {0}".format(u[0].installation_id))
-            return u[0]
+        key = User.get_key(email)
+        if key.get() is not None:
+            raise UserCreationError('User email already in platform', errors.ALREADY_EXISTS)
+        u = User(key=key, account_type=account_type, age=age, email=key.id(), name=name,
+                 installation_id=installation_id)
+        return u.put()
 
     @classmethod
-    def get_by_meter_key(cls, meter_key):
+    def get_from_datastore(cls, email):
         """
-        Gets user from datastore based on a meter_key
+        Gets user from datastore based on email
         """
         try:
-            m = meter_key.get()
-            u = m.user.get()
+            u = cache.users.get(User.get_key(email))
+            if u is None:
+                raise GetUserError('User does not exist', errors.NOT_FOUND)
         except Exception as e:
-            raise GetUserError('Error getting user: '+e.__str__())
+            raise errors.wrap(GetUserError, 'Error getting user: ', e)
         else:
             logging.debug("[User] - Key = {0}".format(u.key))
             logging.debug("[User] - email = {0}".format(u.email))
@@ -95,19 +118,9 @@ class User(ndb.Model):
             return u
 
 
-class UserCreationError(Exception):
-    def __init__(self, value):
-        self.value = value
-        logging.exception('[User] - '+value, exc_info=True)
-
-    def __str__(self):
-        return repr(self.value)
-
-
-class GetUserError(Exception):
-    def __init__(self, value):
-        self.value = value
+class UserCreationError(errors.PlatformError):
+    pass
 
-    def __str__(self):
-        return repr(self.value)
 
+class GetUserError(errors.PlatformError):
+    pass